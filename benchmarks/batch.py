@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time BatchSREs on a full-table sized set of random prefixes
+
+Prefixes are generated as arrays of integers, with a distribution of
+prefix lengths similar to the one of the global routing table, and their
+SREs are computed using pierky.usres_monitor.batch; NumPy is needed.
+
+Usage: benchmarks/batch.py [IPv4 prefixes] [IPv6 prefixes]
+"""
+
+import os
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import numpy
+
+from pierky.usres_monitor.batch import BatchSREs
+
+# (min, max) prefix length, share of the prefixes
+PREFIX_LENS = {
+    4: [((8, 15), 0.001), ((16, 19), 0.15), ((20, 23), 0.35),
+        ((24, 24), 0.5)],
+    6: [((19, 31), 0.1), ((32, 47), 0.4), ((48, 48), 0.5)]
+}
+TARGET_PREFIX_LEN = {4: 24, 6: 48}
+
+
+def random_prefixes(ip_ver, prefix_cnt):
+    rnd = numpy.random.RandomState(prefix_cnt)
+    # IPv6: the highest 64 bits of the addresses
+    tot_len = 32 if ip_ver == 4 else 64
+
+    pref_lens = []
+    for (min_len, max_len), share in PREFIX_LENS[ip_ver]:
+        pref_lens.append(rnd.randint(min_len, max_len + 1,
+                                     int(prefix_cnt * share)))
+    pref_lens = numpy.concatenate(pref_lens).astype(numpy.uint64)
+    rnd.shuffle(pref_lens)
+
+    firsts = rnd.randint(0, 2**32, len(pref_lens)).astype(numpy.uint64) << \
+        numpy.uint64(tot_len - 32)
+    host_bits = numpy.uint64(tot_len) - pref_lens
+    firsts = (firsts >> host_bits) << host_bits
+    if ip_ver == 6:
+        # The highest 64 bits of the 128-bit values.
+        firsts = firsts.astype(object) << 64
+    return firsts, pref_lens
+
+
+def main():
+    sizes = {4: 900000, 6: 150000}
+    for ip_ver, arg in zip([4, 6], sys.argv[1:]):
+        sizes[ip_ver] = int(arg)
+
+    print("{:>4} {:>8} {:>4} {:>8} {:>14} {:>10}".format(
+        "ver", "prefixes", "len", "SREs", "count", "time"))
+
+    for ip_ver in [4, 6]:
+        firsts, pref_lens = random_prefixes(ip_ver, sizes[ip_ver])
+
+        start = timer()
+        sres = BatchSREs(ip_ver, firsts, pref_lens,
+                         TARGET_PREFIX_LEN[ip_ver])
+        cnt = sres.get_count()
+        batch_time = timer() - start
+
+        print("{:>4} {:>8} {:>4} {:>8} {:>14} {:>9.3f}s".format(
+            ip_ver, len(firsts), TARGET_PREFIX_LEN[ip_ver], len(sres.ids),
+            cnt, batch_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare flapping prefixes applied directly and through CoalescingBuffer
+
+A set of random IPv4 prefixes is loaded into a monitor, then a small share
+of them flaps: each flapping prefix is withdrawn and announced again many
+times, and the count is read after every batch of events. Events are
+applied using del_net() and add_net() of the monitor and then through
+pierky.usres_monitor.buffer.CoalescingBuffer, flushed before each read,
+with both backends.
+
+Usage: benchmarks/buffer.py [prefixes] [events] [batch size]
+"""
+
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import ipaddr
+
+from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor
+from pierky.usres_monitor.buffer import CoalescingBuffer
+
+FLAPPING_SHARE = 0.001
+
+
+def random_nets(prefix_cnt):
+    rnd = random.Random(prefix_cnt)
+    nets = set()
+    while len(nets) < prefix_cnt:
+        pref_len = rnd.randint(16, 24)
+        ip = ipaddr.IPv4Address(rnd.getrandbits(pref_len) << 32 - pref_len)
+        nets.add("{}/{}".format(ip, pref_len))
+    return sorted(nets)
+
+
+def main():
+    prefix_cnt, event_cnt, batch_size = 100000, 20000, 1000
+    args = [int(arg) for arg in sys.argv[1:4]]
+    prefix_cnt, event_cnt, batch_size = \
+        args + [prefix_cnt, event_cnt, batch_size][len(args):]
+
+    nets = random_nets(prefix_cnt)
+    rnd = random.Random(event_cnt)
+    flapping = rnd.sample(nets, max(1, int(prefix_cnt * FLAPPING_SHARE)))
+    events = []
+    announced = set(flapping)
+    for i in range(event_cnt):
+        net = rnd.choice(flapping)
+        events.append(("del" if net in announced else "add", net))
+        announced.symmetric_difference_update([net])
+
+    print("{:<10} {:<8} {:>8} {:>10} {:>10}".format(
+        "backend", "mode", "events", "processed", "time"))
+
+    for backend in ["sqlite", "intervals"]:
+        for mode in ["direct", "buffer"]:
+            monitor = UniqueSmallestRoutableEntriesMonitor(
+                target_prefix_len4=24, backend=backend
+            )
+            monitor.add_nets(nets)
+            monitor.get_count(4)
+
+            if mode == "direct":
+                target = monitor
+            else:
+                target = CoalescingBuffer(monitor, batch_size=batch_size,
+                                          batch_interval=3600)
+
+            start = timer()
+            for i, (action, net) in enumerate(events, 1):
+                if action == "add":
+                    target.add_net(net)
+                else:
+                    target.del_net(net)
+                if i % batch_size == 0:
+                    if mode == "buffer":
+                        target.flush()
+                    monitor.get_count(4)
+            if mode == "buffer":
+                target.flush()
+            cnt = monitor.get_count(4)
+            elapsed = timer() - start
+
+            processed = target.processed if mode == "buffer" else len(events)
+            print("{:<10} {:<8} {:>8} {:>10} {:>9.3f}s  {} SREs".format(
+                backend, mode, len(events), processed, elapsed, cnt))
+
+if __name__ == "__main__":
+    main()
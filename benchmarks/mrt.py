@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time the load of an MRT RIB dump into a monitor
+
+A gzip-compressed MRT file with a full-table sized set of random IPv4
+prefixes, each one received from some peers, is generated in a temporary
+directory; its prefixes are then loaded into a monitor ("sqlite" backend)
+using:
+
+- "strings": the prefixes read by pierky.usres_monitor.mrt, turned into
+  one string for each peer and added with add_net(), as when the file is
+  decoded by an external tool;
+
+- "loader": pierky.usres_monitor.mrt.MRTLoader.
+
+Usage: benchmarks/mrt.py [prefixes] [peers]
+"""
+
+import gzip
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor, \
+    USRESMonitorException
+from pierky.usres_monitor.mrt import MRTLoader, iter_records, \
+    iter_rib_prefixes, open_mrt
+
+# Attributes of each route: ORIGIN, AS_PATH, NEXT_HOP
+ATTRS = b"\x40\x01\x01\x00" + \
+    b"\x40\x02\x0e\x02\x03\x00\x00\xfd\xe8\x00\x00\xfd\xe9\x00\x00\xfd\xea" + \
+    b"\x40\x03\x04\xc0\x00\x02\x01"
+
+
+def write_rib(path, prefix_cnt, peer_cnt):
+    rnd = random.Random(prefix_cnt)
+    prefixes = set()
+    while len(prefixes) < prefix_cnt:
+        pref_len = rnd.randint(16, 24)
+        prefixes.add((rnd.getrandbits(pref_len) << 32 - pref_len, pref_len))
+
+    with gzip.open(path, "wb") as f:
+        for seq, (first, pref_len) in enumerate(sorted(prefixes)):
+            body = struct.pack("!IB", seq, pref_len) + \
+                struct.pack("!I", first)[:(pref_len + 7) // 8] + \
+                struct.pack("!H", peer_cnt)
+            for peer in range(peer_cnt):
+                body += struct.pack("!HIH", peer, 1483228800, len(ATTRS)) + \
+                    ATTRS
+            f.write(struct.pack("!IHHI", 1483228800, 13, 2, len(body)) +
+                    body)
+
+
+def main():
+    prefix_cnt, peer_cnt = 500000, 10
+    args = [int(arg) for arg in sys.argv[1:3]]
+    prefix_cnt, peer_cnt = args + [prefix_cnt, peer_cnt][len(args):]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "rib.gz")
+        write_rib(path, prefix_cnt, peer_cnt)
+        print("{} prefixes, {} peers, {} KB compressed".format(
+            prefix_cnt, peer_cnt, os.path.getsize(path) // 1024))
+
+        get_ip_str = UniqueSmallestRoutableEntriesMonitor.get_ip_str
+
+        start = timer()
+        monitor = UniqueSmallestRoutableEntriesMonitor(target_prefix_len4=24)
+        f = open_mrt(path)
+        for ip_ver, first, pref_len in iter_rib_prefixes(iter_records(f)):
+            for peer in range(peer_cnt):
+                try:
+                    monitor.add_net("{}/{}".format(
+                        get_ip_str(ip_ver, first), pref_len))
+                except USRESMonitorException:
+                    pass
+        f.close()
+        print("{:<8} {:>10} SREs {:>9.3f}s".format(
+            "strings", monitor.get_count(4), timer() - start))
+
+        start = timer()
+        monitor = UniqueSmallestRoutableEntriesMonitor(target_prefix_len4=24)
+        MRTLoader(monitor).load(path)
+        print("{:<8} {:>10} SREs {:>9.3f}s".format(
+            "loader", monitor.get_count(4), timer() - start))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
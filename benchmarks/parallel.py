@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare ShardedSREs with a growing number of processes
+
+A full-table sized set of random prefixes, with a distribution of prefix
+lengths similar to the one of the global routing table, is generated as a
+list of strings; its SREs are computed using a monitor (add_nets() and
+get_count(), "intervals" backend) and using
+pierky.usres_monitor.parallel.ShardedSREs with 1, 2, 4... processes, up
+to the number of CPUs.
+
+Usage: benchmarks/parallel.py [IPv4 prefixes] [IPv6 prefixes]
+"""
+
+import multiprocessing
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import ipaddr
+
+from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor
+from pierky.usres_monitor.parallel import ShardedSREs
+
+# (min, max) prefix length, share of the prefixes
+PREFIX_LENS = {
+    4: [((8, 15), 0.001), ((16, 19), 0.15), ((20, 23), 0.35),
+        ((24, 24), 0.5)],
+    6: [((19, 31), 0.1), ((32, 47), 0.4), ((48, 48), 0.5)]
+}
+TARGET_PREFIX_LEN = {4: 24, 6: 48}
+
+
+def random_nets(ip_ver, prefix_cnt):
+    rnd = random.Random(prefix_cnt)
+    nets = []
+    for (min_len, max_len), share in PREFIX_LENS[ip_ver]:
+        for i in range(int(prefix_cnt * share)):
+            pref_len = rnd.randint(min_len, max_len)
+            if ip_ver == 4:
+                ip = ipaddr.IPv4Address(rnd.getrandbits(pref_len) <<
+                                        32 - pref_len)
+            else:
+                ip = ipaddr.IPv6Address(rnd.getrandbits(pref_len) <<
+                                        128 - pref_len)
+            nets.append("{}/{}".format(ip, pref_len))
+    rnd.shuffle(nets)
+    return nets
+
+
+def main():
+    sizes = {4: 900000, 6: 150000}
+    for ip_ver, arg in zip([4, 6], sys.argv[1:]):
+        sizes[ip_ver] = int(arg)
+
+    nets = random_nets(4, sizes[4]) + random_nets(6, sizes[6])
+
+    print("{:<20} {:>10} {:>10} {:>10}".format(
+        "engine", "IPv4 SREs", "IPv6 SREs", "time"))
+
+    def report(engine, cnt4, cnt6, elapsed):
+        print("{:<20} {:>10} {:>10} {:>9.3f}s".format(
+            engine, cnt4, cnt6, elapsed))
+
+    start = timer()
+    monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len4=TARGET_PREFIX_LEN[4],
+        target_prefix_len6=TARGET_PREFIX_LEN[6],
+        backend="intervals"
+    )
+    monitor.add_nets(nets)
+    report("monitor", monitor.get_count(4), monitor.get_count(6),
+           timer() - start)
+
+    processes = 1
+    while True:
+        start = timer()
+        sres = ShardedSREs.from_nets(
+            nets,
+            target_prefix_len4=TARGET_PREFIX_LEN[4],
+            target_prefix_len6=TARGET_PREFIX_LEN[6],
+            processes=processes
+        )
+        report("{} processes".format(processes), sres[4].get_count(),
+               sres[6].get_count(), timer() - start)
+
+        if processes >= multiprocessing.cpu_count():
+            break
+        processes = min(processes * 2, multiprocessing.cpu_count())
+
+if __name__ == "__main__":
+    main()
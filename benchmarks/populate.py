@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the rebuild of the SREs table against its previous implementation
+
+_populate_smallest_routable_entries() used to run two nested GROUP BY
+self-joins and to feed their rows, sorted by pref_len, into a view whose
+INSTEAD OF trigger rejected the rows already covered. It now runs a single
+sweep over the prefixes sorted by (first, pref_len).
+
+This script loads random prefixes using the same sizes and prefix lengths
+of test_random_load in tests.py, rebuilds the SREs table with both the
+implementations, checks that the results are identical and prints the
+timings.
+
+Usage: benchmarks/populate.py [sqlite3|apsw]
+"""
+
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor
+
+SIZES = [
+    (4, 100, 24),
+    (4, 1000, 24),
+    (4, 10000, 24),
+    (4, 30000, 24),
+    (4, 100000, 24),
+    (4, 500000, 24),
+    (6, 100, 64),
+    (6, 1000, 64),
+    (6, 10000, 64)
+]
+
+
+def random_prefixes(ip_ver, prefix_cnt, target_prefix_len):
+    """Same distribution of tests.py:add_random_net"""
+
+    tot_len = 32 if ip_ver == 4 else 128
+    min_prefix_len = 8 if ip_ver == 4 else 19
+    prefixes = {}
+    while len(prefixes) < prefix_cnt:
+        prefix_len = random.randint(min_prefix_len, target_prefix_len - 1)
+        first = random.randint(0, 2**prefix_len - 1) << \
+            tot_len - prefix_len
+        diff_len = target_prefix_len - prefix_len
+        last = first | ((2**diff_len - 1) << tot_len - target_prefix_len)
+        prefixes[(first, prefix_len)] = (first, prefix_len, last,
+                                         2**diff_len)
+    return list(prefixes.values())
+
+
+def setup_legacy(backend, ip_ver):
+    backend.sql_out(
+        "CREATE TEMP VIEW"
+        "    smallest_routable_entries{ip_ver}_view AS"
+        "    SELECT"
+        "        *"
+        "    FROM"
+        "        smallest_routable_entries{ip_ver}"
+        "".format(ip_ver=ip_ver))
+
+    backend.sql_out(
+        "CREATE TEMP TRIGGER"
+        "    smallest_routable_entries{ip_ver}_view_insert "
+        "INSTEAD OF INSERT ON"
+        "    smallest_routable_entries{ip_ver}_view "
+        "BEGIN"
+        "    INSERT INTO smallest_routable_entries{ip_ver}"
+        "    SELECT NEW.id, NEW.first, NEW.pref_len, NEW.last, NEW.cnt"
+        "    WHERE"
+        "        NOT EXISTS ("
+        "            SELECT id FROM smallest_routable_entries{ip_ver}"
+        "            WHERE NEW.first BETWEEN first AND last"
+        "        );"
+        "END".format(ip_ver=ip_ver))
+
+
+def populate_legacy(backend, ip_ver):
+    sql = ("SELECT "
+           "     a.* "
+           "FROM "
+           "     prefixes{ip_ver} a"
+           "        INNER JOIN ("
+           "            SELECT"
+           "                last,"
+           "                MIN(first) AS first"
+           "            FROM"
+           "                prefixes{ip_ver}"
+           "            GROUP BY last"
+           "        ) b ON"
+           "            a.first = b.first AND"
+           "            a.last = b.last"
+           "".format(ip_ver=ip_ver))
+
+    sql = ("SELECT "
+           "    c.id, c.first, c.pref_len, c.last, c.cnt "
+           "FROM "
+           "    prefixes{ip_ver} c"
+           "        INNER JOIN ("
+           "            SELECT "
+           "                first, MAX(last) AS last "
+           "            FROM "
+           "                ({sql})"
+           "            GROUP BY"
+           "                first"
+           "        ) d ON"
+           "            c.first = d.first AND"
+           "            c.last = d.last "
+           "".format(ip_ver=ip_ver, sql=sql))
+
+    backend.sql_out("BEGIN")
+    backend.sql_out("DELETE FROM smallest_routable_entries{}".format(ip_ver))
+    backend.sql_out("INSERT INTO smallest_routable_entries{ip_ver}_view "
+                    "    SELECT * FROM ({sql}) ORDER BY pref_len".format(
+                        ip_ver=ip_ver, sql=sql))
+    backend.sql_out("COMMIT")
+
+
+def get_sres(backend, ip_ver):
+    return backend.sql_out("SELECT id, first, pref_len, last, cnt "
+                           "FROM smallest_routable_entries{} "
+                           "ORDER BY id".format(ip_ver)).fetchall()
+
+
+def main():
+    force_sqlite_lib = sys.argv[1] if len(sys.argv) > 1 else None
+
+    print("{:>4} {:>8} {:>4} {:>8} {:>10} {:>10} {:>8}".format(
+        "ver", "prefixes", "len", "SREs", "legacy", "sweep", "speedup"))
+
+    for ip_ver, prefix_cnt, target_prefix_len in SIZES:
+        random.seed(prefix_cnt)
+        monitor = UniqueSmallestRoutableEntriesMonitor(
+            target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+            target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+            force_sqlite_lib=force_sqlite_lib
+        )
+        backend = monitor.backend
+        setup_legacy(backend, ip_ver)
+
+        backend.begin()
+        backend.add_prefixes(
+            ip_ver, random_prefixes(ip_ver, prefix_cnt, target_prefix_len)
+        )
+        backend.commit()
+
+        start = timer()
+        populate_legacy(backend, ip_ver)
+        legacy_time = timer() - start
+        legacy_sres = get_sres(backend, ip_ver)
+
+        start = timer()
+        monitor._populate_smallest_routable_entries(ip_ver)
+        sweep_time = timer() - start
+        sweep_sres = get_sres(backend, ip_ver)
+
+        assert legacy_sres == sweep_sres, \
+            "Results don't match for {} IPv{} prefixes".format(
+                prefix_cnt, ip_ver)
+
+        print("{:>4} {:>8} {:>4} {:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format(
+            ip_ver, prefix_cnt, target_prefix_len, len(sweep_sres),
+            legacy_time, sweep_time, legacy_time / max(sweep_time, 1e-6)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark suite: throughput, latency and memory of the monitor
+
+Each case loads prefixes into a new monitor one by one using add_net(),
+then applies churn to them using del_net() and add_net(), reading the
+count after every change; get_prefixes() is timed on the whole table
+after the load and after the churn.
+
+Prefixes are generated with a realistic distribution of prefix lengths
+("dfz", roughly the one of the global routing table, with a share of more
+specific prefixes nested within other prefixes) or with the uniform one
+used by tests.py ("uniform"). Churn patterns are:
+
+- "flap": random prefixes are withdrawn and announced again;
+- "reset": a random share of the table, as received from a peer whose
+  session went down, is withdrawn and then announced again.
+
+With the "sqlite" backend, the database can be kept in memory (the
+default) or in a file (--storage disk, see the db_path argument of the
+monitor); "--storage memory disk" compares the two modes.
+
+For each operation the results report the ops/sec and the latency
+percentiles; for each case, the peak memory (resident set size) used by
+the monitor. Each case runs in its own process, so that its peak memory
+is not affected by the previous ones.
+
+Results are written in JSON, to stdout or to the --output file, and can
+be compared against the results of a previous run using --compare:
+operations whose ops/sec dropped by more than --threshold are reported
+and the exit code is 1.
+
+Usage examples:
+
+    benchmarks/suite.py --output results.json
+    benchmarks/suite.py --backend intervals --prefixes4 950000 \\
+        --prefixes6 200000 --compare results.json
+    benchmarks/suite.py --backend sqlite --storage memory disk
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor, \
+                                 BACKENDS
+from pierky.usres_monitor.version import __version__
+
+TARGET_PREFIX_LEN = {4: 24, 6: 48}
+
+# Share of prefixes by prefix length (weights), roughly the one of the
+# global routing table.
+DISTRIBUTIONS = {
+    "dfz": {
+        4: {8: 0.01, 9: 0.01, 10: 0.03, 11: 0.08, 12: 0.15, 13: 0.3,
+            14: 0.6, 15: 1, 16: 1.4, 17: 0.6, 18: 1, 19: 2.5, 20: 4,
+            21: 4.5, 22: 11.5, 23: 9.5, 24: 60},
+        6: {19: 0.01, 20: 0.02, 24: 0.05, 28: 0.3, 29: 3, 30: 0.5,
+            31: 0.3, 32: 18, 33: 1, 34: 1, 35: 0.7, 36: 2, 37: 0.5,
+            38: 0.7, 39: 0.5, 40: 4, 41: 0.4, 42: 1, 43: 0.5, 44: 5,
+            45: 1, 46: 4, 47: 2, 48: 50}
+    },
+    # Same of tests.py:add_random_net().
+    "uniform": {
+        4: dict((pref_len, 1) for pref_len in range(8, 24)),
+        6: dict((pref_len, 1) for pref_len in range(19, 48))
+    }
+}
+
+# Share of prefixes that are more specific of another prefix.
+NESTED_SHARE = {"dfz": 0.4, "uniform": 0}
+
+CHURN_PATTERNS = ["flap", "reset"]
+
+# Share of the table that is withdrawn by a "reset".
+RESET_SHARE = 0.1
+
+STORAGES = ["memory", "disk"]
+
+OPERATIONS = ["add_net", "del_net", "get_count", "get_prefixes",
+              "prefixes_raw"]
+
+
+def random_pref_len(rnd, weights):
+    pref_lens = sorted(weights)
+    value = rnd.uniform(0, sum(weights.values()))
+    for pref_len in pref_lens:
+        value -= weights[pref_len]
+        if value <= 0:
+            return pref_len
+    return pref_lens[-1]
+
+
+def random_prefixes(rnd, ip_ver, prefix_cnt, distribution):
+    """Returns: list of (first, pref_len) tuples, without duplicates
+
+    IPv4 prefixes are within 1.0.0.0-223.255.255.255, IPv6 ones within
+    2000::/3, as in the global routing table.
+    """
+
+    tot_len = 32 if ip_ver == 4 else 128
+    min_first, max_first = (1 << 24, 224 << 24) if ip_ver == 4 \
+        else (1 << 125, 1 << 126)
+    weights = DISTRIBUTIONS[distribution][ip_ver]
+
+    prefixes = set()
+    by_len = dict((pref_len, []) for pref_len in weights)
+    while len(prefixes) < prefix_cnt:
+        pref_len = random_pref_len(rnd, weights)
+
+        first = None
+        if rnd.random() < NESTED_SHARE[distribution]:
+            # more specific of an existing shorter prefix
+            shorter = [l for l in by_len if l < pref_len and by_len[l]]
+            if shorter:
+                parent_first, parent_len = rnd.choice(
+                    by_len[rnd.choice(shorter)])
+                first = parent_first | \
+                    rnd.getrandbits(pref_len - parent_len) << \
+                    tot_len - pref_len
+        if first is None:
+            first = rnd.randint(min_first, max_first - 1)
+            first = first >> tot_len - pref_len << tot_len - pref_len
+
+        if (first, pref_len) not in prefixes:
+            prefixes.add((first, pref_len))
+            by_len[pref_len].append((first, pref_len))
+
+    res = list(prefixes)
+    rnd.shuffle(res)
+    return res
+
+
+def get_peak_memory():
+    """Returns: peak resident set size of the process, in KB, or None"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak // 1024
+    return peak
+
+
+def summarize(samples):
+    """Returns: ops/sec and latency percentiles (in microseconds)"""
+
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1,
+                                 int(len(samples) * p / 100.0))] * 1e6, 3)
+
+    return {
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / max(sum(samples), 1e-9), 1),
+        "p50_us": percentile(50),
+        "p90_us": percentile(90),
+        "p99_us": percentile(99),
+        "max_us": round(samples[-1] * 1e6, 3)
+    }
+
+
+def run_case(case):
+    """Run a single case
+
+    Args:
+        case: dict with backend, storage, ip_ver, distribution, churn,
+            prefixes, churn_ops, seed.
+
+    Returns: dict, the results
+    """
+
+    ip_ver = case["ip_ver"]
+    rnd = random.Random(case["seed"])
+    prefixes = random_prefixes(rnd, ip_ver, case["prefixes"],
+                               case["distribution"])
+    get_ip_repr = UniqueSmallestRoutableEntriesMonitor.get_ip_repr
+    nets = ["{}/{}".format(get_ip_repr(ip_ver, first), pref_len)
+            for first, pref_len in prefixes]
+
+    mem_before = get_peak_memory()
+
+    tmp_dir = None
+    db_path = None
+    if case.get("storage") == "disk":
+        tmp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(tmp_dir, "usres.db")
+
+    monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len4=TARGET_PREFIX_LEN[4],
+        target_prefix_len6=TARGET_PREFIX_LEN[6],
+        backend=case["backend"],
+        db_path=db_path
+    )
+    samples = dict((operation, []) for operation in OPERATIONS)
+
+    def timed(operation, func, *args):
+        start = timer()
+        res = func(*args)
+        samples[operation].append(timer() - start)
+        return res
+
+    def read_all():
+        for prefix in monitor.get_prefixes(ip_ver):
+            pass
+
+    def read_all_raw():
+        for prefix in monitor.get_prefixes(ip_ver, raw=True):
+            pass
+
+    start = timer()
+    for net in nets:
+        timed("add_net", monitor.add_net, net)
+    load_time = timer() - start
+    timed("get_count", monitor.get_count, ip_ver)
+    timed("get_prefixes", read_all)
+
+    if case["churn"] == "flap":
+        for i in range(case["churn_ops"] // 2):
+            net = rnd.choice(nets)
+            timed("del_net", monitor.del_net, net)
+            timed("get_count", monitor.get_count, ip_ver)
+            timed("add_net", monitor.add_net, net)
+            timed("get_count", monitor.get_count, ip_ver)
+    elif case["churn"] == "reset":
+        peer_nets = rnd.sample(nets, int(len(nets) * RESET_SHARE))
+        for func, operation in [(monitor.del_net, "del_net"),
+                                (monitor.add_net, "add_net")]:
+            for net in peer_nets:
+                timed(operation, func, net)
+                timed("get_count", monitor.get_count, ip_ver)
+
+    for i in range(3):
+        timed("get_prefixes", read_all)
+        timed("prefixes_raw", read_all_raw)
+
+    mem_after = get_peak_memory()
+
+    if tmp_dir:
+        shutil.rmtree(tmp_dir)
+
+    res = dict(case)
+    res.update({
+        "sres": monitor.get_count(ip_ver),
+        "load_time": round(load_time, 3),
+        "peak_memory_kb": mem_after - mem_before
+        if mem_before is not None else None,
+        "operations": dict((operation, summarize(samples[operation]))
+                           for operation in OPERATIONS)
+    })
+    return res
+
+
+def get_case_key(case):
+    # Results of previous runs may lack the storage.
+    return "{backend} {storage} IPv{ip_ver} {distribution} {churn} " \
+        "{prefixes}".format(**dict(case, storage=case.get("storage",
+                                                          "memory")))
+
+
+def compare(results, baseline, threshold):
+    """Print the ops/sec compared to a previous run
+
+    Returns: the number of regressions
+    """
+
+    baseline_cases = dict((get_case_key(case), case)
+                          for case in baseline["cases"])
+    regressions = 0
+    for case in results["cases"]:
+        old_case = baseline_cases.get(get_case_key(case))
+        if not old_case:
+            continue
+        for operation in OPERATIONS:
+            new = case["operations"].get(operation)
+            old = old_case["operations"].get(operation)
+            if not new or not old:
+                continue
+            ratio = new["ops_per_sec"] / max(old["ops_per_sec"], 1e-9)
+            regression = ratio < 1 - threshold
+            regressions += int(regression)
+            sys.stderr.write(
+                "{:<48} {:<13} {:>12} {:>12} {:>6.2f}x{}\n".format(
+                    get_case_key(case), operation, old["ops_per_sec"],
+                    new["ops_per_sec"], ratio,
+                    " REGRESSION" if regression else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark suite of the USREs monitor"
+    )
+    parser.add_argument("--backend", nargs="+", choices=sorted(BACKENDS),
+                        default=sorted(BACKENDS))
+    parser.add_argument("--storage", nargs="+", choices=STORAGES,
+                        default=["memory"],
+                        help="Where the \"sqlite\" backend keeps the "
+                        "database (default: memory)")
+    parser.add_argument("--distribution", nargs="+",
+                        choices=sorted(DISTRIBUTIONS), default=["dfz"])
+    parser.add_argument("--churn", nargs="+", choices=CHURN_PATTERNS,
+                        default=CHURN_PATTERNS)
+    parser.add_argument("--prefixes4", type=int, default=100000,
+                        help="Number of IPv4 prefixes (0 to skip IPv4)")
+    parser.add_argument("--prefixes6", type=int, default=20000,
+                        help="Number of IPv6 prefixes (0 to skip IPv6)")
+    parser.add_argument("--churn-ops", type=int, default=10000,
+                        help="Number of changes of the flap pattern")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write results to this file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="Compare results with those of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Ops/sec drop reported as a regression by "
+                        "--compare (default: 0.2, that is 20%%)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        json.dump(run_case(json.loads(args.run_case)), sys.stdout)
+        return
+
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "cases": []
+    }
+
+    cases = [(backend, storage)
+             for backend in args.backend for storage in args.storage
+             if backend == "sqlite" or storage == "memory"]
+
+    for backend, storage in cases:
+        for ip_ver, prefix_cnt in [(4, args.prefixes4),
+                                   (6, args.prefixes6)]:
+            if not prefix_cnt:
+                continue
+            for distribution in args.distribution:
+                for churn in args.churn:
+                    case = {
+                        "backend": backend,
+                        "storage": storage,
+                        "ip_ver": ip_ver,
+                        "distribution": distribution,
+                        "churn": churn,
+                        "prefixes": prefix_cnt,
+                        "churn_ops": args.churn_ops,
+                        "seed": args.seed
+                    }
+                    sys.stderr.write("{}... ".format(get_case_key(case)))
+                    sys.stderr.flush()
+                    output = subprocess.check_output(
+                        [sys.executable, os.path.abspath(__file__),
+                         "--run-case", json.dumps(case)]
+                    )
+                    res = json.loads(output.decode("utf-8"))
+                    results["cases"].append(res)
+                    sys.stderr.write("{}s, {} KB\n".format(
+                        res["load_time"], res["peak_memory_kb"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
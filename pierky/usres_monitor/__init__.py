@@ -13,161 +13,283 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import socket
+import struct
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
 import ipaddr
 
-class USRESMonitorException(Exception):
-    pass
+from .errors import USRESMonitorException
+from .sqlite_backend import SQLiteBackend
+from .intervals_backend import SortedIntervalsBackend
+
+try:
+    string_types = (basestring,)
+    integer_types = (int, long)
+except NameError:
+    string_types = (str,)
+    integer_types = (int,)
+
+BACKENDS = {
+    SQLiteBackend.name: SQLiteBackend,
+    SortedIntervalsBackend.name: SortedIntervalsBackend
+}
+
+
+def _sqlite_backend_attr(name):
+    """Read-only property that forwards to the SQLite backend
+
+    Attributes that monitors had before backends were introduced.
+    """
+
+    def get(self):
+        if self.backend.name != SQLiteBackend.name:
+            raise AttributeError(
+                "{} is only available with the {} backend".format(
+                    name, SQLiteBackend.name)
+            )
+        return getattr(self.backend, name)
+    return property(get)
+
+
+class BulkResult(object):
+    """Outcome of add_nets() and del_nets()
+
+    Attributes:
+        processed: number of prefixes that have been added or removed.
+
+        duplicates: prefixes that add_nets() found already in the db, and
+            prefixes given more than once within the same call of
+            add_nets() or del_nets(), apart from the first time.
+
+        missing: prefixes that del_nets() didn't find in the db; a prefix
+            given more than once is reported here at most once, its
+            repeats being reported in duplicates.
+
+        invalid: (prefix, error) tuples for prefixes that couldn't be
+            processed, for example because they are longer than the target
+            prefix length.
+    """
+
+    def __init__(self):
+        self.processed = 0
+        self.duplicates = []
+        self.missing = []
+        self.invalid = []
+
+    def __repr__(self):
+        return ("<BulkResult processed={}, duplicates={}, missing={}, "
+                "invalid={}>".format(self.processed, len(self.duplicates),
+                                     len(self.missing), len(self.invalid)))
+
+
+class SREChanges(object):
+    """Outcome of get_changes()
+
+    Attributes:
+        added: SREs that appeared since the previous call, as dicts in the
+            same format of get_prefixes(), sorted by ID.
+
+        removed: SREs that disappeared since the previous call, same
+            format.
+
+        cnt: the current total number of SREs, as returned by get_count().
+
+        cnt_delta: change of the total number of SREs since the previous
+            call.
+    """
+
+    def __init__(self, added, removed, cnt, cnt_delta):
+        self.added = added
+        self.removed = removed
+        self.cnt = cnt
+        self.cnt_delta = cnt_delta
+
+    def __repr__(self):
+        return ("<SREChanges added={}, removed={}, cnt={}, "
+                "cnt_delta={}>".format(len(self.added), len(self.removed),
+                                       self.cnt, self.cnt_delta))
 
 
 class UniqueSmallestRoutableEntriesMonitor(object):
 
-    def load_sqlite(self, force_sqlite_lib=None):
-        """Load sqlite3/apsw library
+    # Methods timed by enable_profiling(); those in PROFILED_GENERATORS
+    # are timed until their results have been consumed.
+    PROFILED_METHODS = ["add_net", "del_net", "add_net_int", "del_net_int",
+                        "add_nets", "del_nets", "add_nets_int",
+                        "del_nets_int", "flush_source", "get_count",
+                        "get_counts", "get_prefixes", "get_prefixes_page",
+                        "is_covered", "covering_prefix", "count_in"]
+    PROFILED_GENERATORS = ["get_prefixes"]
+
+    # Methods that hold the lock of thread-safe monitors; get_prefixes()
+    # only holds it while taking a copy of the SREs.
+    LOCKED_METHODS = ["add_net_int", "del_net_int", "add_nets", "del_nets",
+                      "add_nets_int", "del_nets_int", "flush_source",
+                      "get_generation", "get_prefixes_cnt", "get_count",
+                      "get_counts", "get_changes", "get_prefixes_page",
+                      "is_covered", "covering_prefix", "count_in", "stats",
+                      "save_snapshot", "load_snapshot",
+                      "_populate_smallest_routable_entries"]
+
+    def __init__(self, target_prefix_len4=24, target_prefix_len6=40,
+                 force_sqlite_lib=None, backend="sqlite", thread_safe=False,
+                 db_path=None, db_pragmas=None):
+        """Init a USREs monitor for prefixes of given length
 
-        If no hints are given, it tries the apsw library then sqlite3.
+        Args:
+            target_prefix_len4, target_prefix_len6: the target prefix
+                length, or a list of target prefix lengths; in the latter
+                case, prefixes are stored only once and SREs are computed
+                for each of the given lengths, from the same data (see
+                get_counts()). Prefixes longer than the largest target
+                prefix length are not accepted; those that are longer than
+                a smaller target prefix length are ignored for it.
+
+            force_sqlite_lib: "sqlite3" or "apsw", to force the library
+                used by the "sqlite" backend.
+
+            backend: the engine used to keep prefixes and SREs:
+                "sqlite" (the default) for an in-memory SQLite database,
+                "intervals" for the pure-Python engine based on sorted
+                arrays of integers.
+
+            thread_safe: when True, the monitor can be used by many
+                threads at once: updates and queries are serialized by a
+                lock, and get_prefixes() iterates over a copy of the SREs,
+                taken once for each generation of the data and shared by
+                all the readers, so that long exports don't block updates.
+
+            db_path: with the "sqlite" backend, the file where the
+                database is created, instead of keeping it in memory; the
+                file must not exist. Pages are read through a memory map
+                and only a bounded cache is kept in memory, so the tables
+                can be larger than the available RAM.
+
+            db_pragmas: dict, to override the SQLite PRAGMAs used with
+                db_path: page_size, locking_mode, journal_mode,
+                synchronous, cache_size and mmap_size (see
+                sqlite_backend.DISK_PRAGMAS).
         """
 
-        if force_sqlite_lib and force_sqlite_lib not in("sqlite3", "apsw"):
+        if isinstance(target_prefix_len4, int):
+            target_prefix_len4 = [target_prefix_len4]
+        if isinstance(target_prefix_len6, int):
+            target_prefix_len6 = [target_prefix_len6]
+
+        assert target_prefix_len4, "Invalid IPv4 target prefix length"
+        assert target_prefix_len6, "Invalid IPv6 target prefix length"
+        for target_prefix_len in target_prefix_len4:
+            assert target_prefix_len > 0, "Invalid IPv4 target prefix length"
+            assert target_prefix_len <= 32, \
+                "Max IPv4 target prefix length is 32"
+        for target_prefix_len in target_prefix_len6:
+            assert target_prefix_len > 0, "Invalid IPv6 target prefix length"
+            assert target_prefix_len <= 128, \
+                "Max IPv6 target prefix length is 128"
+
+        # All the target prefix lengths, sorted; prefixes are stored on
+        # the basis of the largest one.
+        self.target_prefix_lens = {
+            4: sorted(set(target_prefix_len4)),
+            6: sorted(set(target_prefix_len6))
+        }
+        self.target_prefix_len4 = self.target_prefix_lens[4][-1]
+        self.target_prefix_len6 = self.target_prefix_lens[6][-1]
+
+        if backend not in BACKENDS:
             raise USRESMonitorException(
-                "Unknown SQLite library: {}. Must be sqlite3 or apsw".format(
-                    force_sqlite_lib
+                "Unknown backend: {}. Must be one of {}".format(
+                    backend, ", ".join(sorted(BACKENDS))
                 )
             )
 
-        def load_sqlite3():
-            import sqlite3 as sqlite_lib
-            self.sqlite_lib = sqlite_lib
-            self.sqlite_lib_name = "sqlite3"
-            self.sqlite_version = sqlite_lib.sqlite_version
-
-        def load_apsw():
-            import apsw as sqlite_lib
-            self.sqlite_lib = sqlite_lib
-            self.sqlite_lib_name = "apsw"
-            self.sqlite_version = sqlite_lib.sqlitelibversion()
-
-        if force_sqlite_lib == "sqlite3":
-            load_sqlite3()
-        elif force_sqlite_lib == "apsw":
-            load_apsw()
-        else:
-            try:
-                load_apsw()
-            except:
-                load_sqlite3()
-
-    def __init__(self, target_prefix_len4=24, target_prefix_len6=40,
-                 force_sqlite_lib=None):
-        """Init a USREs monitor for prefixes of given length"""
+        # Timings collected by enable_profiling(), by operation.
+        self._timings = {}
 
-        assert target_prefix_len4 > 0, "Invalid IPv4 target prefix length"
-        assert target_prefix_len6 > 0, "Invalid IPv6 target prefix length"
-        assert target_prefix_len4 <= 32, "Max IPv4 target prefix length is 32"
-        assert target_prefix_len6 <= 64, "Max IPv6 target prefix length is 64"
+        # Total number of SREs at the last get_changes() call.
+        self._changes_cnt = {4: 0, 6: 0}
 
-        self.target_prefix_len4 = target_prefix_len4
-        self.target_prefix_len6 = target_prefix_len6
+        if backend == SQLiteBackend.name:
+            self.backend = SQLiteBackend(force_sqlite_lib=force_sqlite_lib,
+                                         thread_safe=thread_safe,
+                                         db_path=db_path,
+                                         db_pragmas=db_pragmas)
+        else:
+            for arg_name, arg in [("force_sqlite_lib", force_sqlite_lib),
+                                  ("db_path", db_path),
+                                  ("db_pragmas", db_pragmas)]:
+                if arg:
+                    raise USRESMonitorException(
+                        "{} can't be used with the {} "
+                        "backend".format(arg_name, backend)
+                    )
+            self.backend = BACKENDS[backend]()
+
+        self._lock = None
+        if thread_safe:
+            self._lock = threading.RLock()
+            self._lock_methods()
+
+    sqlite_lib = _sqlite_backend_attr("sqlite_lib")
+    sqlite_lib_name = _sqlite_backend_attr("sqlite_lib_name")
+    sqlite_version = _sqlite_backend_attr("sqlite_version")
+    cur = _sqlite_backend_attr("cur")
+    setup_db = _sqlite_backend_attr("setup_db")
 
-        self.load_sqlite(force_sqlite_lib=force_sqlite_lib)
+    def sql_out(self, sql, args=()):
+        if self.backend.name != SQLiteBackend.name:
+            raise USRESMonitorException(
+                "sql_out() is not supported by the {} backend".format(
+                    self.backend.name)
+            )
+        return self.backend.sql_out(sql, args)
 
-        self.setup_db()
+    def dump_all(self, additional_info=None):
+        return self.backend.dump_all(additional_info)
+
+    def _get_snapshot_info(self):
+        return {
+            "format": 3,
+            "backend": self.backend.name,
+            "target_prefix_len4": self.target_prefix_len4,
+            "target_prefix_len6": self.target_prefix_len6,
+            "target_prefix_lens4": self.target_prefix_lens[4],
+            "target_prefix_lens6": self.target_prefix_lens[6]
+        }
 
-    def sql_out(self, sql, args=()):
-        return self.cur.execute(sql, args)
+    def save_snapshot(self, path):
+        """Save prefixes and SREs to a file
 
-    def setup_db(self):
-        try:
-            # sqlite3
-            con = self.sqlite_lib.connect(":memory:")
-        except:
-            # apsw
-            con = self.sqlite_lib.Connection(":memory:")
+        With the "sqlite" backend, the in-memory database is copied to the
+        file using the SQLite online backup API; the "intervals" backend
+        uses a compact binary format.
 
-        self.cur = con.cursor()
+        The file is written to a temporary path first, then renamed.
+        """
 
-        for ip_ver in [4, 6]:
-            sql = ("CREATE TABLE"
-                "    prefixes{ip_ver} ("
-                "        id INTEGER PRIMARY KEY AUTOINCREMENT,"
-                "        first INTEGER,"
-                "        pref_len INTEGER,"
-                "        last INTEGER,"
-                "        cnt INTEGER"
-                "    )".format(ip_ver=ip_ver))
-            self.sql_out(sql)
-
-            sql = ("CREATE UNIQUE INDEX"
-                "    prefixes{ip_ver}_pk ON"
-                "    prefixes{ip_ver} ("
-                "        first,"
-                "        pref_len"
-                "    )".format(ip_ver=ip_ver))
-            self.sql_out(sql)
-
-            sql = ("CREATE TABLE"
-                "    smallest_routable_entries{ip_ver} ("
-                "        id INTEGER,"
-                "        first INTEGER,"
-                "        pref_len INTEGER,"
-                "        last INTEGER,"
-                "        cnt INTEGER"
-                "    )".format(ip_ver=ip_ver))
-            self.sql_out(sql)
-
-            sql = ("CREATE UNIQUE INDEX"
-                "    smallest_routable_entries{ip_ver}_ok ON"
-                "    smallest_routable_entries{ip_ver} ("
-                "        first,"
-                "        last"
-                "    )".format(ip_ver=ip_ver))
-            self.sql_out(sql)
-
-            sql = ("CREATE VIEW"
-                "    smallest_routable_entries{ip_ver}_view AS"
-                "    SELECT"
-                "        *"
-                "    FROM"
-                "        smallest_routable_entries{ip_ver}"
-                "".format(ip_ver=ip_ver))
-            self.sql_out(sql)
-
-            sql = ("CREATE TRIGGER"
-                "    smallest_routable_entries{ip_ver}_view_insert "
-                "INSTEAD OF INSERT ON"
-                "    smallest_routable_entries{ip_ver}_view "
-                "BEGIN"
-                "    INSERT INTO smallest_routable_entries{ip_ver}"
-                "    SELECT NEW.id, NEW.first, NEW.pref_len, NEW.last, NEW.cnt"
-                "    WHERE"
-                "        NOT EXISTS ("
-                "            SELECT id FROM smallest_routable_entries{ip_ver}"
-                "            WHERE NEW.first BETWEEN first AND last"
-                "        );"
-                "END".format(ip_ver=ip_ver))
-            self.sql_out(sql)
+        self.backend.save_snapshot(path, self._get_snapshot_info())
 
-    def dump_all(self, additional_info=None):
-        import time
-        from random import randint
-        target_file = "dump-{time}_{random}.db".format(
-            time=time.strftime("%Y-%m-%d_%H%M%S"),
-            random="_{:04d}".format(randint(0, 9999))
-        )
+    def load_snapshot(self, path):
+        """Replace prefixes and SREs with those saved by save_snapshot()
 
-        self.sql_out("ATTACH '{}' AS target".format(target_file))
+        The snapshot must have been saved by a monitor that uses the same
+        backend and target prefix lengths of this one.
+        """
 
-        tables = ["smallest_routable_entries4", "smallest_routable_entries6",
-                  "prefixes4", "prefixes6"]
-        for tbl_name in tables:
-            self.sql_out("CREATE TABLE target.{tbl_name} AS "
-                    "SELECT * FROM main.{tbl_name}".format(
-                        tbl_name=tbl_name)
-            )
+        info = self.backend.read_snapshot_info(path)
+        exp_info = self._get_snapshot_info()
+        for key in sorted(exp_info):
+            if info.get(key) != exp_info[key]:
+                raise USRESMonitorException(
+                    "Can't load snapshot {}: {} is {}, expected {}".format(
+                        path, key, info.get(key), exp_info[key]
+                    )
+                )
 
-        if additional_info:
-            with open("{}.info".format(target_file), "w") as f:
-                f.write(additional_info)
-        return target_file
+        self.backend.load_snapshot(path)
 
     @staticmethod
     def get_net(net):
@@ -178,10 +300,86 @@ class UniqueSmallestRoutableEntriesMonitor(object):
     @staticmethod
     def get_first(net):
         assert isinstance(net, (ipaddr.IPv4Network, ipaddr.IPv6Network))
-        if net.version == 6:
-            return int(net.network) >> 64
-        else:
-            return int(net.network)
+        return int(net.network)
+
+    @staticmethod
+    def parse_net_str(net_str):
+        """Parse a prefix string straight into integers
+
+        Dotted-quad IPv4 and IPv6 CIDR strings (or plain addresses) are
+        parsed using inet_pton(), without building ipaddr objects. Host
+        bits are cleared, as ipaddr does.
+
+        Returns: (ip_ver, first, pref_len), where first is the same value
+            returned by get_first(), or None if the string is not in one of
+            these formats.
+        """
+
+        addr, sep, pref_len = net_str.partition("/")
+        if sep and not pref_len.isdigit():
+            # Signs, spaces and empty lengths are rejected by ipaddr too.
+            return None
+        try:
+            if ":" in addr:
+                hi, lo = struct.unpack(
+                    "!QQ", socket.inet_pton(socket.AF_INET6, addr))
+                ip_ver, tot_len, first = 6, 128, hi << 64 | lo
+            else:
+                first = struct.unpack(
+                    "!I", socket.inet_pton(socket.AF_INET, addr))[0]
+                ip_ver, tot_len = 4, 32
+            pref_len = int(pref_len) if pref_len else tot_len
+        except (socket.error, ValueError):
+            return None
+
+        if not 0 <= pref_len <= tot_len:
+            return None
+
+        first &= ~((1 << tot_len - pref_len) - 1)
+        return ip_ver, first, pref_len
+
+    @classmethod
+    def parse_net(cls, net_or_str):
+        """Get the integer representation of a prefix
+
+        Args:
+            net_or_str: ipaddr.IPv[4|6]Network object or string
+
+        Returns: (ip_ver, first, pref_len)
+        """
+
+        if isinstance(net_or_str, string_types):
+            res = cls.parse_net_str(net_or_str)
+            if res:
+                return res
+
+        # Not a string, or in a format that only ipaddr understands.
+        net = cls.get_net(net_or_str)
+        return net.version, cls.get_first(net), net.prefixlen
+
+    @classmethod
+    def parse_addr(cls, addr_or_str):
+        """Get the integer representation of an IP address
+
+        Args:
+            addr_or_str: ipaddr.IPv[4|6]Address object or string
+
+        Returns: (ip_ver, addr), where addr is the integer representation
+            of the address.
+        """
+
+        if isinstance(addr_or_str, string_types) and "/" not in addr_or_str:
+            res = cls.parse_net_str(addr_or_str)
+            if res:
+                return res[0], res[1]
+
+        try:
+            addr = ipaddr.IPAddress(addr_or_str)
+        except ValueError:
+            raise USRESMonitorException(
+                "Invalid IP address: {}".format(addr_or_str)
+            )
+        return addr.version, int(addr)
 
     @staticmethod
     def get_sre(net, target_prefix_len):
@@ -191,20 +389,33 @@ class UniqueSmallestRoutableEntriesMonitor(object):
         """
 
         assert isinstance(net, (ipaddr.IPv4Network, ipaddr.IPv6Network))
-        assert target_prefix_len <= 64, "Max target prefix length is 64"
-        assert net.prefixlen <= target_prefix_len, \
-            ("Prefix length ({}) must be <= of the target prefix "
-             "length ({}): {}".format(net.prefixlen, target_prefix_len, net))
 
-        first = UniqueSmallestRoutableEntriesMonitor.get_first(net)
+        return UniqueSmallestRoutableEntriesMonitor.get_sre_int(
+            net.version,
+            UniqueSmallestRoutableEntriesMonitor.get_first(net),
+            net.prefixlen,
+            target_prefix_len
+        )
+
+    @staticmethod
+    def get_sre_int(ip_ver, first, pref_len, target_prefix_len):
+        """Same as get_sre(), for a prefix given as integers
+
+        Returns: first, last, cnt (all integers)
+        """
 
-        tot_len = 64 if net.version == 6 else 32
+        tot_len = 128 if ip_ver == 6 else 32
 
-        # first <= 2^63 -1 to avoid overflows
-        assert first <= 9223372036854775807, \
-            "Only prefixes <= 7fff:ffff:ffff:ffff::/64 can be processed"
+        assert target_prefix_len <= tot_len, \
+            "Max target prefix length is {}".format(tot_len)
+        assert pref_len <= target_prefix_len, \
+            ("Prefix length ({}) must be <= of the target prefix "
+             "length ({}): {}/{}".format(
+                 pref_len, target_prefix_len,
+                 UniqueSmallestRoutableEntriesMonitor.get_ip_repr(
+                     ip_ver, first), pref_len))
 
-        diff_len = target_prefix_len - net.prefixlen
+        diff_len = target_prefix_len - pref_len
 
         last = first | ((2**diff_len - 1) << tot_len - target_prefix_len)
 
@@ -212,143 +423,386 @@ class UniqueSmallestRoutableEntriesMonitor(object):
 
     @staticmethod
     def get_ip_repr(ip_ver, net_int):
-        return ipaddr.IPAddress(net_int if ip_ver == 4 else net_int << 64)
+        return ipaddr.IPAddress(net_int, version=ip_ver)
+
+    @staticmethod
+    def get_ip_str(ip_ver, net_int):
+        """Same as str(get_ip_repr()), without building ipaddr objects
+
+        Addresses within ::/96 and ::ffff:0:0/96 are the exception, since
+        inet_ntop() gives them in the mixed IPv4 notation.
+        """
+
+        if ip_ver == 4:
+            return socket.inet_ntoa(struct.pack("!I", net_int))
+        if net_int >> 32 in (0, 0xffff):
+            return str(ipaddr.IPv6Address(net_int))
+        return socket.inet_ntop(socket.AF_INET6,
+                                struct.pack("!QQ", net_int >> 64,
+                                            net_int & 0xffffffffffffffff))
+
+    @staticmethod
+    def check_source(source):
+        """Raise USRESMonitorException if source is not a valid source
+
+        See add_net().
+        """
+
+        if source is not None and \
+                not isinstance(source, string_types + integer_types):
+            raise USRESMonitorException(
+                "Invalid source: {!r}. Must be a string or an "
+                "integer".format(source)
+            )
 
-    def add_net(self, net_or_str):
+    def add_net(self, net_or_str, source=None):
         """Add the ipaddr.IPv[4|6]Network object to db
         
         Args:
             net: ipaddr.IPv[4|6]Network object or string
+
+            source: a string or an integer that identifies where the
+                prefix comes from, for example the address of the BGP
+                neighbor that announced it. The same prefix can be added
+                by many sources (and once without a source): it's
+                removed from the db only when all of them removed it,
+                using del_net() or flush_source().
         """
 
-        net = self.get_net(net_or_str)
+        self.add_net_int(*self.parse_net(net_or_str), source=source)
 
-        target_prefix_len = self.target_prefix_len4 if net.version == 4 \
-                            else self.target_prefix_len6
-        first, last, cnt = self.get_sre(net, target_prefix_len)
+    def add_net_int(self, ip_ver, first_int, prefix_len, source=None):
+        """Add a prefix given as integers to db
 
-        try:
-            self.sql_out("INSERT INTO "
-                         "   prefixes{} ("
-                         "       first, pref_len, last, cnt"
-                         "   ) "
-                         "VALUES "
-                         "   (?, ?, ?, ?)".format(net.version),
-                         (first, net.prefixlen, last, cnt)
-            )
-        except Exception as e:
-            if "UNIQUE constraint failed" in str(e) or \
-                "columns first, pref_len are not unique" in str(e):
+        For callers that already have the prefix in integer form, for
+        example from a BGP decoder.
 
-                raise USRESMonitorException(
-                    "Processing {} but it was already in the db".format(net)
-                )
-            self.dump_all(
-                "add_net {}\n"
-                "target_prefix_len: {}\n"
-                "first: {}\n"
-                "last: {}\n"
-                "cnt: {}\n"
-                "{}".format(
-                    net, target_prefix_len, first, last, cnt, str(e)
+        Args:
+            ip_ver: 4 or 6.
+
+            first_int: the integer representation of the network ID of the
+                prefix (the same of the "first_int" value returned by
+                get_prefixes()). Host bits must be zero.
+
+            prefix_len: the length of the prefix.
+
+            source: see add_net().
+        """
+
+        self.check_source(source)
+
+        target_prefix_len = self.target_prefix_len4 if ip_ver == 4 \
+                            else self.target_prefix_len6
+        first, last, cnt = self.get_sre_int(ip_ver, first_int, prefix_len,
+                                            target_prefix_len)
+
+        if not self.backend.add_prefix(ip_ver, first, prefix_len, last, cnt,
+                                       source):
+            raise USRESMonitorException(
+                "Processing {}/{} but it was already in the db{}".format(
+                    self.get_ip_repr(ip_ver, first), prefix_len,
+                    "" if source is None else
+                    " for source {}".format(source)
                 )
             )
-            raise
 
-    def del_net(self, net_or_str):
+    def del_net(self, net_or_str, source=None):
         """Remove the ipaddr.IPv[4|6]Network object from db
 
         Args:
             net: ipaddr.IPv[4|6]Network object or string
+
+            source: the source that added the prefix (see add_net()).
+                The prefix is removed only if no other sources added it.
+
+        Returns: False if the prefix was not in the db for the source,
+            otherwise True.
         """
 
-        net = self.get_net(net_or_str)
+        return self.del_net_int(*self.parse_net(net_or_str), source=source)
 
-        first = self.get_first(net)
+    def del_net_int(self, ip_ver, first_int, prefix_len, source=None):
+        """Remove a prefix given as integers from db
 
+        Args: see add_net_int() and del_net().
+
+        Returns: False if the prefix was not in the db for the source,
+            otherwise True.
+        """
+
+        self.check_source(source)
+        return self.backend.del_prefix(ip_ver, first_int, prefix_len, source)
+
+    def flush_source(self, source):
+        """Remove all the prefixes added by a source
+
+        Prefixes that have been added by other sources too (or without a
+        source) are kept. All the prefixes of the source are processed in
+        a single transaction, using set-based queries with the "sqlite"
+        backend. When only a few prefixes are actually removed, the SREs
+        are updated for each of them, otherwise they are rebuilt once,
+        when they are needed by the next query.
+
+        Args:
+            source: the source given to add_net() or add_nets().
+
+        Returns: the number of prefixes of the source.
+        """
+
+        if source is None:
+            raise USRESMonitorException("A source must be given")
+        self.check_source(source)
+
+        self.backend.begin()
         try:
-            self.sql_out("DELETE FROM "
-                         "   prefixes{} "
-                         "WHERE"
-                         "   first = ? AND"
-                         "   pref_len = ?".format(net.version),
-                         (first, net.prefixlen)
-            )
-        except Exception as e:
-            self.dump_all(
-                "del_net {}\n"
-                "first: {}\n"
-                "{}".format(
-                    net, first, str(e)
-                )
-            )
+            res = self.backend.flush_source(4, source) + \
+                self.backend.flush_source(6, source)
+            self.backend.commit()
+        except:
+            self.backend.rollback()
             raise
+        return res
 
-    def _populate_smallest_routable_entries(self, ip_ver):
-        # MIN(first) for each last.
-        sql = ("SELECT "
-               "     a.* "
-               "FROM "
-               "     prefixes{ip_ver} a"
-               "        INNER JOIN ("
-               "            SELECT"
-               "                last,"
-               "                MIN(first) AS first"
-               "            FROM"
-               "                prefixes{ip_ver}"
-               "            GROUP BY last"
-               "        ) b ON"
-               "            a.first = b.first AND"
-               "            a.last = b.last"
-               "".format(ip_ver=ip_ver))
-
-        # MAX(last) for each first of previous sub-query.
-        sql = ("SELECT "
-               "    c.* "
-               "FROM "
-               "    prefixes{ip_ver} c"
-               "        INNER JOIN ("
-               "            SELECT "
-               "                first, MAX(last) AS last "
-               "            FROM "
-               "                ({sql})"
-               "            GROUP BY"
-               "                first"
-               "        ) d ON"
-               "            c.first = d.first AND"
-               "            c.last = d.last "
-               "".format(
-                   ip_ver=ip_ver,
-                   sql=sql
-               ))
-
-        # Uses data from the previous sub-query.
-        # Insert into the view on pref_len order (ASC); the trigger avoids
-        # to add prefixes that are already coveredy by other prefixes
-        # already present in the table.
-        sql = ("DELETE FROM smallest_routable_entries{ip_ver}; "
-               "INSERT INTO smallest_routable_entries{ip_ver}_view "
-               "    SELECT * FROM ({sql}) ORDER BY pref_len; ".format(
-                   ip_ver=ip_ver, sql=sql
-              ))
+    @staticmethod
+    def _parse_net_int(prefix):
+        ip_ver, first, pref_len = prefix
+        if ip_ver not in (4, 6):
+            raise ValueError("Invalid IP version: {}".format(ip_ver))
+        return ip_ver, first, pref_len
+
+    def _iter_batches(self, nets_or_strs, batch_size, parse_net):
+        """Convert prefixes and group them in batches by address family
+
+        Args:
+            parse_net: function that returns the (ip_ver, first, pref_len)
+                of a prefix, like parse_net().
 
+        Prefixes are deduplicated across the whole call, so that each one
+        is yielded once, regardless of the batch boundaries.
+
+        Yields: (ip_ver, {(first, pref_len): [net_or_str, last, cnt,
+            repeats of net_or_str within the same batch...]}) tuples, plus
+            a final (None, (invalid, repeated)) tuple, with the prefixes
+            that couldn't be converted and those given again after the
+            batch of their first occurrence had been yielded.
+        """
+
+        # Ordered, so that prefixes get their IDs in the given order.
+        batches = {4: OrderedDict(), 6: OrderedDict()}
+        # Keys of the batches already yielded.
+        seen = {4: set(), 6: set()}
+        invalid = []
+        repeated = []
+        for net_or_str in nets_or_strs:
+            try:
+                ip_ver, first, pref_len = parse_net(net_or_str)
+                target_prefix_len = self.target_prefix_len4 \
+                    if ip_ver == 4 else self.target_prefix_len6
+                first, last, cnt = self.get_sre_int(
+                    ip_ver, first, pref_len, target_prefix_len)
+            except (AssertionError, ValueError) as e:
+                invalid.append((net_or_str, str(e)))
+                continue
+
+            batch = batches[ip_ver]
+            key = (first, pref_len)
+            if key in batch:
+                # Given more than once: let the caller know which one.
+                batch[key].append(net_or_str)
+                continue
+            if key in seen[ip_ver]:
+                repeated.append(net_or_str)
+                continue
+            batch[key] = [net_or_str, last, cnt]
+
+            if len(batch) >= batch_size:
+                yield ip_ver, batch
+                seen[ip_ver].update(batch)
+                batches[ip_ver] = OrderedDict()
+
+        for ip_ver in [4, 6]:
+            if batches[ip_ver]:
+                yield ip_ver, batches[ip_ver]
+        if invalid or repeated:
+            yield None, (invalid, repeated)
+
+    def _run_bulk(self, nets_or_strs, batch_size, process_batch, source,
+                  parse_net=None):
+        self.check_source(source)
+        res = BulkResult()
+
+        self.backend.begin()
         try:
-            if self.sqlite_lib_name == "apsw":
-                self.sql_out(sql)
-            else:
-                self.cur.executescript(sql)
-        except Exception as e:
-            self.dump_all(
-                "_populate_smallest_routable_entries {}\n"
-                "{}".format(
-                    ip_ver, str(e)
+            for ip_ver, batch in self._iter_batches(
+                    nets_or_strs, batch_size, parse_net or self.parse_net):
+                if ip_ver is None:
+                    invalid, repeated = batch
+                    res.invalid.extend(invalid)
+                    res.duplicates.extend(repeated)
+                    continue
+
+                for value in batch.values():
+                    res.duplicates.extend(value[3:])
+
+                process_batch(ip_ver, batch, res, source)
+
+            self.backend.commit()
+        except:
+            self.backend.rollback()
+            raise
+
+        return res
+
+    def add_nets(self, nets_or_strs, batch_size=10000, source=None):
+        """Add many prefixes to the db within a single transaction
+
+        Prefixes are converted and handed to the backend in batches of
+        batch_size items (with the "sqlite" backend, they are inserted
+        using executemany()); the SREs are then rebuilt once, when they
+        are needed by the next query.
+
+        Duplicate and invalid prefixes don't stop the process: they are
+        reported in the returned object.
+
+        Args:
+            nets_or_strs: iterable of ipaddr.IPv[4|6]Network objects or
+                strings
+
+            source: see add_net().
+
+        Returns: BulkResult
+        """
+
+        return self._run_bulk(nets_or_strs, batch_size, self._add_batch,
+                              source)
+
+    def del_nets(self, nets_or_strs, batch_size=10000, source=None):
+        """Remove many prefixes from the db within a single transaction
+
+        Prefixes that are not in the db don't stop the process: they are
+        reported in the returned object, together with invalid ones.
+        Prefixes given more than once are removed once, and their repeats
+        are reported as duplicates.
+
+        Args:
+            nets_or_strs: iterable of ipaddr.IPv[4|6]Network objects or
+                strings
+
+            source: see del_net().
+
+        Returns: BulkResult
+        """
+
+        return self._run_bulk(nets_or_strs, batch_size, self._del_batch,
+                              source)
+
+    def add_nets_int(self, prefixes, batch_size=10000, source=None):
+        """Add many prefixes given as integers within a single transaction
+
+        Same as add_nets(), for callers that already have the prefixes in
+        integer form, for example from a BGP decoder or an MRT dump.
+
+        Args:
+            prefixes: iterable of (ip_ver, first_int, prefix_len) tuples
+                (see add_net_int()).
+
+            source: see add_net().
+
+        Returns: BulkResult, where prefixes are reported as the given
+            tuples.
+        """
+
+        return self._run_bulk(prefixes, batch_size, self._add_batch, source,
+                              self._parse_net_int)
+
+    def del_nets_int(self, prefixes, batch_size=10000, source=None):
+        """Remove many prefixes given as integers within a single transaction
+
+        Args: see add_nets_int() and del_nets().
+
+        Returns: BulkResult, where prefixes are reported as the given
+            tuples.
+        """
+
+        return self._run_bulk(prefixes, batch_size, self._del_batch, source,
+                              self._parse_net_int)
+
+    def _add_batch(self, ip_ver, batch, res, source):
+        duplicates = self.backend.add_prefixes(
+            ip_ver,
+            [(first, pref_len, value[1], value[2])
+             for (first, pref_len), value in batch.items()],
+            source
+        )
+        for key in duplicates:
+            res.duplicates.append(batch[tuple(key)][0])
+        res.processed += len(batch) - len(duplicates)
+
+    def _del_batch(self, ip_ver, batch, res, source):
+        missing = self.backend.del_prefixes(ip_ver, list(batch.keys()),
+                                            source)
+        for key in missing:
+            res.missing.append(batch[tuple(key)][0])
+        res.processed += len(batch) - len(missing)
+
+    def get_generation(self, ip_ver):
+        """Get the generation of the data for the given address family
+
+        The value changes every time prefixes are added or removed, so it
+        can be used to know whether the results of get_prefixes() and
+        get_count() changed since the last time they were read.
+
+        Return: int
+        """
+
+        return self.backend.get_generation(ip_ver)
+
+    def get_prefixes_cnt(self, ip_ver):
+        """Get the number of prefixes of the given address family
+
+        Prefixes added by many sources are counted once. The SREs are not
+        rebuilt, so it's cheap to call after every change.
+
+        Return: int
+        """
+
+        return self.backend.get_prefixes_cnt(ip_ver)
+
+    def _populate_smallest_routable_entries(self, ip_ver):
+        """Rebuild the SREs from scratch
+
+        The SREs are kept up to date by add_net() and del_net(); this
+        is only needed to recompute them from all the prefixes.
+        """
+
+        self.backend.populate(ip_ver)
+
+    def _get_target_prefix_len(self, ip_ver, target_prefix_len):
+        if target_prefix_len is None:
+            return self.target_prefix_lens[ip_ver][-1]
+        if target_prefix_len not in self.target_prefix_lens[ip_ver]:
+            raise USRESMonitorException(
+                "Target prefix length {} is not monitored for IPv{}; "
+                "target prefix lengths are {}".format(
+                    target_prefix_len, ip_ver,
+                    ", ".join(map(str, self.target_prefix_lens[ip_ver]))
                 )
             )
-            raise
+        return target_prefix_len
 
-    def get_prefixes(self, ip_ver):
+    def get_prefixes(self, ip_ver, target_prefix_len=None, raw=False):
         """Get the list of not overlapping prefixes and their SREs
 
+        Args:
+            target_prefix_len: one of the target prefix lengths the
+                monitor has been created with; by default, the largest.
+                Prefixes longer than it are not reported.
+
+            raw: when True, (id, first_int, pref_len, last_int, cnt)
+                tuples are returned instead of dicts, without formatting
+                the IP addresses; it's the fastest way to export all the
+                SREs.
+
         This is a generator of dict in this format:
 
         {
@@ -356,10 +810,8 @@ class UniqueSmallestRoutableEntriesMonitor(object):
 
             "first_int": the integer representation of the first subnet
                 covered by the prefix, calculated on the basis of the
-                target prefix length given as input.
-                For IPv4 prefixes, this is the real network ID of the
-                prefix; for IPv6 addresses, this is the highest 64-bit value
-                of the network ID.
+                target prefix length given as input, that is the
+                network ID of the prefix.
 
             "first_ip": a string that represents the IP notation of the
                 first network covered by this prefix.
@@ -379,42 +831,404 @@ class UniqueSmallestRoutableEntriesMonitor(object):
         }
         """
 
-        self._populate_smallest_routable_entries(ip_ver)
-
-        sql = ("SELECT "
-               "    id, first, pref_len, last, cnt "
-               "FROM "
-               "    smallest_routable_entries{ip_ver} "
-               "ORDER BY "
-               "    id".format(ip_ver=ip_ver))
-
-        rs = self.sql_out(sql)
-        record = rs.fetchone()
-        while record:
-            res = {
-                "id": record[0],
-                "first_int": record[1],
-                "first_ip": str(self.get_ip_repr(ip_ver, record[1])),
-                "pref_len": record[2],
-                "last_int": record[3],
-                "last_ip": str(self.get_ip_repr(ip_ver, record[3])),
-                "cnt": record[4]
-            }
-            yield res
-            record = rs.fetchone()
+        target_prefix_len = self._get_target_prefix_len(ip_ver,
+                                                        target_prefix_len)
+        if self._lock:
+            with self._lock:
+                records = self.backend.get_sres_snapshot(ip_ver)
+        else:
+            records = self.backend.iter_sres(ip_ver)
+        if target_prefix_len != self.target_prefix_lens[ip_ver][-1]:
+            # SREs for a smaller target prefix length are the same
+            # prefixes, except those that are longer than it; last and
+            # cnt are computed again.
+            records = (
+                (record[0], record[1], record[2]) +
+                self.get_sre_int(ip_ver, record[1], record[2],
+                                 target_prefix_len)[1:]
+                for record in records if record[2] <= target_prefix_len
+            )
+
+        if raw:
+            for record in records:
+                yield record
+            return
+
+        for record in records:
+            yield self._get_prefix_dict(ip_ver, record)
+
+    def get_prefixes_page(self, ip_ver, after=None, limit=1000,
+                          target_prefix_len=None, raw=False):
+        """Get a page of the not overlapping prefixes and their SREs
+
+        Unlike get_prefixes(), prefixes are sorted by their first value,
+        and each page is read with a single query on the index of the
+        SREs (keyset pagination): no cursors are kept open between pages,
+        so large results can be served page by page, with bounded memory,
+        while other calls are made in the meantime. When prefixes are
+        added or removed between two pages, the following pages reflect
+        the new data.
+
+        Args:
+            after: the "first_int" value of the last prefix of the
+                previous page, or None for the first page.
+
+            limit: max number of prefixes returned.
+
+            target_prefix_len, raw: see get_prefixes().
+
+        Returns: list, in the same format of get_prefixes(); it's shorter
+            than limit only for the last page.
+        """
+
+        if limit <= 0:
+            raise USRESMonitorException(
+                "Invalid limit: {}. Must be > 0".format(limit)
+            )
+
+        target_prefix_len = self._get_target_prefix_len(ip_ver,
+                                                        target_prefix_len)
+        records = self.backend.get_sres_page(ip_ver, after, limit,
+                                             target_prefix_len)
+        if target_prefix_len != self.target_prefix_lens[ip_ver][-1]:
+            records = [
+                (record[0], record[1], record[2]) +
+                self.get_sre_int(ip_ver, record[1], record[2],
+                                 target_prefix_len)[1:]
+                for record in records
+            ]
+
+        if raw:
+            return records
+        return [self._get_prefix_dict(ip_ver, record) for record in records]
+
+    def _get_prefix_dict(self, ip_ver, record):
+        return {
+            "id": record[0],
+            "first_int": record[1],
+            "first_ip": self.get_ip_str(ip_ver, record[1]),
+            "pref_len": record[2],
+            "last_int": record[3],
+            "last_ip": self.get_ip_str(ip_ver, record[3]),
+            "cnt": record[4]
+        }
+
+    def get_changes(self, ip_ver):
+        """Get the SREs that appeared or disappeared since the last call
+
+        The first call returns all the SREs, as added, and starts tracking
+        their changes: from then on, only the net changes are kept (an SRE
+        that appears and then disappears between two calls is not
+        reported), so the work done by consumers is proportional to the
+        churn rather than to the size of the table. Nothing is tracked
+        until the first call.
+
+        SREs refer to the largest target prefix length; their changes are
+        tracked once for all the callers.
+
+        Return: SREChanges
+        """
+
+        added, removed = self.backend.pop_sre_changes(ip_ver)
+        cnt = self.backend.get_count(ip_ver)
+        cnt_delta = cnt - self._changes_cnt[ip_ver]
+        self._changes_cnt[ip_ver] = cnt
+
+        return SREChanges(
+            [self._get_prefix_dict(ip_ver, record) for record in added],
+            [self._get_prefix_dict(ip_ver, record) for record in removed],
+            cnt, cnt_delta
+        )
 
-    def get_count(self, ip_ver):
+    def get_count(self, ip_ver, target_prefix_len=None):
         """Get the total number of SREs covered by not overlapping prefixes
 
+        The total is kept up to date by add_net() and del_net(), so this
+        runs in constant time (unless the SREs must be rebuilt after
+        add_nets() or del_nets(), and only once until the data changes).
+
+        Args:
+            target_prefix_len: one of the target prefix lengths the
+                monitor has been created with; by default, the largest.
+
         Return: int
         """
 
-        self._populate_smallest_routable_entries(ip_ver)
+        target_prefix_len = self._get_target_prefix_len(ip_ver,
+                                                        target_prefix_len)
+        if target_prefix_len == self.target_prefix_lens[ip_ver][-1]:
+            return self.backend.get_count(ip_ver)
+
+        # Computed from the number of SREs of each prefix length.
+        return sum([sres_cnt * 2**(target_prefix_len - pref_len)
+                    for pref_len, sres_cnt
+                    in self.backend.get_sre_lens(ip_ver).items()
+                    if pref_len <= target_prefix_len])
+
+    def get_counts(self, ip_ver):
+        """Get the total number of SREs for each target prefix length
+
+        Return: OrderedDict, {target_prefix_len: total}, sorted by target
+            prefix length.
+        """
+
+        sre_lens = self.backend.get_sre_lens(ip_ver)
+        return OrderedDict(
+            (target_prefix_len,
+             sum([sres_cnt * 2**(target_prefix_len - pref_len)
+                  for pref_len, sres_cnt in sre_lens.items()
+                  if pref_len <= target_prefix_len]))
+            for target_prefix_len in self.target_prefix_lens[ip_ver]
+        )
+
+    def _find_covering_sre(self, ip_ver, first, pref_len, target_prefix_len):
+        """Get the SRE that covers the given prefix, or None"""
+
+        target_prefix_len = self._get_target_prefix_len(ip_ver,
+                                                        target_prefix_len)
+        record = self.backend.find_sre(ip_ver, first)
+        if record is None or record[2] > min(pref_len, target_prefix_len):
+            return None
+
+        tot_len = 128 if ip_ver == 6 else 32
+        if (first ^ record[1]) >> (tot_len - record[2]):
+            return None
+
+        if target_prefix_len != self.target_prefix_lens[ip_ver][-1]:
+            record = (record[0], record[1], record[2]) + \
+                self.get_sre_int(ip_ver, record[1], record[2],
+                                 target_prefix_len)[1:]
+        return record
+
+    def is_covered(self, addr_or_str, target_prefix_len=None):
+        """Tell whether an IP address is covered by any prefix
+
+        The SRE that could cover the address is found with a single
+        lookup on the index of the SREs, in logarithmic time.
+
+        Args:
+            addr_or_str: ipaddr.IPv[4|6]Address object or string
+
+            target_prefix_len: see get_count().
+
+        Returns: bool
+        """
+
+        ip_ver, addr = self.parse_addr(addr_or_str)
+        return self._find_covering_sre(
+            ip_ver, addr, 128 if ip_ver == 6 else 32, target_prefix_len
+        ) is not None
+
+    def covering_prefix(self, addr_or_str, target_prefix_len=None):
+        """Get the prefix that covers an IP address
+
+        The prefix is one of those returned by get_prefixes(), that is
+        the shortest one that covers the address. Same lookup of
+        is_covered().
+
+        Args: see is_covered().
+
+        Returns: dict, in the same format of get_prefixes(), or None if
+            the address is not covered.
+        """
+
+        ip_ver, addr = self.parse_addr(addr_or_str)
+        record = self._find_covering_sre(
+            ip_ver, addr, 128 if ip_ver == 6 else 32, target_prefix_len
+        )
+        if record is None:
+            return None
+        return self._get_prefix_dict(ip_ver, record)
+
+    def count_in(self, net_or_str, target_prefix_len=None):
+        """Get the number of SREs within a prefix
+
+        When the prefix is covered by a SRE, the answer comes from a
+        single lookup, in logarithmic time. Otherwise, the SREs within
+        the prefix are counted by prefix length while scanning the index
+        of the SREs, without reading them: the cost is O(log n + k) for
+        k SREs in the prefix, so counting within a short prefix (like a
+        /8 or ::/0) on a full table goes through most of the index.
+
+        Args:
+            net_or_str: ipaddr.IPv[4|6]Network object or string; it can't
+                be longer than the target prefix length.
+
+            target_prefix_len: see get_count().
+
+        Return: int
+        """
+
+        ip_ver, first, pref_len = self.parse_net(net_or_str)
+        target_prefix_len = self._get_target_prefix_len(ip_ver,
+                                                        target_prefix_len)
+        first, last, cnt = self.get_sre_int(ip_ver, first, pref_len,
+                                            target_prefix_len)
+
+        if self._find_covering_sre(ip_ver, first, pref_len,
+                                   target_prefix_len) is not None:
+            return cnt
+
+        return sum([sres_cnt * 2**(target_prefix_len - sre_len)
+                    for sre_len, sres_cnt in self.backend.get_sre_lens_in(
+                        ip_ver, first, last).items()
+                    if sre_len <= target_prefix_len])
+
+    def stats(self):
+        """Get table sizes, counters and timings
+
+        Counters are always collected; timings only while profiling is
+        enabled (see enable_profiling()).
+
+        Return: dict, in this format:
+
+        {
+            4 and 6: {
+                "prefixes": number of prefixes.
+
+                "sres": number of SREs.
+
+                "sre_cnt": total number of SREs covered by them, the same
+                    returned by get_count() (for the largest target prefix
+                    length).
+
+                "generation": see get_generation().
+
+                "sres_up_to_date": False if the SREs are behind the data
+                    and will be rebuilt by the next query; in this case,
+                    "sres" and "sre_cnt" are those of the last update.
+
+                "incremental_updates": number of changes applied to the
+                    SREs by add_net() and del_net().
+
+                "populate_runs": number of times the SREs have been
+                    rebuilt from scratch.
+
+                "populate_rows", "last_populate_rows": prefixes processed
+                    by all the rebuilds and by the last one.
+
+                "last_populate_covered": prefixes found to be covered by
+                    another one (so not SREs) by the last rebuild.
+
+                "cache_hits", "cache_misses": queries answered using the
+                    SREs as they were, or that had to rebuild them first.
+            },
+
+            "timings": {
+                operation: {
+                    "calls": number of calls.
+
+                    "total", "last", "max": seconds spent in all the calls,
+                        in the last one and in the slowest one.
+                }
+            }
+        }
+        """
+
+        res = {}
+        for ip_ver in [4, 6]:
+            res[ip_ver] = self.backend.get_stats(ip_ver)
+        res["timings"] = dict((operation, dict(timing)) for operation, timing
+                              in self._timings.items())
+        return res
+
+    def enable_profiling(self, callback=None, timer=None):
+        """Time the methods of the monitor and the rebuild of the SREs
+
+        The methods listed in PROFILED_METHODS and the rebuild of the SREs
+        ("populate") are wrapped by functions that time them; timings are
+        reported by stats(). Calls that are nested within other ones
+        (for example, add_net_int() called by add_net()) are timed
+        separately too.
+
+        When profiling is not enabled, methods are not wrapped at all, so
+        there's no overhead.
+
+        Args:
+            callback: function called after each timed call, with the name
+                of the operation and the elapsed seconds as arguments.
+
+            timer: function that returns the current time in seconds;
+                by default, timeit.default_timer.
+        """
+
+        self.disable_profiling()
+        self._timings = {}
+        timer = timer or default_timer
+
+        def record(operation, elapsed):
+            timing = self._timings.get(operation)
+            if timing is None:
+                timing = {"calls": 0, "total": 0, "last": 0, "max": 0}
+                self._timings[operation] = timing
+            timing["calls"] += 1
+            timing["total"] += elapsed
+            timing["last"] = elapsed
+            timing["max"] = max(timing["max"], elapsed)
+            if callback:
+                callback(operation, elapsed)
+
+        def wrap(operation, func):
+            def wrapper(*args, **kwargs):
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    record(operation, timer() - start)
+            return wrapper
+
+        def wrap_generator(operation, func):
+            # Only the time spent producing the items is counted, not the
+            # one spent by the caller consuming them.
+            def wrapper(*args, **kwargs):
+                elapsed = 0
+                try:
+                    start = timer()
+                    for item in func(*args, **kwargs):
+                        elapsed += timer() - start
+                        yield item
+                        start = timer()
+                    elapsed += timer() - start
+                finally:
+                    record(operation, elapsed)
+            return wrapper
+
+        for operation in self.PROFILED_METHODS:
+            if operation in self.PROFILED_GENERATORS:
+                wrapper = wrap_generator(operation, getattr(self, operation))
+            else:
+                wrapper = wrap(operation, getattr(self, operation))
+            setattr(self, operation, wrapper)
+        self.backend.populate = wrap("populate", self.backend.populate)
+
+    def disable_profiling(self):
+        """Stop timing; timings collected so far are kept"""
+
+        for operation in self.PROFILED_METHODS:
+            self.__dict__.pop(operation, None)
+        self.backend.__dict__.pop("populate", None)
+
+        if self._lock:
+            # Locks set by _lock_methods() have just been removed too.
+            self._lock_methods()
+
+    def _lock_methods(self):
+        """Wrap LOCKED_METHODS with functions that hold the lock
+
+        When the monitor is not thread-safe, methods are not wrapped at
+        all, so there's no overhead. Wrappers set by a previous call are
+        replaced, so that methods are never wrapped more than once.
+        """
+
+        lock = self._lock
+
+        def wrap(func):
+            def wrapper(*args, **kwargs):
+                with lock:
+                    return func(*args, **kwargs)
+            wrapper.__wrapped__ = func
+            return wrapper
 
-        sql = ("SELECT "
-               "    SUM(cnt) "
-               "FROM "
-               "    smallest_routable_entries{ip_ver} "
-               "ORDER BY "
-               "    id".format(ip_ver=ip_ver))
-        return self.sql_out(sql).fetchall()[0][0]
+        for name in self.LOCKED_METHODS:
+            self.__dict__.pop(name, None)
+            setattr(self, name, wrap(getattr(self, name)))
@@ -0,0 +1,606 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from .errors import USRESMonitorException
+
+
+def iter_uncovered(records):
+    """Yield the records that are not covered by a previous one
+
+    Since prefixes can only be nested or disjoint, when records are sorted
+    by (first, pref_len) a record is covered by another one if and only if
+    its first address is not beyond the last address of the latest
+    uncovered record.
+
+    Args:
+        records: iterable of (id, first, pref_len, last, cnt) tuples,
+            sorted by first and pref_len.
+    """
+
+    covered_until = None
+    for record in records:
+        if covered_until is None or record[1] > covered_until:
+            covered_until = record[3]
+            yield record
+
+
+class Backend(object):
+    """Storage engine used by the monitor to keep prefixes and SREs
+
+    Prefixes are given as (first, pref_len, last, cnt) values, as computed
+    by UniqueSmallestRoutableEntriesMonitor.get_sre(); the (first, pref_len)
+    pair identifies them. Each prefix gets an ID, in insertion order.
+
+    Prefixes can be added by many sources (for example, BGP neighbors),
+    each one identified by a string or an integer, and also without a
+    source (source None): a prefix is referenced once by each source that
+    added it, and it's removed only when no references are left.
+
+    The SREs are the prefixes that are not covered by any other prefix;
+    they are kept as (id, first, pref_len, last, cnt) records.
+
+    This class keeps track of the generation of the data of each address
+    family, of the running total of SREs and of the number of SREs of each
+    prefix length, and it drives the incremental update of the SREs;
+    subclasses implement the storage.
+    """
+
+    name = None
+
+    def __init__(self):
+        # Running total of SREs for each address family, kept up to date
+        # by add_prefix() and del_prefix().
+        self._sre_cnt = {4: 0, 6: 0}
+
+        # Number of SREs of each prefix length, for each address family,
+        # as {pref_len: number of SREs}; it allows to compute the total for
+        # target prefix lengths other than the one used for the cnt values.
+        self._sre_lens = {4: {}, 6: {}}
+
+        # Generation of the data for each address family, bumped every time
+        # a prefix is added or removed, and generation the SREs and the
+        # running total refer to. add_prefix() and del_prefix() keep them
+        # aligned; add_prefixes() and del_prefixes() leave the SREs behind,
+        # to be rebuilt only once by the next query.
+        self._generation = {4: 0, 6: 0}
+        self._sre_generation = {4: 0, 6: 0}
+
+        # Changes of the SREs of each address family not yet read by
+        # pop_sre_changes(), as {record: +1 (added) or -1 (removed)}; None
+        # until pop_sre_changes() is called for the first time, so that
+        # nothing is tracked unless needed.
+        self._journal = {4: None, 6: None}
+
+        # Copy of the SREs of each address family returned by
+        # get_sres_snapshot(), as (generation, tuple of records).
+        self._sres_snapshot = {4: (None, ()), 6: (None, ())}
+
+        # Number of prefixes of each address family returned by
+        # get_prefixes_cnt(), as (generation, number of prefixes).
+        self._prefixes_cnt = {4: (None, 0), 6: (None, 0)}
+
+        # Counters reported by get_stats().
+        self._stats = {}
+        for ip_ver in [4, 6]:
+            self._stats[ip_ver] = {
+                "incremental_updates": 0,
+                "populate_runs": 0,
+                "populate_rows": 0,
+                "last_populate_rows": 0,
+                "last_populate_covered": 0,
+                "cache_hits": 0,
+                "cache_misses": 0
+            }
+
+    # Above this share of the prefixes, the SREs are rebuilt from scratch
+    # by the next query instead of being updated for each prefix removed
+    # by flush_source().
+    FLUSH_REBUILD_SHARE = 0.1
+
+    def add_prefix(self, ip_ver, first, pref_len, last, cnt, source=None):
+        """Add a prefix, or a reference to it from source
+
+        Returns: False if the prefix was already present for the source,
+            otherwise True.
+        """
+
+        added, prefix_id = self._insert_prefix(ip_ver, first, pref_len,
+                                               last, cnt, source)
+        if not added:
+            return False
+        if prefix_id is None:
+            # Only a new reference to a prefix that was already present.
+            return True
+
+        if self._sre_generation[ip_ver] == self._generation[ip_ver]:
+            self._add_sre(ip_ver, prefix_id, first, pref_len, last, cnt)
+            self._sre_generation[ip_ver] += 1
+            self._stats[ip_ver]["incremental_updates"] += 1
+        self._generation[ip_ver] += 1
+        return True
+
+    def del_prefix(self, ip_ver, first, pref_len, source=None):
+        """Remove the reference to a prefix from source
+
+        The prefix is removed when no references are left.
+
+        Returns: False if the prefix was not present for the source,
+            otherwise True.
+        """
+
+        deleted, last = self._delete_prefix(ip_ver, first, pref_len, source)
+        if not deleted:
+            return False
+        if last is None:
+            # Still referenced by other sources.
+            return True
+
+        if self._sre_generation[ip_ver] == self._generation[ip_ver]:
+            self._del_sre(ip_ver, first, last)
+            self._sre_generation[ip_ver] += 1
+            self._stats[ip_ver]["incremental_updates"] += 1
+        self._generation[ip_ver] += 1
+        return True
+
+    def add_prefixes(self, ip_ver, prefixes, source=None):
+        """Add many prefixes, or references to them from source
+
+        Args:
+            prefixes: list of (first, pref_len, last, cnt) tuples, without
+                duplicates.
+
+        Returns: list of the (first, pref_len) of the prefixes that were
+            already present for the source.
+        """
+
+        duplicates, added_cnt = self._insert_prefixes(ip_ver, prefixes,
+                                                      source)
+        if added_cnt:
+            self._generation[ip_ver] += 1
+        return duplicates
+
+    def del_prefixes(self, ip_ver, keys, source=None):
+        """Remove the references to many prefixes from source
+
+        Args:
+            keys: list of (first, pref_len) tuples, without duplicates.
+
+        Returns: list of the (first, pref_len) of the prefixes that were
+            not present for the source.
+        """
+
+        missing, deleted_cnt = self._delete_prefixes(ip_ver, keys, source)
+        if deleted_cnt:
+            self._generation[ip_ver] += 1
+        return missing
+
+    def flush_source(self, ip_ver, source):
+        """Remove all the references from source
+
+        Prefixes that are left without references are removed; if they
+        are not too many (see FLUSH_REBUILD_SHARE), the SREs are updated
+        for each of them, otherwise they are rebuilt once by the next
+        query.
+
+        Returns: the number of references removed.
+        """
+
+        refs_cnt, deleted = self._flush_source(ip_ver, source)
+        if not deleted:
+            return refs_cnt
+
+        if self._sre_generation[ip_ver] == self._generation[ip_ver] and \
+                len(deleted) <= self.FLUSH_REBUILD_SHARE * \
+                (self._get_prefixes_cnt(ip_ver) + len(deleted)):
+            for first, last in deleted:
+                self._del_sre(ip_ver, first, last)
+            self._sre_generation[ip_ver] += 1
+            self._stats[ip_ver]["incremental_updates"] += len(deleted)
+        self._generation[ip_ver] += 1
+        return refs_cnt
+
+    def begin(self):
+        """Start a group of add_prefixes()/del_prefixes() calls"""
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def get_generation(self, ip_ver):
+        return self._generation[ip_ver]
+
+    def refresh(self, ip_ver):
+        """Rebuild the SREs if they are behind the data"""
+
+        if self._sre_generation[ip_ver] != self._generation[ip_ver]:
+            self._stats[ip_ver]["cache_misses"] += 1
+            self.populate(ip_ver)
+        else:
+            self._stats[ip_ver]["cache_hits"] += 1
+
+    def populate(self, ip_ver):
+        """Rebuild the SREs from scratch"""
+
+        old_sres = self._get_journaled_sres(ip_ver)
+
+        self._sre_cnt[ip_ver] = 0
+        self._sre_lens[ip_ver] = {}
+        for pref_len, sres_cnt, cnt in self._populate(ip_ver):
+            self._update_sre_cnt(ip_ver, pref_len, sres_cnt, cnt)
+        self._sre_generation[ip_ver] = self._generation[ip_ver]
+
+        stats = self._stats[ip_ver]
+        rows = self._get_prefixes_cnt(ip_ver)
+        stats["populate_runs"] += 1
+        stats["populate_rows"] += rows
+        stats["last_populate_rows"] = rows
+        stats["last_populate_covered"] = \
+            rows - sum(self._sre_lens[ip_ver].values())
+
+        self._log_sres_diff(ip_ver, old_sres)
+
+    def _log_sre(self, ip_ver, record, change):
+        """Track a change of the SREs, if pop_sre_changes() is in use
+
+        Backends call it only if self._journal[ip_ver] is not None.
+
+        Args:
+            record: (id, first, pref_len, last, cnt) tuple.
+
+            change: 1 if the SRE has been added, -1 if it's been removed.
+        """
+
+        journal = self._journal[ip_ver]
+        change += journal.get(record, 0)
+        if change:
+            journal[record] = change
+        else:
+            # added then removed, or the other way round
+            del journal[record]
+
+    def _get_journaled_sres(self, ip_ver):
+        """Returns: the current SREs, if changes are tracked, or None"""
+
+        if self._journal[ip_ver] is None:
+            return None
+        return set(tuple(record) for record in self._iter_sres(ip_ver))
+
+    def _log_sres_diff(self, ip_ver, old_sres):
+        """Track the changes of the SREs after they have been replaced
+
+        Args:
+            old_sres: the SREs returned by _get_journaled_sres() before
+                they were replaced.
+        """
+
+        if old_sres is None:
+            return
+        new_sres = self._get_journaled_sres(ip_ver)
+        for record in old_sres - new_sres:
+            self._log_sre(ip_ver, record, -1)
+        for record in new_sres - old_sres:
+            self._log_sre(ip_ver, record, 1)
+
+    def pop_sre_changes(self, ip_ver):
+        """Get the SREs added and removed since the previous call
+
+        The first time it's called, all the SREs are returned as added,
+        then their changes start being tracked.
+
+        Returns: (added, removed), lists of (id, first, pref_len, last,
+            cnt) tuples, sorted by ID.
+        """
+
+        self.refresh(ip_ver)
+
+        if self._journal[ip_ver] is None:
+            self._journal[ip_ver] = {}
+            return [tuple(record) for record in self._iter_sres(ip_ver)], []
+
+        journal = self._journal[ip_ver]
+        self._journal[ip_ver] = {}
+        return (sorted([record for record, change in journal.items()
+                        if change > 0]),
+                sorted([record for record, change in journal.items()
+                        if change < 0]))
+
+    def _update_sre_cnt(self, ip_ver, pref_len, sres_cnt, cnt):
+        """Account for SREs that have been added (or removed, if negative)
+
+        Args:
+            sres_cnt: number of SREs of length pref_len.
+
+            cnt: sum of their cnt values.
+        """
+
+        self._sre_cnt[ip_ver] += cnt
+        sre_lens = self._sre_lens[ip_ver]
+        sres_cnt += sre_lens.get(pref_len, 0)
+        if sres_cnt:
+            sre_lens[pref_len] = sres_cnt
+        else:
+            sre_lens.pop(pref_len, None)
+
+    def get_count(self, ip_ver):
+        self.refresh(ip_ver)
+        return self._sre_cnt[ip_ver]
+
+    def get_sre_lens(self, ip_ver):
+        """Returns: {pref_len: number of SREs of that length}"""
+
+        self.refresh(ip_ver)
+        return dict(self._sre_lens[ip_ver])
+
+    def iter_sres(self, ip_ver):
+        """Iterate over the SREs, in prefixes' ID order
+
+        Yields: (id, first, pref_len, last, cnt) tuples.
+        """
+
+        self.refresh(ip_ver)
+        return self._iter_sres(ip_ver)
+
+    def find_sre(self, ip_ver, key):
+        """Get the SRE with the greatest first value <= key
+
+        Since SREs don't overlap, it's the only one that could cover key.
+
+        Returns: (id, first, pref_len, last, cnt) tuple, or None.
+        """
+
+        self.refresh(ip_ver)
+        return self._find_sre(ip_ver, key)
+
+    def get_sres_in(self, ip_ver, first, last):
+        """Get the SREs whose first value is between first and last
+
+        Returns: list of (id, first, pref_len, last, cnt) tuples, sorted
+            by first.
+        """
+
+        self.refresh(ip_ver)
+        return self._get_sres_in(ip_ver, first, last)
+
+    def get_sre_lens_in(self, ip_ver, first, last):
+        """Count the SREs whose first value is between first and last
+
+        Only the number of SREs of each prefix length is returned, so
+        backends can compute it without reading the SREs themselves.
+
+        Returns: {pref_len: number of SREs of that length}
+        """
+
+        self.refresh(ip_ver)
+        return self._get_sre_lens_in(ip_ver, first, last)
+
+    def get_sres_page(self, ip_ver, after, limit, max_pref_len):
+        """Get the SREs that follow a given first value
+
+        Args:
+            after: the first value of the last SRE of the previous page,
+                or None to start from the beginning.
+
+            limit: max number of SREs returned.
+
+            max_pref_len: SREs longer than it are skipped.
+
+        Returns: list of (id, first, pref_len, last, cnt) tuples, sorted
+            by first.
+        """
+
+        self.refresh(ip_ver)
+        return self._get_sres_page(ip_ver, -1 if after is None else after,
+                                   limit, max_pref_len)
+
+    def get_sres_snapshot(self, ip_ver):
+        """Get a copy of the SREs, in prefixes' ID order
+
+        The copy is made once for each generation of the data and it's
+        shared by all the callers: it's never modified, so it can be
+        iterated while prefixes are added or removed.
+
+        Returns: tuple of (id, first, pref_len, last, cnt) tuples.
+        """
+
+        self.refresh(ip_ver)
+        generation, records = self._sres_snapshot[ip_ver]
+        if generation != self._generation[ip_ver]:
+            records = tuple(self._iter_sres(ip_ver))
+            self._sres_snapshot[ip_ver] = (self._generation[ip_ver], records)
+        return records
+
+    def get_prefixes_cnt(self, ip_ver):
+        """Get the number of prefixes of the given address family
+
+        The value is computed once for each generation of the data.
+
+        Returns: int
+        """
+
+        generation, cnt = self._prefixes_cnt[ip_ver]
+        if generation != self._generation[ip_ver]:
+            cnt = self._get_prefixes_cnt(ip_ver)
+            self._prefixes_cnt[ip_ver] = (self._generation[ip_ver], cnt)
+        return cnt
+
+    def get_stats(self, ip_ver):
+        """Get table sizes and counters of the given address family
+
+        The SREs are not rebuilt: when they are behind the data,
+        "sres_up_to_date" is False and "sres" and "sre_cnt" refer to the
+        last time they were updated.
+
+        Returns: dict
+        """
+
+        stats = dict(self._stats[ip_ver])
+        stats.update({
+            "prefixes": self.get_prefixes_cnt(ip_ver),
+            "sres": sum(self._sre_lens[ip_ver].values()),
+            "sre_cnt": self._sre_cnt[ip_ver],
+            "generation": self._generation[ip_ver],
+            "sres_up_to_date": self._sre_generation[ip_ver] ==
+            self._generation[ip_ver]
+        })
+        return stats
+
+    def dump_all(self, additional_info=None):
+        raise USRESMonitorException(
+            "Dump not supported by the {} backend".format(self.name)
+        )
+
+    def save_snapshot(self, path, info):
+        """Save prefixes and SREs to path
+
+        Args:
+            info: dict, JSON-serializable, stored in the snapshot and
+                returned by read_snapshot_info().
+        """
+
+        for ip_ver in [4, 6]:
+            self.refresh(ip_ver)
+
+        info = dict(info)
+        for ip_ver in [4, 6]:
+            info["sre_cnt{}".format(ip_ver)] = self._sre_cnt[ip_ver]
+            info["sre_lens{}".format(ip_ver)] = \
+                sorted(self._sre_lens[ip_ver].items())
+
+        # Written to a temporary file first, so that a failure doesn't
+        # leave a broken snapshot behind.
+        tmp_path = "{}.tmp".format(path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            self._save_snapshot(tmp_path, info)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, path)
+
+    def read_snapshot_info(self, path):
+        """Returns: the info dict stored in the snapshot"""
+
+        if not os.path.isfile(path):
+            raise USRESMonitorException(
+                "Snapshot not found: {}".format(path)
+            )
+        return self._read_snapshot_info(path)
+
+    def load_snapshot(self, path):
+        """Replace prefixes and SREs with those saved in path"""
+
+        info = self.read_snapshot_info(path)
+        old_sres = dict((ip_ver, self._get_journaled_sres(ip_ver))
+                        for ip_ver in [4, 6])
+        self._load_snapshot(path)
+
+        for ip_ver in [4, 6]:
+            self._sre_cnt[ip_ver] = info["sre_cnt{}".format(ip_ver)]
+            self._sre_lens[ip_ver] = dict(
+                (pref_len, sres_cnt) for pref_len, sres_cnt
+                in info["sre_lens{}".format(ip_ver)]
+            )
+            self._generation[ip_ver] += 1
+            self._sre_generation[ip_ver] = self._generation[ip_ver]
+            self._log_sres_diff(ip_ver, old_sres[ip_ver])
+
+    # Storage, implemented by subclasses.
+
+    def _insert_prefix(self, ip_ver, first, pref_len, last, cnt, source):
+        """Returns: (added, prefix_id)
+
+            added is False if the prefix was already present for the
+            source; prefix_id is the ID of the new prefix, or None if
+            only a reference to an existing prefix has been added.
+        """
+        raise NotImplementedError()
+
+    def _delete_prefix(self, ip_ver, first, pref_len, source):
+        """Returns: (deleted, last)
+
+            deleted is False if the prefix was not present for the
+            source; last is the last value of the prefix, if it has been
+            removed, or None if it's still referenced by other sources.
+        """
+        raise NotImplementedError()
+
+    def _insert_prefixes(self, ip_ver, prefixes, source):
+        """Returns: (duplicates, number of new prefixes)"""
+        raise NotImplementedError()
+
+    def _delete_prefixes(self, ip_ver, keys, source):
+        """Returns: (missing, number of prefixes removed)"""
+        raise NotImplementedError()
+
+    def _flush_source(self, ip_ver, source):
+        """Returns: (number of references removed, list of the (first,
+            last) values of the prefixes that have been removed)
+        """
+        raise NotImplementedError()
+
+    def _add_sre(self, ip_ver, prefix_id, first, pref_len, last, cnt):
+        """Update the SREs and their total after a prefix has been added
+
+        Changes to the SREs must be accounted using _update_sre_cnt(),
+        and tracked using _log_sre() when self._journal[ip_ver] is not
+        None.
+        """
+        raise NotImplementedError()
+
+    def _del_sre(self, ip_ver, first, last):
+        """Update the SREs and their total after a prefix has been removed
+
+        See _add_sre().
+        """
+        raise NotImplementedError()
+
+    def _populate(self, ip_ver):
+        """Returns: (pref_len, number of SREs, sum of their cnt) tuples"""
+        raise NotImplementedError()
+
+    def _iter_sres(self, ip_ver):
+        raise NotImplementedError()
+
+    def _find_sre(self, ip_ver, key):
+        raise NotImplementedError()
+
+    def _get_sres_in(self, ip_ver, first, last):
+        raise NotImplementedError()
+
+    def _get_sre_lens_in(self, ip_ver, first, last):
+        raise NotImplementedError()
+
+    def _get_sres_page(self, ip_ver, after, limit, max_pref_len):
+        raise NotImplementedError()
+
+    def _get_prefixes_cnt(self, ip_ver):
+        """Returns: the number of prefixes"""
+        raise NotImplementedError()
+
+    def _save_snapshot(self, path, info):
+        raise NotImplementedError()
+
+    def _read_snapshot_info(self, path):
+        raise NotImplementedError()
+
+    def _load_snapshot(self, path):
+        raise NotImplementedError()
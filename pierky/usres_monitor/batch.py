@@ -0,0 +1,238 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compute the SREs of a whole set of prefixes at once, using NumPy
+
+For offline work, for example when processing RIB snapshots, the SREs of a
+set of prefixes can be computed in a single pass over arrays of integers,
+without going through a monitor and its backend:
+
+- get_sre_arrays() is the vectorized version of
+  UniqueSmallestRoutableEntriesMonitor.get_sre_int(): it computes the
+  first and last values of many prefixes at once;
+
+- find_sres() sorts the prefixes by (first, pref_len) and keeps those
+  whose first value is beyond the cumulative maximum of the last values
+  of the previous ones, that is the same sweep of iter_uncovered();
+
+- BatchSREs wraps them, and provides get_prefixes() and get_count() that
+  return the same results of a monitor where the same prefixes have been
+  added, in the same order, using add_nets().
+
+Arrays are of 64-bit unsigned integers: IPv6 prefixes are processed using
+the highest 64 bits of their addresses, so their target prefix length can't
+be longer than 64.
+
+NumPy is an optional dependency of this library: it's needed only by this
+module.
+"""
+
+from . import UniqueSmallestRoutableEntriesMonitor
+from .errors import USRESMonitorException
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _check_numpy():
+    if numpy is None:
+        raise USRESMonitorException(
+            "NumPy is needed to compute the SREs in batch mode"
+        )
+
+
+def get_sre_arrays(ip_ver, firsts, pref_lens, target_prefix_len):
+    """Vectorized UniqueSmallestRoutableEntriesMonitor.get_sre_int()
+
+    Args:
+        firsts: array of the first values of the prefixes, as returned by
+            UniqueSmallestRoutableEntriesMonitor.get_first().
+
+        pref_lens: array of the lengths of the prefixes.
+
+    Returns: firsts, lasts (NumPy arrays of uint64; for IPv6, the highest
+        64 bits of the values)
+    """
+
+    _check_numpy()
+
+    assert target_prefix_len <= 64, "Max target prefix length is 64"
+
+    if ip_ver == 6:
+        firsts = (numpy.asarray(firsts, dtype=object) >> 64).astype(
+            numpy.uint64)
+    else:
+        firsts = numpy.asarray(firsts, dtype=numpy.uint64)
+    pref_lens = numpy.asarray(pref_lens, dtype=numpy.uint64)
+    assert firsts.shape == pref_lens.shape, \
+        "firsts and pref_lens must have the same length"
+
+    if len(firsts) == 0:
+        return firsts, firsts.copy()
+
+    assert pref_lens.max() <= target_prefix_len, \
+        "Prefix length ({}) must be <= of the target prefix length " \
+        "({})".format(pref_lens.max(), target_prefix_len)
+
+    tot_len = 64 if ip_ver == 6 else 32
+
+    # (2**diff_len - 1), computed without shifting by 64 bits.
+    diff_lens = numpy.uint64(target_prefix_len) - pref_lens
+    masks = numpy.where(
+        diff_lens == 0,
+        numpy.uint64(0),
+        numpy.uint64(0xffffffffffffffff) >>
+        (numpy.uint64(64) - numpy.maximum(diff_lens, numpy.uint64(1)))
+    )
+    lasts = firsts | (masks << numpy.uint64(tot_len - target_prefix_len))
+
+    return firsts, lasts
+
+
+def find_sres(firsts, pref_lens, lasts):
+    """Find the prefixes that are not covered by any other prefix
+
+    Prefixes given more than once are considered only once, the first
+    time they appear.
+
+    Returns: (sres, ids), two NumPy arrays: the positions of the SREs
+        within the given arrays, sorted, and their IDs, that is the
+        positions of the prefixes within the given arrays once duplicates
+        are removed, starting from 1.
+    """
+
+    _check_numpy()
+
+    firsts = numpy.asarray(firsts, dtype=numpy.uint64)
+    pref_lens = numpy.asarray(pref_lens, dtype=numpy.uint64)
+    lasts = numpy.asarray(lasts, dtype=numpy.uint64)
+
+    if len(firsts) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty.copy()
+
+    # Sorted by first, pref_len and position; duplicates are contiguous
+    # and only the first one is kept.
+    order = numpy.lexsort((numpy.arange(len(firsts)), pref_lens, firsts))
+    sorted_firsts = firsts[order]
+    sorted_pref_lens = pref_lens[order]
+
+    duplicate = numpy.zeros(len(order), dtype=bool)
+    duplicate[1:] = (sorted_firsts[1:] == sorted_firsts[:-1]) & \
+        (sorted_pref_lens[1:] == sorted_pref_lens[:-1])
+
+    # Since prefixes can only be nested or disjoint, the cumulative max
+    # of the last values is the last value of the latest SRE: a prefix
+    # that starts beyond it is not covered. Duplicates never are.
+    covered_until = numpy.maximum.accumulate(lasts[order])
+    uncovered = numpy.ones(len(order), dtype=bool)
+    uncovered[1:] = sorted_firsts[1:] > covered_until[:-1]
+
+    sres = numpy.sort(order[uncovered])
+    unique = numpy.sort(order[~duplicate])
+    ids = numpy.searchsorted(unique, sres) + 1
+
+    return sres, ids
+
+
+class BatchSREs(object):
+    """SREs of a set of prefixes of the same address family"""
+
+    def __init__(self, ip_ver, firsts, pref_lens, target_prefix_len):
+        """Compute the SREs of the given prefixes
+
+        Args:
+            firsts, pref_lens: see get_sre_arrays().
+        """
+
+        self.ip_ver = ip_ver
+        self.target_prefix_len = target_prefix_len
+
+        firsts, lasts = get_sre_arrays(ip_ver, firsts, pref_lens,
+                                       target_prefix_len)
+        pref_lens = numpy.asarray(pref_lens, dtype=numpy.uint64)
+
+        sres, self.ids = find_sres(firsts, pref_lens, lasts)
+        self.firsts = firsts[sres]
+        self.pref_lens = pref_lens[sres]
+        self.lasts = lasts[sres]
+
+    @classmethod
+    def from_nets(cls, nets_or_strs, target_prefix_len4=24,
+                  target_prefix_len6=40):
+        """Compute the SREs of IPv4 and IPv6 prefixes
+
+        Args:
+            nets_or_strs: iterable of ipaddr.IPv[4|6]Network objects or
+                strings
+
+        Returns: {4: BatchSREs, 6: BatchSREs}
+        """
+
+        _check_numpy()
+
+        prefixes = {4: ([], []), 6: ([], [])}
+        for net_or_str in nets_or_strs:
+            ip_ver, first, pref_len = \
+                UniqueSmallestRoutableEntriesMonitor.parse_net(net_or_str)
+            prefixes[ip_ver][0].append(first)
+            prefixes[ip_ver][1].append(pref_len)
+
+        return {
+            4: cls(4, prefixes[4][0], prefixes[4][1], target_prefix_len4),
+            6: cls(6, prefixes[6][0], prefixes[6][1], target_prefix_len6)
+        }
+
+    def get_count(self):
+        """Get the total number of SREs
+
+        Return: int
+        """
+
+        # Computed by prefix length using Python integers, since the
+        # total can exceed 64 bits.
+        sres_cnt = numpy.bincount(self.pref_lens.astype(numpy.int64),
+                                  minlength=self.target_prefix_len + 1)
+        return sum([int(sres_cnt[pref_len]) *
+                    2**(self.target_prefix_len - pref_len)
+                    for pref_len in range(self.target_prefix_len + 1)])
+
+    def get_prefixes(self):
+        """Get the list of not overlapping prefixes and their SREs
+
+        Same as UniqueSmallestRoutableEntriesMonitor.get_prefixes().
+        """
+
+        get_ip_str = UniqueSmallestRoutableEntriesMonitor.get_ip_str
+
+        # See get_sre_arrays().
+        shift = 64 if self.ip_ver == 6 else 0
+
+        for prefix_id, first, pref_len, last in zip(
+                self.ids.tolist(), self.firsts.tolist(),
+                self.pref_lens.tolist(), self.lasts.tolist()):
+            first <<= shift
+            last <<= shift
+            yield {
+                "id": prefix_id,
+                "first_int": first,
+                "first_ip": get_ip_str(self.ip_ver, first),
+                "pref_len": pref_len,
+                "last_int": last,
+                "last_ip": get_ip_str(self.ip_ver, last),
+                "cnt": 2**(self.target_prefix_len - pref_len)
+            }
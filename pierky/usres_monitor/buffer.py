@@ -0,0 +1,316 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Coalesce the updates of flapping prefixes before applying them
+
+Unstable prefixes can be announced and withdrawn many times a second;
+applied one by one, each event changes the prefixes and the SREs of the
+monitor, only to have the change reverted by the next one.
+
+CoalescingBuffer sits in front of add_net() and del_net(): events are
+kept in memory, only the last one for each (prefix, source) pair, and
+they are applied to the monitor when batch_size events have been buffered
+or when batch_interval seconds have passed since the first one, or when
+flush() is called. Events that cancel each other out within the same
+batch (a prefix added and then removed, or removed and then added again)
+don't change the monitor at all.
+
+Each prefix/source pair can only be present or not, and the last event
+decides which one, so the monitor ends up with the same prefixes and SREs
+it would have had if the events had been applied one by one (IDs apart):
+events are never lost, only merged. Prefixes whose events cancelled out
+are applied again too, since the first event could have been a duplicate
+or a missing prefix: being already in the final state, they only cost a
+lookup, without changing the monitor.
+
+The monitor doesn't see the buffered events until they are flushed, so
+flush() must be called before reading counts or SREs. The buffer must be
+used by one thread at a time; a thread-safe monitor can still be queried
+by other threads.
+
+Example:
+
+    buf = CoalescingBuffer(monitor, batch_size=1000, batch_interval=1)
+    for action, prefix, peer in events:
+        if action == "add":
+            buf.add_net(prefix, source=peer)
+        else:
+            buf.del_net(prefix, source=peer)
+    buf.flush()
+    monitor.get_count(4)
+"""
+
+from collections import OrderedDict
+from timeit import default_timer
+
+from . import BulkResult, UniqueSmallestRoutableEntriesMonitor, \
+    USRESMonitorException
+from .backend import Backend
+
+
+class CoalescingBuffer(object):
+    """Buffer the events of a monitor and apply only their net result
+
+    Attributes:
+        events: number of add and del events received.
+
+        coalesced: number of events that were not applied because a later
+            event for the same prefix from the same source was in the
+            same batch.
+
+        netted: number of prefixes whose events cancelled each other out
+            within a batch.
+
+        flushes: number of batches applied.
+
+        processed: number of prefixes actually added to or removed from
+            the monitor.
+
+        duplicates, missing: number of prefixes that were already in the
+            monitor when an add event was applied, or that were not there
+            when a del event was applied.
+    """
+
+    # Prefixes of an address family are applied with add_nets() and
+    # del_nets(), so that the SREs are rebuilt once by the next query,
+    # when they are at least BULK_MIN and more than BULK_SHARE of those
+    # in the monitor; otherwise they are applied one at a time, so that
+    # the SREs are updated incrementally.
+    BULK_MIN = 100
+    BULK_SHARE = Backend.FLUSH_REBUILD_SHARE
+
+    def __init__(self, monitor, batch_size=1000, batch_interval=1.0,
+                 timer=None):
+        """Init the buffer
+
+        Args:
+            monitor: UniqueSmallestRoutableEntriesMonitor object.
+
+            batch_size: max number of events buffered; when it's reached,
+                the batch is applied.
+
+            batch_interval: max number of seconds the events stay
+                buffered; it's checked every time an event is received,
+                and by poll().
+
+            timer: function that returns the current time in seconds;
+                by default, timeit.default_timer.
+        """
+
+        if batch_size <= 0:
+            raise USRESMonitorException(
+                "Invalid batch_size: {}. Must be > 0".format(batch_size)
+            )
+
+        self.monitor = monitor
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.timer = timer or default_timer
+
+        # (ip_ver, first, pref_len, source) -> [first action, last action,
+        # net_or_str of the last event, or None if given as integers],
+        # in the order of the last event received for each key.
+        self._pending = OrderedDict()
+        self._pending_events = 0
+        self._batch_start = None
+
+        self.events = 0
+        self.coalesced = 0
+        self.netted = 0
+        self.flushes = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.missing = 0
+
+    def __len__(self):
+        """Number of prefixes waiting to be applied"""
+
+        return len(self._pending)
+
+    def _push(self, action, ip_ver, first, pref_len, source, net_or_str):
+        self.monitor.check_source(source)
+        target_prefix_len = self.monitor.target_prefix_lens[ip_ver][-1]
+        # Same errors add_net() raises, now rather than at flush time.
+        UniqueSmallestRoutableEntriesMonitor.get_sre_int(
+            ip_ver, first, pref_len, target_prefix_len)
+
+        now = self.timer()
+        if self._batch_start is None:
+            self._batch_start = now
+
+        key = (ip_ver, first, pref_len, source)
+        value = self._pending.pop(key, None)
+        if value is None:
+            value = [action, action, net_or_str]
+        else:
+            self.coalesced += 1
+            value[1] = action
+            value[2] = net_or_str
+        self._pending[key] = value
+        self._pending_events += 1
+        self.events += 1
+
+        if self._pending_events >= self.batch_size or \
+                now - self._batch_start >= self.batch_interval:
+            self.flush()
+
+    def add_net(self, net_or_str, source=None):
+        """Buffer the addition of a prefix
+
+        Args: see UniqueSmallestRoutableEntriesMonitor.add_net().
+        """
+
+        ip_ver, first, pref_len = self.monitor.parse_net(net_or_str)
+        self._push("add", ip_ver, first, pref_len, source, net_or_str)
+
+    def del_net(self, net_or_str, source=None):
+        """Buffer the removal of a prefix
+
+        Args: see UniqueSmallestRoutableEntriesMonitor.del_net().
+        """
+
+        ip_ver, first, pref_len = self.monitor.parse_net(net_or_str)
+        self._push("del", ip_ver, first, pref_len, source, net_or_str)
+
+    def add_net_int(self, ip_ver, first_int, prefix_len, source=None):
+        """Buffer the addition of a prefix given as integers
+
+        Args: see UniqueSmallestRoutableEntriesMonitor.add_net_int().
+        """
+
+        self._push("add", ip_ver, first_int, prefix_len, source, None)
+
+    def del_net_int(self, ip_ver, first_int, prefix_len, source=None):
+        """Buffer the removal of a prefix given as integers
+
+        Args: see UniqueSmallestRoutableEntriesMonitor.del_net_int().
+        """
+
+        self._push("del", ip_ver, first_int, prefix_len, source, None)
+
+    def flush_source(self, source):
+        """Remove all the prefixes of a source from the monitor
+
+        Buffered events of the source are dropped, since the prefixes
+        they refer to are removed anyway.
+
+        Returns: see UniqueSmallestRoutableEntriesMonitor.flush_source().
+        """
+
+        for key in [key for key in self._pending if key[3] == source]:
+            del self._pending[key]
+            self.coalesced += 1
+        return self.monitor.flush_source(source)
+
+    def poll(self):
+        """Apply the buffered events if batch_interval has passed
+
+        To be called periodically when events may stop arriving, so that
+        the last ones are not kept in the buffer indefinitely.
+
+        Returns: BulkResult, or None if nothing was applied.
+        """
+
+        if self._batch_start is not None and \
+                self.timer() - self._batch_start >= self.batch_interval:
+            return self.flush()
+        return None
+
+    @staticmethod
+    def _get_net_str(key, net_or_str):
+        if net_or_str is not None:
+            return net_or_str
+        ip_ver, first, pref_len, source = key
+        return "{}/{}".format(
+            UniqueSmallestRoutableEntriesMonitor.get_ip_str(ip_ver, first),
+            pref_len
+        )
+
+    def _apply_incremental(self, pending, res):
+        for key, (first_action, action, net_or_str) in pending.items():
+            ip_ver, first, pref_len, source = key
+            netted = first_action != action
+            if action == "add":
+                try:
+                    self.monitor.add_net_int(ip_ver, first, pref_len,
+                                             source=source)
+                    done = True
+                except USRESMonitorException:
+                    done = False
+                    if not netted:
+                        res.duplicates.append(
+                            self._get_net_str(key, net_or_str))
+            else:
+                done = self.monitor.del_net_int(ip_ver, first, pref_len,
+                                                source=source)
+                if not done and not netted:
+                    res.missing.append(self._get_net_str(key, net_or_str))
+            if done:
+                res.processed += 1
+
+    def _apply_bulk(self, pending, res):
+        # Prefixes of different sources are independent of each other, so
+        # they can be grouped by source and action.
+        groups = OrderedDict()
+        for key, (first_action, action, net_or_str) in pending.items():
+            group = (key[3], action, first_action != action)
+            groups.setdefault(group, []).append(
+                self._get_net_str(key, net_or_str))
+
+        for (source, action, netted), nets in groups.items():
+            if action == "add":
+                group_res = self.monitor.add_nets(nets, source=source)
+            else:
+                group_res = self.monitor.del_nets(nets, source=source)
+            res.processed += group_res.processed
+            res.invalid.extend(group_res.invalid)
+            if not netted:
+                res.duplicates.extend(group_res.duplicates)
+                res.missing.extend(group_res.missing)
+
+    def flush(self):
+        """Apply the buffered events to the monitor
+
+        Returns: BulkResult; duplicates and missing prefixes are only
+            reported for those whose events didn't cancel each other out.
+        """
+
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._pending_events = 0
+        self._batch_start = None
+
+        res = BulkResult()
+        if not pending:
+            return res
+
+        self.netted += len([value for value in pending.values()
+                            if value[0] != value[1]])
+        for ip_ver in [4, 6]:
+            family = OrderedDict((key, value)
+                                 for key, value in pending.items()
+                                 if key[0] == ip_ver)
+            if len(family) >= self.BULK_MIN and \
+                    len(family) > self.BULK_SHARE * \
+                    self.monitor.get_prefixes_cnt(ip_ver):
+                self._apply_bulk(family, res)
+            else:
+                self._apply_incremental(family, res)
+
+        self.flushes += 1
+        self.processed += res.processed
+        self.duplicates += len(res.duplicates)
+        self.missing += len(res.missing)
+        return res
@@ -0,0 +1,447 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Feed a monitor with the JSON messages of ExaBGP
+
+ExaBGP (https://github.com/Exa-Networks/exabgp) can pass the BGP updates
+it receives to an external process, as JSON messages written one per line
+on the process' stdin (API "receive" with "encoder json").
+
+ExaBGPIngestor reads these messages from an asyncio stream (stdin or a
+local socket), collects the announced and withdrawn NLRIs and applies them
+to a UniqueSmallestRoutableEntriesMonitor in micro-batches: each batch is
+closed when it contains batch_size events or when batch_interval seconds
+have passed since its first event. Within a batch, events for the same
+prefix from the same neighbor are coalesced, only the last one being
+applied. Like CoalescingBuffer does, the prefixes of an address family
+are applied using add_nets() and del_nets() only when they are many
+(for example after a session reset), otherwise they are applied one at
+a time, so that the SREs are updated incrementally instead of being
+rebuilt by the next query.
+
+Prefixes are tracked per neighbor, using its address as the source (see
+UniqueSmallestRoutableEntriesMonitor.add_net()): a prefix received from
+many neighbors is removed only when all of them withdrew it. When the
+session with a neighbor goes down, all its prefixes are removed at once
+using flush_source().
+
+Messages are parsed by the reader and handed to the writer through a
+bounded queue: when the monitor can't keep up, the reader stops reading,
+so the backpressure reaches ExaBGP through the pipe instead of making the
+memory grow.
+
+This module needs Python 3.7 or later.
+
+Example, ExaBGP configuration:
+
+    process usres {
+        run python3 -m pierky.usres_monitor.exabgp;
+        encoder json;
+    }
+    neighbor 192.0.2.1 {
+        ...
+        api {
+            processes [ usres ];
+            receive { parsed; update; neighbor-changes; }
+        }
+    }
+"""
+
+import asyncio
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from . import UniqueSmallestRoutableEntriesMonitor
+from .buffer import CoalescingBuffer
+from .errors import USRESMonitorException
+
+FAMILIES = ("ipv4 unicast", "ipv6 unicast")
+
+
+def iter_nlris(family_data):
+    """Yield the prefixes announced/withdrawn for an address family
+
+    ExaBGP 4 uses lists of {"nlri": prefix} dicts; ExaBGP 3 uses dicts
+    with prefixes as keys.
+    """
+
+    if isinstance(family_data, dict):
+        for prefix in family_data:
+            yield prefix
+    else:
+        for nlri in family_data:
+            if isinstance(nlri, dict):
+                yield nlri["nlri"]
+            else:
+                yield nlri
+
+
+def get_peer(neighbor):
+    """Get the address of the neighbor a message comes from
+
+    ExaBGP 4 uses {"address": {"peer": ...}}, ExaBGP 3 {"ip": ...}.
+    """
+
+    address = neighbor.get("address")
+    if isinstance(address, dict) and "peer" in address:
+        return address["peer"]
+    return neighbor.get("ip")
+
+
+def parse_message(line):
+    """Parse an ExaBGP JSON message
+
+    Returns: list of ("add"|"del", prefix, peer) events, in the order they
+        appear in the message; withdrawals come before announcements, as
+        in BGP UPDATE messages. When the session with a neighbor goes
+        down, a ("flush", None, peer) event is returned.
+    """
+
+    msg = json.loads(line)
+    neighbor = msg.get("neighbor", {})
+
+    if msg.get("type") == "state":
+        if neighbor.get("state") == "down":
+            return [("flush", None, get_peer(neighbor))]
+        return []
+
+    if msg.get("type") != "update":
+        return []
+
+    peer = get_peer(neighbor)
+    update = neighbor.get("message", {}).get("update", {})
+
+    events = []
+    for family, family_data in update.get("withdraw", {}).items():
+        if family not in FAMILIES:
+            continue
+        for prefix in iter_nlris(family_data):
+            events.append(("del", prefix, peer))
+
+    for family, nexthops in update.get("announce", {}).items():
+        if family not in FAMILIES:
+            continue
+        for nexthop, family_data in nexthops.items():
+            for prefix in iter_nlris(family_data):
+                events.append(("add", prefix, peer))
+
+    return events
+
+
+class ExaBGPIngestor(object):
+    """Apply ExaBGP JSON updates to a monitor, in micro-batches
+
+    Attributes:
+        messages: number of messages read.
+
+        bad_messages: number of lines that couldn't be parsed.
+
+        batches: number of batches applied.
+
+        events: number of announcements and withdrawals read.
+
+        coalesced: number of events that were not applied because a later
+            event for the same prefix from the same neighbor was in the
+            same batch.
+
+        flushed: number of prefixes removed because the session with
+            their neighbor went down.
+
+        duplicates, missing, invalid: prefixes reported by add_nets() and
+            del_nets() while applying the batches.
+    """
+
+    # See CoalescingBuffer.
+    BULK_MIN = CoalescingBuffer.BULK_MIN
+    BULK_SHARE = CoalescingBuffer.BULK_SHARE
+
+    def __init__(self, monitor, batch_size=10000, batch_interval=0.5,
+                 queue_size=1000):
+        """Init the ingestor
+
+        Args:
+            monitor: UniqueSmallestRoutableEntriesMonitor object.
+
+            batch_size: max number of events in a batch.
+
+            batch_interval: max number of seconds a batch stays open.
+
+            queue_size: max number of parsed messages waiting to be
+                applied; when the queue is full the reader waits.
+        """
+
+        self.monitor = monitor
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue_size = queue_size
+
+        self.messages = 0
+        self.bad_messages = 0
+        self.batches = 0
+        self.events = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.duplicates = 0
+        self.missing = 0
+        self.invalid = 0
+
+    async def _put_line(self, line, queue):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            return
+
+        self.messages += 1
+        try:
+            events = parse_message(line)
+        except (ValueError, KeyError, AttributeError, TypeError):
+            self.bad_messages += 1
+            return
+
+        if events:
+            await queue.put(events)
+
+    async def read(self, reader, queue):
+        """Read messages from the stream and put their events in queue"""
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await self._put_line(line, queue)
+
+        await queue.put(None)
+
+    def _apply_incremental(self, ip_ver, family):
+        for (peer, prefix), (action, first, pref_len) in family.items():
+            if action == "add":
+                try:
+                    self.monitor.add_net_int(ip_ver, first, pref_len,
+                                             source=peer)
+                except USRESMonitorException:
+                    self.duplicates += 1
+            elif not self.monitor.del_net_int(ip_ver, first, pref_len,
+                                              source=peer):
+                self.missing += 1
+
+    def _apply_bulk(self, family):
+        by_peer = OrderedDict()
+        for (peer, prefix), (action, first, pref_len) in family.items():
+            to_add, to_del = by_peer.setdefault(peer, ([], []))
+            if action == "add":
+                to_add.append(prefix)
+            else:
+                to_del.append(prefix)
+
+        for peer, (to_add, to_del) in by_peer.items():
+            for res in (self.monitor.del_nets(to_del, source=peer),
+                        self.monitor.add_nets(to_add, source=peer)):
+                self.duplicates += len(res.duplicates)
+                self.missing += len(res.missing)
+                self.invalid += len(res.invalid)
+
+    def apply(self, batch, flushes=()):
+        """Apply a batch of coalesced events to the monitor
+
+        Args:
+            batch: OrderedDict, (peer, prefix) -> "add"|"del".
+
+            flushes: peers whose session went down; they are flushed
+                before the batch is applied, so batch must only contain
+                the events that followed the flush.
+        """
+
+        for peer in flushes:
+            self.flushed += self.monitor.flush_source(peer)
+
+        families = {4: OrderedDict(), 6: OrderedDict()}
+        for (peer, prefix), action in batch.items():
+            try:
+                ip_ver, first, pref_len = self.monitor.parse_net(prefix)
+                # Same errors add_nets() reports as invalid.
+                UniqueSmallestRoutableEntriesMonitor.get_sre_int(
+                    ip_ver, first, pref_len,
+                    self.monitor.target_prefix_lens[ip_ver][-1])
+            except (AssertionError, ValueError):
+                self.invalid += 1
+                continue
+            families[ip_ver][(peer, prefix)] = (action, first, pref_len)
+
+        for ip_ver, family in families.items():
+            if len(family) >= self.BULK_MIN and \
+                    len(family) > self.BULK_SHARE * \
+                    self.monitor.get_prefixes_cnt(ip_ver):
+                self._apply_bulk(family)
+            else:
+                self._apply_incremental(ip_ver, family)
+
+        self.batches += 1
+
+    async def write(self, queue):
+        """Get events from queue and apply them in micro-batches"""
+
+        loop = asyncio.get_running_loop()
+        eof = False
+        while not eof:
+            events = await queue.get()
+            if events is None:
+                break
+
+            batch = OrderedDict()
+            flushes = []
+            batch_cnt = 0
+            deadline = loop.time() + self.batch_interval
+            while True:
+                for action, prefix, peer in events:
+                    if action == "flush":
+                        # Pending events of the peer are superseded.
+                        for key in [key for key in batch if key[0] == peer]:
+                            del batch[key]
+                            self.coalesced += 1
+                        if peer is not None and peer not in flushes:
+                            flushes.append(peer)
+                        continue
+                    key = (peer, prefix)
+                    if key in batch:
+                        self.coalesced += 1
+                    batch[key] = action
+                batch_cnt += len(events)
+                self.events += len(events)
+
+                if batch_cnt >= self.batch_size:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    events = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if events is None:
+                    eof = True
+                    break
+
+            self.apply(batch, flushes)
+
+    async def run(self, reader):
+        """Ingest messages from reader until EOF"""
+
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        await asyncio.gather(self.read(reader, queue), self.write(queue))
+
+    async def replay(self, lines):
+        """Ingest messages from an iterable of lines
+
+        For example, a file where the output of ExaBGP was saved.
+        """
+
+        queue = asyncio.Queue(maxsize=self.queue_size)
+
+        async def read():
+            for line in lines:
+                await self._put_line(line, queue)
+            await queue.put(None)
+
+        await asyncio.gather(read(), self.write(queue))
+
+    async def run_stdin(self):
+        """Ingest messages from stdin until EOF"""
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+        await self.run(reader)
+
+    async def run_unix_socket(self, path):
+        """Listen on a local socket and ingest messages from its clients
+
+        Clients are served one at a time, so that their updates are
+        applied in order.
+        """
+
+        lock = asyncio.Lock()
+
+        async def handle_client(reader, writer):
+            async with lock:
+                await self.run(reader)
+            writer.close()
+
+        server = await asyncio.start_unix_server(handle_client, path=path)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    """Read ExaBGP messages from stdin and periodically print SRE counts"""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Count unique SREs of the prefixes received by ExaBGP"
+    )
+    parser.add_argument("--target-prefix-len4", type=int, nargs="+",
+                        default=[24])
+    parser.add_argument("--target-prefix-len6", type=int, nargs="+",
+                        default=[40])
+    parser.add_argument("--socket", help="Listen on this local socket "
+                        "instead of reading from stdin")
+    parser.add_argument("--interval", type=float, default=60,
+                        help="Seconds between counts printed on stderr")
+    args = parser.parse_args()
+
+    monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len4=args.target_prefix_len4,
+        target_prefix_len6=args.target_prefix_len6
+    )
+    ingestor = ExaBGPIngestor(monitor)
+
+    def format_counts(ip_ver):
+        return ", ".join(
+            "/{}: {}".format(target_prefix_len, cnt)
+            for target_prefix_len, cnt in monitor.get_counts(ip_ver).items()
+        )
+
+    def print_counts():
+        sys.stderr.write("{} IPv4 SREs: {}; IPv6 SREs: {}\n".format(
+            time.strftime("%Y-%m-%d %H:%M:%S"),
+            format_counts(4), format_counts(6)
+        ))
+        sys.stderr.flush()
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.interval)
+            print_counts()
+
+    async def run():
+        reporter = asyncio.ensure_future(report())
+        try:
+            if args.socket:
+                await ingestor.run_unix_socket(args.socket)
+            else:
+                await ingestor.run_stdin()
+        finally:
+            reporter.cancel()
+            print_counts()
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
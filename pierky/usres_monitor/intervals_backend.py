@@ -0,0 +1,501 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import struct
+from bisect import bisect_left, bisect_right
+
+from .backend import Backend, iter_uncovered
+from .errors import USRESMonitorException
+
+SNAPSHOT_MAGIC = b"USRESMON"
+
+
+def _pack_firsts(ip_ver, firsts):
+    """Pack first values: 8 bytes each, 16 for IPv6 (high and low half)"""
+
+    if ip_ver == 6:
+        firsts = [half for first in firsts
+                  for half in (first >> 64, first & 0xffffffffffffffff)]
+    return struct.pack("!{}Q".format(len(firsts)), *firsts)
+
+
+def _read_firsts(f, ip_ver, cnt):
+    """Read cnt first values packed by _pack_firsts()"""
+
+    if ip_ver == 4:
+        return struct.unpack("!{}Q".format(cnt), f.read(cnt * 8))
+    halves = struct.unpack("!{}Q".format(cnt * 2), f.read(cnt * 16))
+    return [hi << 64 | lo for hi, lo in zip(halves[::2], halves[1::2])]
+
+
+class SortedArray(object):
+    """Sorted sequence of keys, looked up with bisect
+
+    Keys are split in buckets, each one a sorted list of at most
+    2 * load keys, so that inserts and deletes only shift the keys of one
+    bucket instead of the whole sequence.
+    """
+
+    def __init__(self, keys=(), load=1000):
+        """Build the array from keys, that must already be sorted"""
+
+        self._load = load
+        self._buckets = []
+        self._maxes = []
+        keys = list(keys)
+        for i in range(0, len(keys), load):
+            self._buckets.append(keys[i:i + load])
+            self._maxes.append(keys[min(i + load, len(keys)) - 1])
+
+    def __len__(self):
+        return sum([len(bucket) for bucket in self._buckets])
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            for key in bucket:
+                yield key
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        bucket = self._buckets[i]
+        bucket.insert(bisect_left(bucket, key), key)
+        self._maxes[i] = bucket[-1]
+
+        if len(bucket) > 2 * self._load:
+            self._buckets[i + 1:i + 1] = [bucket[self._load:]]
+            del bucket[self._load:]
+            self._maxes[i:i + 1] = [bucket[-1], self._buckets[i + 1][-1]]
+
+    def _shrink(self, i):
+        if self._buckets[i]:
+            self._maxes[i] = self._buckets[i][-1]
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+
+    def remove(self, key):
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self._shrink(i)
+
+    def floor(self, key):
+        """Return the greatest key <= key, or None"""
+
+        i = bisect_left(self._maxes, key)
+        if i < len(self._buckets) and self._buckets[i][0] <= key:
+            bucket = self._buckets[i]
+            return bucket[bisect_right(bucket, key) - 1]
+        if i > 0:
+            return self._maxes[i - 1]
+        return None
+
+    def irange(self, lo, hi):
+        """Iterate over the keys between lo and hi (both included)"""
+
+        i = bisect_left(self._maxes, lo)
+        if i == len(self._buckets):
+            return
+        j = bisect_left(self._buckets[i], lo)
+        while i < len(self._buckets):
+            bucket = self._buckets[i]
+            while j < len(bucket):
+                if bucket[j] > hi:
+                    return
+                yield bucket[j]
+                j += 1
+            i += 1
+            j = 0
+
+    def remove_range(self, lo, hi):
+        """Remove the keys between lo and hi (both included)
+
+        Returns: list of removed keys.
+        """
+
+        removed = []
+        i = bisect_left(self._maxes, lo)
+        while i < len(self._buckets):
+            bucket = self._buckets[i]
+            last_bucket = self._maxes[i] > hi
+            j = bisect_left(bucket, lo)
+            k = bisect_right(bucket, hi, j)
+            removed.extend(bucket[j:k])
+            del bucket[j:k]
+            if bucket:
+                self._maxes[i] = bucket[-1]
+                i += 1
+            else:
+                del self._buckets[i]
+                del self._maxes[i]
+            if last_bucket:
+                break
+        return removed
+
+
+class SortedIntervalsBackend(Backend):
+    """Pure-Python engine based on sorted arrays of integers
+
+    Prefixes are kept in a dict, plus a sorted array of their
+    (first, pref_len) keys that is scanned when a SRE is removed and the
+    prefixes it was covering must be uncovered. SREs are non-overlapping
+    ranges, kept in a dict indexed by their first value plus a sorted
+    array of these values, so the SRE that covers a prefix (if any) is
+    found with a single bisect.
+    """
+
+    name = "intervals"
+
+    def __init__(self):
+        super(SortedIntervalsBackend, self).__init__()
+
+        # (first, pref_len) -> (id, first, pref_len, last, cnt)
+        self._prefixes = {4: {}, 6: {}}
+        self._prefix_keys = {4: SortedArray(), 6: SortedArray()}
+        self._last_id = {4: 0, 6: 0}
+
+        # References of the prefixes added by some sources, as
+        # (first, pref_len) -> [added without a source, number of
+        # sources]; prefixes only added without a source are not here.
+        self._refs = {4: {}, 6: {}}
+
+        # source -> set of (first, pref_len)
+        self._sources = {4: {}, 6: {}}
+
+        # first -> (id, first, pref_len, last, cnt)
+        self._sres = {4: {}, 6: {}}
+        self._sre_firsts = {4: SortedArray(), 6: SortedArray()}
+
+    def _insert_prefix(self, ip_ver, first, pref_len, last, cnt, source):
+        key = (first, pref_len)
+        prefixes = self._prefixes[ip_ver]
+
+        if source is not None:
+            keys = self._sources[ip_ver].setdefault(source, set())
+            if key in keys:
+                return False, None
+            keys.add(key)
+
+        if key in prefixes:
+            refs = self._refs[ip_ver].get(key)
+            if source is None:
+                if refs is None or refs[0]:
+                    return False, None
+                refs[0] = True
+            elif refs is None:
+                # Until now, added without a source only.
+                self._refs[ip_ver][key] = [True, 1]
+            else:
+                refs[1] += 1
+            return True, None
+
+        if source is not None:
+            self._refs[ip_ver][key] = [False, 1]
+
+        self._last_id[ip_ver] += 1
+        prefix_id = self._last_id[ip_ver]
+        prefixes[key] = (prefix_id, first, pref_len, last, cnt)
+        self._prefix_keys[ip_ver].add(key)
+        return True, prefix_id
+
+    def _delete_prefix(self, ip_ver, first, pref_len, source):
+        key = (first, pref_len)
+        prefixes = self._prefixes[ip_ver]
+        if key not in prefixes:
+            return False, None
+
+        refs = self._refs[ip_ver].get(key)
+        if source is None:
+            if refs is not None:
+                if not refs[0]:
+                    return False, None
+                # Still referenced by some sources.
+                refs[0] = False
+                return True, None
+        else:
+            keys = self._sources[ip_ver].get(source)
+            if not keys or key not in keys:
+                return False, None
+            keys.remove(key)
+            if not keys:
+                del self._sources[ip_ver][source]
+
+            refs[1] -= 1
+            if refs[1] == 0:
+                del self._refs[ip_ver][key]
+            if refs[1] or refs[0]:
+                return True, None
+
+        record = prefixes.pop(key)
+        self._prefix_keys[ip_ver].remove(key)
+        return True, record[3]
+
+    def _insert_prefixes(self, ip_ver, prefixes, source):
+        duplicates = []
+        added_cnt = 0
+        for first, pref_len, last, cnt in prefixes:
+            added, prefix_id = self._insert_prefix(ip_ver, first, pref_len,
+                                                   last, cnt, source)
+            if not added:
+                duplicates.append((first, pref_len))
+            elif prefix_id is not None:
+                added_cnt += 1
+        return duplicates, added_cnt
+
+    def _delete_prefixes(self, ip_ver, keys, source):
+        missing = []
+        deleted_cnt = 0
+        for first, pref_len in keys:
+            deleted, last = self._delete_prefix(ip_ver, first, pref_len,
+                                                source)
+            if not deleted:
+                missing.append((first, pref_len))
+            elif last is not None:
+                deleted_cnt += 1
+        return missing, deleted_cnt
+
+    def _flush_source(self, ip_ver, source):
+        keys = list(self._sources[ip_ver].get(source, ()))
+        deleted = []
+        for first, pref_len in keys:
+            last = self._delete_prefix(ip_ver, first, pref_len, source)[1]
+            if last is not None:
+                deleted.append((first, last))
+        return len(keys), deleted
+
+    def _add_sre(self, ip_ver, prefix_id, first, pref_len, last, cnt):
+        sres = self._sres[ip_ver]
+        sre_firsts = self._sre_firsts[ip_ver]
+
+        # The closest SRE that starts at or before the new prefix is the
+        # only one that could cover it.
+        closest = sre_firsts.floor(first)
+        if closest is not None and sres[closest][3] >= last:
+            return
+
+        journal = self._journal[ip_ver]
+
+        for covered in sre_firsts.remove_range(first, last):
+            record = sres.pop(covered)
+            self._update_sre_cnt(ip_ver, record[2], -1, -record[4])
+            if journal is not None:
+                self._log_sre(ip_ver, record, -1)
+
+        record = (prefix_id, first, pref_len, last, cnt)
+        sres[first] = record
+        sre_firsts.add(first)
+        self._update_sre_cnt(ip_ver, pref_len, 1, cnt)
+        if journal is not None:
+            self._log_sre(ip_ver, record, 1)
+
+    def _del_sre(self, ip_ver, first, last):
+        sres = self._sres[ip_ver]
+        sre_firsts = self._sre_firsts[ip_ver]
+
+        record = sres.get(first)
+        if record is None or record[3] != last:
+            return
+
+        journal = self._journal[ip_ver]
+
+        del sres[first]
+        sre_firsts.remove(first)
+        self._update_sre_cnt(ip_ver, record[2], -1, -record[4])
+        if journal is not None:
+            self._log_sre(ip_ver, record, -1)
+
+        prefixes = self._prefixes[ip_ver]
+        keys = self._prefix_keys[ip_ver].irange((first, 0), (last, 128))
+        for record in iter_uncovered([prefixes[key] for key in keys]):
+            sres[record[1]] = record
+            sre_firsts.add(record[1])
+            self._update_sre_cnt(ip_ver, record[2], 1, record[4])
+            if journal is not None:
+                self._log_sre(ip_ver, record, 1)
+
+    def _populate(self, ip_ver):
+        prefixes = self._prefixes[ip_ver]
+        sres = {}
+        sre_firsts = []
+        totals = {}
+        for record in iter_uncovered(prefixes[key] for key
+                                     in self._prefix_keys[ip_ver]):
+            sres[record[1]] = record
+            sre_firsts.append(record[1])
+            sres_cnt, cnt = totals.get(record[2], (0, 0))
+            totals[record[2]] = (sres_cnt + 1, cnt + record[4])
+
+        self._sres[ip_ver] = sres
+        self._sre_firsts[ip_ver] = SortedArray(sre_firsts)
+        return [(pref_len, sres_cnt, cnt)
+                for pref_len, (sres_cnt, cnt) in totals.items()]
+
+    def _iter_sres(self, ip_ver):
+        return iter(sorted(self._sres[ip_ver].values()))
+
+    def _find_sre(self, ip_ver, key):
+        first = self._sre_firsts[ip_ver].floor(key)
+        if first is None:
+            return None
+        return self._sres[ip_ver][first]
+
+    def _get_sres_in(self, ip_ver, first, last):
+        sres = self._sres[ip_ver]
+        return [sres[key]
+                for key in self._sre_firsts[ip_ver].irange(first, last)]
+
+    def _get_sre_lens_in(self, ip_ver, first, last):
+        sres = self._sres[ip_ver]
+        res = {}
+        for key in self._sre_firsts[ip_ver].irange(first, last):
+            pref_len = sres[key][2]
+            res[pref_len] = res.get(pref_len, 0) + 1
+        return res
+
+    def _get_sres_page(self, ip_ver, after, limit, max_pref_len):
+        sres = self._sres[ip_ver]
+        res = []
+        for key in self._sre_firsts[ip_ver].irange(after + 1, 2**128):
+            record = sres[key]
+            if record[2] <= max_pref_len:
+                res.append(record)
+                if len(res) == limit:
+                    break
+        return res
+
+    def _get_prefixes_cnt(self, ip_ver):
+        return len(self._prefixes[ip_ver])
+
+    # Snapshots are saved in a compact binary format:
+    # - SNAPSHOT_MAGIC;
+    # - length of the JSON header (4 bytes);
+    # - JSON header: the info dict, plus the number of prefixes, the
+    #   last ID and the sources with their number of prefixes;
+    # - for IPv4 and IPv6, the prefixes sorted by (first, pref_len), as
+    #   four arrays: IDs and first values (8 bytes each, first values
+    #   of IPv6 prefixes take 16 bytes, see _pack_firsts()), prefix
+    #   lengths and flags set when the prefix has been added without a
+    #   source (1 byte each); then, for each source, the first values
+    #   and the prefix lengths of its prefixes.
+    # All the integers are in network byte order. The last and cnt values
+    # are computed again on load, on the basis of the target prefix
+    # lengths, and the SREs are rebuilt with a single sweep.
+
+    def _save_snapshot(self, path, info):
+        header = dict(info)
+        for ip_ver in [4, 6]:
+            header["prefixes_cnt{}".format(ip_ver)] = \
+                len(self._prefixes[ip_ver])
+            header["last_id{}".format(ip_ver)] = self._last_id[ip_ver]
+            header["sources{}".format(ip_ver)] = [
+                [source, len(keys)]
+                for source, keys in self._sources[ip_ver].items()
+            ]
+        header_data = json.dumps(header).encode("utf-8")
+
+        with open(path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack("!I", len(header_data)))
+            f.write(header_data)
+
+            for ip_ver in [4, 6]:
+                prefixes = self._prefixes[ip_ver]
+                refs = self._refs[ip_ver]
+                keys = list(self._prefix_keys[ip_ver])
+                records = [prefixes[key] for key in keys]
+                fmt = "!{}Q".format(len(records))
+                f.write(struct.pack(fmt, *[record[0] for record in records]))
+                f.write(_pack_firsts(ip_ver,
+                                     [record[1] for record in records]))
+                f.write(bytes(bytearray([record[2] for record in records])))
+                f.write(bytes(bytearray([int(key not in refs or refs[key][0])
+                                         for key in keys])))
+
+                for source, cnt in header["sources{}".format(ip_ver)]:
+                    keys = self._sources[ip_ver][source]
+                    f.write(_pack_firsts(ip_ver, [key[0] for key in keys]))
+                    f.write(bytes(bytearray([key[1] for key in keys])))
+
+    def _read_header(self, f, path):
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise USRESMonitorException(
+                "Can't read snapshot {}: unknown format".format(path)
+            )
+        header_len = struct.unpack("!I", f.read(4))[0]
+        return json.loads(f.read(header_len).decode("utf-8"))
+
+    def _read_snapshot_info(self, path):
+        with open(path, "rb") as f:
+            return self._read_header(f, path)
+
+    def _load_snapshot(self, path):
+        with open(path, "rb") as f:
+            header = self._read_header(f, path)
+
+            for ip_ver in [4, 6]:
+                cnt = header["prefixes_cnt{}".format(ip_ver)]
+                fmt = "!{}Q".format(cnt)
+                ids = struct.unpack(fmt, f.read(cnt * 8))
+                firsts = _read_firsts(f, ip_ver, cnt)
+                pref_lens = bytearray(f.read(cnt))
+                unsourced = bytearray(f.read(cnt))
+
+                target_prefix_len = header[
+                    "target_prefix_len{}".format(ip_ver)]
+                tot_len = 32 if ip_ver == 4 else 128
+
+                prefixes = {}
+                keys = []
+                for prefix_id, first, pref_len in zip(ids, firsts,
+                                                      pref_lens):
+                    diff_len = target_prefix_len - pref_len
+                    last = first | ((2**diff_len - 1) <<
+                                    tot_len - target_prefix_len)
+                    key = (first, pref_len)
+                    prefixes[key] = (prefix_id, first, pref_len, last,
+                                     2**diff_len)
+                    keys.append(key)
+
+                sources = {}
+                refs = {}
+                for source, cnt in header["sources{}".format(ip_ver)]:
+                    source_keys = set(zip(
+                        _read_firsts(f, ip_ver, cnt),
+                        bytearray(f.read(cnt))
+                    ))
+                    sources[source] = source_keys
+                    for key in source_keys:
+                        if key in refs:
+                            refs[key][1] += 1
+                        else:
+                            refs[key] = [None, 1]
+                for i, key in enumerate(keys):
+                    if key in refs:
+                        refs[key][0] = bool(unsourced[i])
+
+                self._prefixes[ip_ver] = prefixes
+                self._prefix_keys[ip_ver] = SortedArray(keys)
+                self._sources[ip_ver] = sources
+                self._refs[ip_ver] = refs
+                self._last_id[ip_ver] = header["last_id{}".format(ip_ver)]
+                self._populate(ip_ver)
@@ -0,0 +1,316 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load the prefixes of MRT RIB dumps into a monitor
+
+RIB dumps of route collectors (RouteViews, RIPE RIS...) are MRT files
+(RFC 6396) made of TABLE_DUMP_V2 records: a PEER_INDEX_TABLE, then one
+record for each prefix, holding the routes received for it from all the
+peers. Files are often compressed using gzip or bz2.
+
+MRTLoader reads these files in chunks of buffer_size bytes and decodes
+the RIB records in place: only the prefix is read, as integers, and the
+routes of the peers are skipped without being parsed. Since a record
+already holds the routes of all the peers, each prefix is loaded only
+once; repeated records of the same prefix, as written by some
+collectors, are skipped too. Prefixes are added to the monitor in batches
+of batch_size items using add_nets_int(), so the memory used doesn't
+depend on the size of the file.
+
+Records of other types, multicast RIBs and RIB_GENERIC records are
+skipped, as well as prefixes longer than the target prefix length of the
+monitor.
+
+Example:
+
+    loader = MRTLoader(monitor)
+    loader.load("rib.20170101.0000.bz2")
+    monitor.get_count(4)
+
+It can also be run as a script, to print the SRE counts of some files:
+
+    python -m pierky.usres_monitor.mrt rib.20170101.0000.bz2
+"""
+
+import bz2
+import gzip
+import struct
+from itertools import islice
+
+from .errors import USRESMonitorException
+
+TABLE_DUMP_V2 = 13
+
+# TABLE_DUMP_V2 subtypes of unicast RIBs, with their address family;
+# RFC 8050 (ADD-PATH) records have the same format up to the routes.
+RIB_SUBTYPES = {
+    2: 4,   # RIB_IPV4_UNICAST
+    4: 6,   # RIB_IPV6_UNICAST
+    8: 4,   # RIB_IPV4_UNICAST_ADDPATH
+    10: 6   # RIB_IPV6_UNICAST_ADDPATH
+}
+
+BUFFER_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct("!IHHI")
+_RIB_HEADER = struct.Struct("!IB")
+_ENTRY_CNT = struct.Struct("!H")
+
+
+def open_mrt(path, buffer_size=BUFFER_SIZE):
+    """Open an MRT file, decompressing it if needed
+
+    gzip and bz2 files are recognized by their first bytes;
+    buffer_size is used for uncompressed files only, the others being
+    read through the buffers of their decompressors.
+
+    Returns: file object
+    """
+
+    with open(path, "rb") as f:
+        magic = f.read(3)
+
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(path, "rb")
+    if magic == b"BZh":
+        return bz2.BZ2File(path, "rb")
+    return open(path, "rb", buffer_size)
+
+
+def iter_records(f, buffer_size=BUFFER_SIZE):
+    """Read the MRT records of a file
+
+    The file is read in chunks of buffer_size bytes; records are not
+    copied out of the chunk they are in.
+
+    Yields: (type, subtype, data, start, end) tuples, where the body of
+        the record is data[start:end].
+    """
+
+    data = b""
+    pos = 0
+    while True:
+        chunk = f.read(buffer_size)
+        data = data[pos:] + chunk
+        pos = 0
+
+        while len(data) - pos >= _HEADER.size:
+            _, mrt_type, subtype, length = _HEADER.unpack_from(data, pos)
+            start = pos + _HEADER.size
+            end = start + length
+            if end > len(data):
+                break
+            yield mrt_type, subtype, data, start, end
+            pos = end
+
+        if not chunk:
+            if pos < len(data):
+                raise USRESMonitorException(
+                    "Truncated MRT record: {} bytes left".format(
+                        len(data) - pos)
+                )
+            return
+
+
+def iter_rib_prefixes(records, stats=None):
+    """Get the prefixes of the unicast RIB records
+
+    Args:
+        records: iterable of records, as returned by iter_records().
+
+        stats: dict, where the number of "records", "rib_records" and
+            "skipped" records is counted, if given.
+
+    Yields: (ip_ver, first, pref_len) tuples, in the same form of the
+        arguments of add_net_int().
+    """
+
+    if stats is None:
+        stats = {}
+    for key in ("records", "rib_records", "skipped"):
+        stats.setdefault(key, 0)
+
+    prev = None
+    for mrt_type, subtype, data, start, end in records:
+        stats["records"] += 1
+        ip_ver = RIB_SUBTYPES.get(subtype) \
+            if mrt_type == TABLE_DUMP_V2 else None
+        if ip_ver is None:
+            stats["skipped"] += 1
+            continue
+        stats["rib_records"] += 1
+
+        tot_len = 32 if ip_ver == 4 else 128
+        _, pref_len = _RIB_HEADER.unpack_from(data, start)
+        prefix_start = start + _RIB_HEADER.size
+        prefix_end = prefix_start + (pref_len + 7) // 8
+        if pref_len > tot_len or prefix_end + _ENTRY_CNT.size > end:
+            raise USRESMonitorException(
+                "Invalid RIB record: prefix length {}, record length "
+                "{}".format(pref_len, end - start)
+            )
+
+        # Without routes, the prefix is not in the RIB.
+        if not _ENTRY_CNT.unpack_from(data, prefix_end)[0]:
+            continue
+
+        # Only the significant bytes of the prefix are stored.
+        prefix = data[prefix_start:prefix_end] + \
+            b"\0" * (prefix_start + tot_len // 8 - prefix_end)
+        if ip_ver == 4:
+            first = struct.unpack("!I", prefix)[0]
+        else:
+            hi, lo = struct.unpack("!QQ", prefix)
+            first = hi << 64 | lo
+        first &= ~((1 << tot_len - pref_len) - 1)
+
+        res = (ip_ver, first, pref_len)
+        if res != prev:
+            yield res
+            prev = res
+
+
+class MRTLoader(object):
+    """Add the prefixes of MRT RIB dumps to a monitor
+
+    Attributes:
+        records: number of MRT records read.
+
+        rib_records: number of unicast RIB records read.
+
+        skipped: number of records of other types.
+
+        too_long: number of prefixes not loaded because they are longer
+            than the target prefix length.
+
+        processed: number of prefixes added to the monitor.
+
+        duplicates: number of prefixes that were already in the monitor,
+            for example because they were loaded from a previous file.
+    """
+
+    def __init__(self, monitor, batch_size=10000, buffer_size=BUFFER_SIZE):
+        """Init the loader
+
+        Args:
+            monitor: UniqueSmallestRoutableEntriesMonitor object.
+
+            batch_size: number of prefixes added to the monitor at once.
+
+            buffer_size: number of bytes read from the file at once.
+        """
+
+        self.monitor = monitor
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+        self.records = 0
+        self.rib_records = 0
+        self.skipped = 0
+        self.too_long = 0
+        self.processed = 0
+        self.duplicates = 0
+
+    def _iter_loadable(self, prefixes):
+        target_prefix_lens = dict(
+            (ip_ver, self.monitor.target_prefix_lens[ip_ver][-1])
+            for ip_ver in [4, 6]
+        )
+        for prefix in prefixes:
+            if prefix[2] > target_prefix_lens[prefix[0]]:
+                self.too_long += 1
+                continue
+            yield prefix
+
+    def load(self, path_or_file, source=None):
+        """Add the prefixes of an MRT file to the monitor
+
+        Args:
+            path_or_file: the path of the file, that can be compressed
+                using gzip or bz2, or a file object opened in binary mode.
+
+            source: see UniqueSmallestRoutableEntriesMonitor.add_net().
+
+        Returns: the number of prefixes added to the monitor.
+        """
+
+        if hasattr(path_or_file, "read"):
+            f = path_or_file
+        else:
+            f = open_mrt(path_or_file, self.buffer_size)
+
+        stats = {}
+        processed = 0
+        try:
+            prefixes = self._iter_loadable(iter_rib_prefixes(
+                iter_records(f, self.buffer_size), stats
+            ))
+            while True:
+                batch = list(islice(prefixes, self.batch_size))
+                if not batch:
+                    break
+                res = self.monitor.add_nets_int(batch, self.batch_size,
+                                                source=source)
+                processed += res.processed
+                self.duplicates += len(res.duplicates)
+        finally:
+            if f is not path_or_file:
+                f.close()
+            self.records += stats.get("records", 0)
+            self.rib_records += stats.get("rib_records", 0)
+            self.skipped += stats.get("skipped", 0)
+            self.processed += processed
+
+        return processed
+
+
+def main():
+    """Load MRT RIB dumps and print the SRE counts"""
+
+    import argparse
+
+    from . import UniqueSmallestRoutableEntriesMonitor
+
+    parser = argparse.ArgumentParser(
+        description="Count unique SREs of the prefixes of MRT RIB dumps"
+    )
+    parser.add_argument("path", nargs="+")
+    parser.add_argument("--target-prefix-len4", type=int, nargs="+",
+                        default=[24])
+    parser.add_argument("--target-prefix-len6", type=int, nargs="+",
+                        default=[40])
+    parser.add_argument("--backend", default="sqlite")
+    args = parser.parse_args()
+
+    monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len4=args.target_prefix_len4,
+        target_prefix_len6=args.target_prefix_len6,
+        backend=args.backend
+    )
+    loader = MRTLoader(monitor)
+    for path in args.path:
+        loader.load(path)
+
+    print("{} records, {} prefixes loaded, {} longer than the target "
+          "prefix length".format(loader.records, loader.processed,
+                                 loader.too_long))
+    for ip_ver in [4, 6]:
+        print("IPv{} SREs: {}".format(ip_ver, ", ".join(
+            "/{}: {}".format(target_prefix_len, cnt)
+            for target_prefix_len, cnt in monitor.get_counts(ip_ver).items()
+        )))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compute the SREs of a large set of prefixes using a process pool
+
+Since prefixes can only be nested or disjoint, the prefixes of disjoint
+blocks of the address space can be deduplicated independently. This
+module splits the prefixes in shards, on the basis of the top shard_bits
+bits of their first address, and computes the SREs of each shard in a
+process pool:
+
+- the input is split in chunks that the workers parse, grouping their
+  prefixes by shard (_parse_chunk());
+
+- the prefixes of each shard are sorted, deduplicated and swept by
+  iter_uncovered() in a worker (_find_shard_sres());
+
+- the SREs of the shards are concatenated, in the order of the shards,
+  and swept again, to remove those that are covered by a prefix shorter
+  than shard_bits, that starts in a previous shard and spans many of
+  them.
+
+ShardedSREs gives the same results of BatchSREs and of a monitor where
+the same prefixes have been added, in the same order, using add_nets(),
+without the need of NumPy.
+"""
+
+import multiprocessing
+from bisect import bisect_left
+from itertools import islice
+
+from . import UniqueSmallestRoutableEntriesMonitor
+from .backend import iter_uncovered
+
+
+def _iter_chunks(nets_or_strs, chunk_size):
+    nets_or_strs = iter(nets_or_strs)
+    start = 0
+    while True:
+        chunk = list(islice(nets_or_strs, chunk_size))
+        if not chunk:
+            break
+        yield start, chunk
+        start += len(chunk)
+
+
+def _parse_chunk(args):
+    """Parse a chunk of prefixes and group them by shard
+
+    Positions are counted separately for each address family: the
+    position of a prefix is start, plus the number of the prefixes of its
+    family that come before it within the chunk.
+
+    Args:
+        args: (start, nets_or_strs, target_prefix_lens, shard_bits), where
+            start is the position of the first prefix within the input
+            and target_prefix_lens is {ip_ver: target prefix length}.
+
+    Returns: (counts, shards), where counts is {ip_ver: number of
+        prefixes} and shards is
+        {ip_ver: {shard: [(pos, first, pref_len, last, cnt), ...]}}
+    """
+
+    start, nets_or_strs, target_prefix_lens, shard_bits = args
+    parse_net = UniqueSmallestRoutableEntriesMonitor.parse_net
+    get_sre_int = UniqueSmallestRoutableEntriesMonitor.get_sre_int
+
+    shifts = {4: 32 - shard_bits, 6: 128 - shard_bits}
+    shards = {4: {}, 6: {}}
+    next_pos = {4: start, 6: start}
+    for net_or_str in nets_or_strs:
+        ip_ver, first, pref_len = parse_net(net_or_str)
+        first, last, cnt = get_sre_int(ip_ver, first, pref_len,
+                                       target_prefix_lens[ip_ver])
+        pos = next_pos[ip_ver]
+        next_pos[ip_ver] += 1
+        shard = first >> shifts[ip_ver]
+        if shard not in shards[ip_ver]:
+            shards[ip_ver][shard] = []
+        shards[ip_ver][shard].append((pos, first, pref_len, last, cnt))
+    counts = {ip_ver: next_pos[ip_ver] - start for ip_ver in [4, 6]}
+    return counts, shards
+
+
+def _find_shard_sres(records):
+    """Find the SREs of the prefixes of a shard
+
+    Args:
+        records: list of (pos, first, pref_len, last, cnt) tuples.
+
+    Returns: (sres, duplicates): the records of the SREs, sorted by
+        (first, pref_len), and the positions of the prefixes that were
+        given more than once, apart from the first time.
+    """
+
+    records.sort(key=lambda record: (record[1], record[2], record[0]))
+
+    unique = []
+    duplicates = []
+    prev_key = None
+    for record in records:
+        key = (record[1], record[2])
+        if key == prev_key:
+            duplicates.append(record[0])
+        else:
+            unique.append(record)
+            prev_key = key
+
+    return list(iter_uncovered(unique)), duplicates
+
+
+class ShardedSREs(object):
+    """SREs of a set of prefixes of the same address family
+
+    Attributes:
+        records: list of the (id, first, pref_len, last, cnt) records of
+            the SREs, sorted by ID; IDs are the positions of the prefixes
+            within the input once duplicates are removed, starting from 1.
+    """
+
+    def __init__(self, ip_ver, target_prefix_len, shard_results,
+                 chunk_size, chunk_offsets):
+        """Merge the SREs computed for each shard
+
+        Args:
+            shard_results: list of the (sres, duplicates) tuples returned
+                by _find_shard_sres(), in the order of the shards.
+
+            chunk_size: number of prefixes parsed by each task.
+
+            chunk_offsets: for each chunk, the number of prefixes of this
+                family found in the previous chunks.
+        """
+
+        self.ip_ver = ip_ver
+        self.target_prefix_len = target_prefix_len
+
+        sres = []
+        duplicates = []
+        for shard_sres, shard_duplicates in shard_results:
+            sres.extend(shard_sres)
+            duplicates.extend(shard_duplicates)
+        duplicates.sort()
+
+        # The ID of a prefix is its position among the prefixes of its
+        # family, less the number of duplicates that come before it.
+        self.records = []
+        for pos, first, pref_len, last, cnt in iter_uncovered(sres):
+            chunk_no, idx = divmod(pos, chunk_size)
+            prefix_id = chunk_offsets[chunk_no] + idx + 1 - \
+                bisect_left(duplicates, pos)
+            self.records.append((prefix_id, first, pref_len, last, cnt))
+        self.records.sort()
+
+    @classmethod
+    def from_nets(cls, nets_or_strs, target_prefix_len4=24,
+                  target_prefix_len6=40, processes=None, shard_bits=8,
+                  chunk_size=50000):
+        """Compute the SREs of IPv4 and IPv6 prefixes
+
+        Args:
+            nets_or_strs: iterable of ipaddr.IPv[4|6]Network objects or
+                strings; it's consumed in chunks, so it can be a
+                generator.
+
+            processes: number of worker processes; by default, the number
+                of CPUs. With 1, everything runs in the current process.
+
+            shard_bits: number of the top bits of the first address used
+                to split the prefixes in shards.
+
+            chunk_size: number of prefixes parsed by each task.
+
+        Returns: {4: ShardedSREs, 6: ShardedSREs}
+        """
+
+        target_prefix_lens = {4: target_prefix_len4, 6: target_prefix_len6}
+        tasks = ((start, chunk, target_prefix_lens, shard_bits)
+                 for start, chunk in _iter_chunks(nets_or_strs, chunk_size))
+
+        if processes == 1:
+            pool = None
+            imap = map
+        else:
+            pool = multiprocessing.Pool(processes)
+            imap = pool.imap
+
+        try:
+            shards = {4: {}, 6: {}}
+            chunk_offsets = {4: [], 6: []}
+            totals = {4: 0, 6: 0}
+            for counts, chunk_shards in imap(_parse_chunk, tasks):
+                for ip_ver in [4, 6]:
+                    chunk_offsets[ip_ver].append(totals[ip_ver])
+                    totals[ip_ver] += counts[ip_ver]
+                    for shard, records in chunk_shards[ip_ver].items():
+                        if shard in shards[ip_ver]:
+                            shards[ip_ver][shard].extend(records)
+                        else:
+                            shards[ip_ver][shard] = records
+
+            res = {}
+            for ip_ver in [4, 6]:
+                keys = sorted(shards[ip_ver])
+                shard_results = list(imap(
+                    _find_shard_sres,
+                    [shards[ip_ver].pop(shard) for shard in keys]
+                ))
+                res[ip_ver] = cls(ip_ver, target_prefix_lens[ip_ver],
+                                  shard_results, chunk_size,
+                                  chunk_offsets[ip_ver])
+        except:
+            if pool:
+                pool.terminate()
+                pool.join()
+            raise
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        return res
+
+    def get_count(self):
+        """Get the total number of SREs
+
+        Return: int
+        """
+
+        return sum([record[4] for record in self.records])
+
+    def get_prefixes(self):
+        """Get the list of not overlapping prefixes and their SREs
+
+        Same as UniqueSmallestRoutableEntriesMonitor.get_prefixes().
+        """
+
+        get_ip_str = UniqueSmallestRoutableEntriesMonitor.get_ip_str
+
+        for prefix_id, first, pref_len, last, cnt in self.records:
+            yield {
+                "id": prefix_id,
+                "first_int": first,
+                "first_ip": get_ip_str(self.ip_ver, first),
+                "pref_len": pref_len,
+                "last_int": last,
+                "last_ip": get_ip_str(self.ip_ver, last),
+                "cnt": cnt
+            }
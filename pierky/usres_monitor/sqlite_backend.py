@@ -0,0 +1,1330 @@
+# Copyright (C) 2017 Pier Carlo Chiodi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import struct
+
+from .backend import Backend, iter_uncovered
+from .errors import USRESMonitorException
+
+try:
+    # Python 2: str values would be stored as TEXT.
+    _blob = buffer
+except NameError:
+    def _blob(data):
+        return data
+
+# IPv6 values don't fit in a SQLite INTEGER, that is a signed 64-bit
+# integer: in the IPv6 tables, first and last values are stored as 16-byte
+# big-endian BLOBs, that SQLite compares with memcmp(), so their order and
+# the indexes are the same of the integers. The cnt values take one more
+# byte, since they can be as large as 2**128 (::/0 with a /128 target).
+# IPv4 values are stored as they are.
+
+
+def _pack_addr(value):
+    return _blob(struct.pack("!QQ", value >> 64,
+                             value & 0xffffffffffffffff))
+
+
+def _unpack_addr(data):
+    hi, lo = struct.unpack("!QQ", data)
+    return hi << 64 | lo
+
+
+def _pack_cnt(value):
+    return _blob(struct.pack("!BQQ", value >> 128,
+                             value >> 64 & 0xffffffffffffffff,
+                             value & 0xffffffffffffffff))
+
+
+def _unpack_cnt(data):
+    top, hi, lo = struct.unpack("!BQQ", data)
+    return top << 128 | hi << 64 | lo
+
+
+def _unpack_record(row):
+    """Decode an (id, first, pref_len, last, cnt) row of an IPv6 table"""
+
+    return (row[0], _unpack_addr(row[1]), row[2], _unpack_addr(row[3]),
+            _unpack_cnt(row[4]))
+
+
+# Statements used on the hot path, formatted once per IP version by
+# setup_db(): the strings passed to the library are then always the same
+# objects and the statements compiled by SQLite are reused through the
+# statement cache of the connection (see STATEMENT_CACHE_SIZE).
+STATEMENTS = {
+    # Single prefixes.
+    "insert_prefix_source": (
+        "INSERT INTO "
+        "   prefix_sources{ip_ver} ("
+        "       source, first, pref_len"
+        "   ) "
+        "VALUES "
+        "   (?, ?, ?)"),
+    "insert_prefix": (
+        "INSERT INTO "
+        "   prefixes{ip_ver} ("
+        "       first, pref_len, last, cnt"
+        "   ) "
+        "VALUES "
+        "   (?, ?, ?, ?)"),
+    "insert_sourced_prefix": (
+        "INSERT INTO "
+        "   prefixes{ip_ver} ("
+        "       first, pref_len, last, cnt,"
+        "       unsourced, sources"
+        "   ) "
+        "VALUES "
+        "   (?, ?, ?, ?, 0, 1)"),
+    "set_unsourced": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   unsourced = 1 "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ? AND"
+        "   unsourced = 0"),
+    "unset_unsourced": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   unsourced = 0 "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ?"),
+    "add_source_ref": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   sources = sources + 1 "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ?"),
+    "del_source_ref": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   sources = sources - 1 "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ?"),
+    "delete_prefix_source": (
+        "DELETE FROM "
+        "   prefix_sources{ip_ver} "
+        "WHERE"
+        "   source = ? AND"
+        "   first = ? AND"
+        "   pref_len = ?"),
+    "get_prefix_refs": (
+        "SELECT "
+        "   last, unsourced, sources "
+        "FROM "
+        "   prefixes{ip_ver} "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ?"),
+    "delete_prefix": (
+        "DELETE FROM "
+        "   prefixes{ip_ver} "
+        "WHERE"
+        "   first = ? AND"
+        "   pref_len = ?"),
+
+    # Batches of prefixes, through the bulk table.
+    "clear_bulk": (
+        "DELETE FROM bulk_prefixes{ip_ver}"),
+    "insert_bulk": (
+        "INSERT INTO "
+        "   bulk_prefixes{ip_ver} ("
+        "       first, pref_len, last, cnt"
+        "   ) "
+        "VALUES "
+        "   (?, ?, ?, ?)"),
+    "delete_bulk": (
+        "DELETE FROM "
+        "   bulk_prefixes{ip_ver} "
+        "WHERE "
+        "   rowid = ?"),
+    "bulk_unsourced_duplicates": (
+        "SELECT "
+        "   b.rowid, b.first, b.pref_len "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b"
+        "       INNER JOIN prefixes{ip_ver} p ON"
+        "           p.first = b.first AND"
+        "           p.pref_len = b.pref_len "
+        "WHERE "
+        "   p.unsourced = 1"),
+    "bulk_source_duplicates": (
+        "SELECT "
+        "   b.rowid, b.first, b.pref_len "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b"
+        "       INNER JOIN prefix_sources{ip_ver} s ON"
+        "           s.source = ? AND"
+        "           s.first = b.first AND"
+        "           s.pref_len = b.pref_len"),
+    "bulk_insert_prefix_sources": (
+        "INSERT INTO "
+        "   prefix_sources{ip_ver} ("
+        "       source, first, pref_len"
+        "   ) "
+        "SELECT "
+        "   ?, first, pref_len "
+        "FROM "
+        "   bulk_prefixes{ip_ver}"),
+    "bulk_set_unsourced": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   unsourced = 1 "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "   )"),
+    "bulk_add_source_ref": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   sources = sources + 1 "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "   )"),
+    "bulk_insert_prefixes": (
+        "INSERT INTO "
+        "   prefixes{ip_ver} ("
+        "       first, pref_len, last, cnt,"
+        "       unsourced, sources"
+        "   ) "
+        "SELECT "
+        "   b.first, b.pref_len, b.last, b.cnt, 1, 0 "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b "
+        "WHERE "
+        "   NOT EXISTS ("
+        "       SELECT id FROM prefixes{ip_ver} p"
+        "       WHERE"
+        "           p.first = b.first AND"
+        "           p.pref_len = b.pref_len"
+        "   ) "
+        "ORDER BY "
+        "   b.rowid"),
+    "bulk_insert_sourced_prefixes": (
+        "INSERT INTO "
+        "   prefixes{ip_ver} ("
+        "       first, pref_len, last, cnt,"
+        "       unsourced, sources"
+        "   ) "
+        "SELECT "
+        "   b.first, b.pref_len, b.last, b.cnt, 0, 1 "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b "
+        "WHERE "
+        "   NOT EXISTS ("
+        "       SELECT id FROM prefixes{ip_ver} p"
+        "       WHERE"
+        "           p.first = b.first AND"
+        "           p.pref_len = b.pref_len"
+        "   ) "
+        "ORDER BY "
+        "   b.rowid"),
+    "bulk_unsourced_missing": (
+        "SELECT "
+        "   b.rowid, b.first, b.pref_len "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b "
+        "WHERE "
+        "   NOT EXISTS ("
+        "       SELECT id FROM prefixes{ip_ver} p"
+        "       WHERE"
+        "           p.first = b.first AND"
+        "           p.pref_len = b.pref_len AND"
+        "           p.unsourced = 1"
+        "   )"),
+    "bulk_source_missing": (
+        "SELECT "
+        "   b.rowid, b.first, b.pref_len "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b "
+        "WHERE "
+        "   NOT EXISTS ("
+        "       SELECT s.rowid FROM prefix_sources{ip_ver} s"
+        "       WHERE"
+        "           s.source = ? AND"
+        "           s.first = b.first AND"
+        "           s.pref_len = b.pref_len"
+        "   )"),
+    "bulk_delete_prefix_sources": (
+        "DELETE FROM "
+        "   prefix_sources{ip_ver} "
+        "WHERE "
+        "   rowid IN ("
+        "       SELECT s.rowid FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefix_sources{ip_ver} s"
+        "               ON"
+        "                   s.source = ? AND"
+        "                   s.first = b.first AND"
+        "                   s.pref_len = b.pref_len"
+        "   )"),
+    "bulk_delete_unsourced_prefixes": (
+        "DELETE FROM "
+        "   prefixes{ip_ver} "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "       WHERE"
+        "           NOT p.sources > 0"
+        "   )"),
+    "bulk_delete_sourced_prefixes": (
+        "DELETE FROM "
+        "   prefixes{ip_ver} "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "       WHERE"
+        "           NOT (p.sources > 1 OR p.unsourced = 1)"
+        "   )"),
+    "bulk_unset_unsourced": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   unsourced = 0 "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "   )"),
+    "bulk_del_source_ref": (
+        "UPDATE "
+        "   prefixes{ip_ver} "
+        "SET "
+        "   sources = sources - 1 "
+        "WHERE "
+        "   id IN ("
+        "       SELECT p.id FROM"
+        "           bulk_prefixes{ip_ver} b"
+        "               INNER JOIN prefixes{ip_ver} p ON"
+        "                   p.first = b.first AND"
+        "                   p.pref_len = b.pref_len"
+        "   )"),
+    "load_source_bulk": (
+        "INSERT INTO "
+        "   bulk_prefixes{ip_ver} ("
+        "       first, pref_len"
+        "   ) "
+        "SELECT "
+        "   first, pref_len "
+        "FROM "
+        "   prefix_sources{ip_ver} "
+        "WHERE "
+        "   source = ?"),
+    "bulk_source_only_prefixes": (
+        "SELECT "
+        "   p.first, p.last "
+        "FROM "
+        "   bulk_prefixes{ip_ver} b"
+        "       INNER JOIN prefixes{ip_ver} p ON"
+        "           p.first = b.first AND"
+        "           p.pref_len = b.pref_len "
+        "WHERE "
+        "   p.sources = 1 AND"
+        "   p.unsourced = 0"),
+
+    # SREs.
+    "get_closest_sre_last": (
+        "SELECT "
+        "   last "
+        "FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first <= ? "
+        "ORDER BY "
+        "   first DESC "
+        "LIMIT 1"),
+    # The cnt values of the SREs of the same length are all the same, so
+    # any of them is taken and multiplied by their number.
+    "get_sres_in_totals": (
+        "SELECT "
+        "   pref_len, COUNT(*), cnt "
+        "FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first BETWEEN ? AND ? "
+        "GROUP BY "
+        "   pref_len"),
+    "get_sres_in": (
+        "SELECT "
+        "   id, first, pref_len, last, cnt "
+        "FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first BETWEEN ? AND ? "
+        "ORDER BY "
+        "   first"),
+    "delete_sres_in": (
+        "DELETE FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first BETWEEN ? AND ?"),
+    "insert_sre": (
+        "INSERT INTO "
+        "   smallest_routable_entries{ip_ver} ("
+        "       id, first, pref_len, last, cnt"
+        "   ) "
+        "VALUES "
+        "   (?, ?, ?, ?, ?)"),
+    "get_sre": (
+        "SELECT "
+        "   id, first, pref_len, last, cnt "
+        "FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first = ? AND"
+        "   last = ?"),
+    "delete_sre": (
+        "DELETE FROM "
+        "   smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "   first = ? AND"
+        "   last = ?"),
+    "get_prefixes_in": (
+        "SELECT "
+        "   id, first, pref_len, last, cnt "
+        "FROM "
+        "   prefixes{ip_ver} "
+        "WHERE "
+        "   first BETWEEN ? AND ? "
+        "ORDER BY "
+        "   first, pref_len"),
+    "get_sorted_prefixes": (
+        "SELECT "
+        "    id, first, pref_len, last, cnt "
+        "FROM "
+        "    prefixes{ip_ver} "
+        "ORDER BY "
+        "    first, pref_len"),
+    "delete_sres": (
+        "DELETE FROM "
+        "    smallest_routable_entries{ip_ver}"),
+    "get_sres_totals": (
+        "SELECT "
+        "    pref_len, COUNT(*), cnt "
+        "FROM "
+        "    smallest_routable_entries{ip_ver} "
+        "GROUP BY "
+        "    pref_len"),
+    "get_sres": (
+        "SELECT "
+        "    id, first, pref_len, last, cnt "
+        "FROM "
+        "    smallest_routable_entries{ip_ver} "
+        "ORDER BY "
+        "    id"),
+    "find_sre": (
+        "SELECT "
+        "    id, first, pref_len, last, cnt "
+        "FROM "
+        "    smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "    first <= ? "
+        "ORDER BY "
+        "    first DESC "
+        "LIMIT 1"),
+    "get_sres_page": (
+        "SELECT "
+        "    id, first, pref_len, last, cnt "
+        "FROM "
+        "    smallest_routable_entries{ip_ver} "
+        "WHERE "
+        "    first > ? AND pref_len <= ? "
+        "ORDER BY "
+        "    first "
+        "LIMIT ?"),
+    "count_prefixes": (
+        "SELECT "
+        "   COUNT(*) "
+        "FROM "
+        "   prefixes{ip_ver}"),
+}
+
+# Size of the per-connection cache of compiled statements; it must hold all
+# the statements above, for both the IP versions, plus the few shared ones.
+STATEMENT_CACHE_SIZE = 128
+
+# PRAGMAs used when the database is kept in a file (see SQLiteBackend),
+# in the order they are applied: page_size must be set before the tables
+# are created. The file is only a working store, that doesn't need to
+# survive a crash (snapshots are used for that) nor to be read by other
+# processes: it's locked exclusively, writes are not synced and the
+# rollback journal is kept in memory ("WAL" keeps it on disk, at the cost
+# of slower updates). The memory used by SQLite for its pages is bounded
+# by cache_size (in KB when negative); pages of the file are read through
+# a memory map of up to mmap_size bytes, so that the OS page cache holds
+# the hot part of the tables.
+DISK_PRAGMAS = [
+    ("page_size", 8192),
+    ("locking_mode", "EXCLUSIVE"),
+    ("journal_mode", "MEMORY"),
+    ("synchronous", "OFF"),
+    ("cache_size", -65536),
+    ("mmap_size", 1073741824),
+]
+
+
+class SQLiteBackend(Backend):
+    """SQLite database, through the apsw or sqlite3 library
+
+    By default the database is kept in memory; when db_path is given, it's
+    created in that file and tuned using DISK_PRAGMAS, whose values can be
+    overridden by db_pragmas.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, force_sqlite_lib=None, thread_safe=False,
+                 db_path=None, db_pragmas=None):
+        super(SQLiteBackend, self).__init__()
+
+        # When True, the connection can be used by threads other than
+        # the one that created it; the monitor serializes the access.
+        self.thread_safe = thread_safe
+
+        self.db_path = db_path
+        self.db_pragmas = self.get_db_pragmas(db_path, db_pragmas)
+
+        self.load_sqlite(force_sqlite_lib=force_sqlite_lib)
+
+        self.setup_db()
+
+    def load_sqlite(self, force_sqlite_lib=None):
+        """Load sqlite3/apsw library
+
+        If no hints are given, it tries the apsw library then sqlite3.
+        """
+
+        if force_sqlite_lib and force_sqlite_lib not in("sqlite3", "apsw"):
+            raise USRESMonitorException(
+                "Unknown SQLite library: {}. Must be sqlite3 or apsw".format(
+                    force_sqlite_lib
+                )
+            )
+
+        def load_sqlite3():
+            import sqlite3 as sqlite_lib
+            self.sqlite_lib = sqlite_lib
+            self.sqlite_lib_name = "sqlite3"
+            self.sqlite_version = sqlite_lib.sqlite_version
+
+        def load_apsw():
+            import apsw as sqlite_lib
+            self.sqlite_lib = sqlite_lib
+            self.sqlite_lib_name = "apsw"
+            self.sqlite_version = sqlite_lib.sqlitelibversion()
+
+        if force_sqlite_lib == "sqlite3":
+            load_sqlite3()
+        elif force_sqlite_lib == "apsw":
+            load_apsw()
+        else:
+            try:
+                load_apsw()
+            except:
+                load_sqlite3()
+
+    @staticmethod
+    def get_db_pragmas(db_path, db_pragmas):
+        """Returns: list of (name, value) of the PRAGMAs to apply
+
+        The values of DISK_PRAGMAS are overridden by those of db_pragmas,
+        a dict; only the PRAGMAs of DISK_PRAGMAS can be set.
+        """
+
+        if not db_path:
+            if db_pragmas:
+                raise USRESMonitorException(
+                    "db_pragmas can be used only with db_path"
+                )
+            return []
+
+        db_pragmas = dict(db_pragmas or {})
+        res = []
+        for name, default in DISK_PRAGMAS:
+            value = db_pragmas.pop(name, default)
+            if not str(value).lstrip("-").isalnum():
+                raise USRESMonitorException(
+                    "Invalid value for PRAGMA {}: {}".format(name, value)
+                )
+            res.append((name, value))
+        if db_pragmas:
+            raise USRESMonitorException(
+                "Unknown PRAGMA: {}. Must be one of {}".format(
+                    ", ".join(sorted(db_pragmas)),
+                    ", ".join(name for name, _ in DISK_PRAGMAS)
+                )
+            )
+        return res
+
+    def sql_out(self, sql, args=()):
+        return self.cur.execute(sql, args)
+
+    def setup_db(self):
+        if self.db_path:
+            # The content of the file would not match the counters kept
+            # by the monitor: load_snapshot() must be used to restore it.
+            if os.path.exists(self.db_path):
+                raise USRESMonitorException(
+                    "The database file {} already exists".format(
+                        self.db_path
+                    )
+                )
+
+        # With sqlite3, the connection is set in autocommit mode (the
+        # same behaviour of apsw); transactions are explicitly opened by
+        # add_nets() and del_nets().
+        con = self._connect(self.db_path or ":memory:")
+
+        self.con = con
+        self.cur = con.cursor()
+
+        for name, value in self.db_pragmas:
+            self.sql_out("PRAGMA {}={}".format(name, value)).fetchall()
+
+        self.statements = {}
+
+        for ip_ver in [4, 6]:
+            self.statements[ip_ver] = dict(
+                (name, sql.format(ip_ver=ip_ver))
+                for name, sql in STATEMENTS.items()
+            )
+
+            # See _pack_addr() for the type of the IPv6 values.
+            val_type = "INTEGER" if ip_ver == 4 else "BLOB"
+
+            # unsourced: 1 if the prefix has been added without a source;
+            # sources: number of sources that added it.
+            sql = ("CREATE TABLE"
+                "    prefixes{ip_ver} ("
+                "        id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                "        first {val_type},"
+                "        pref_len INTEGER,"
+                "        last {val_type},"
+                "        cnt {val_type},"
+                "        unsourced INTEGER DEFAULT 1,"
+                "        sources INTEGER DEFAULT 0"
+                "    )".format(ip_ver=ip_ver, val_type=val_type))
+            self.sql_out(sql)
+
+            sql = ("CREATE UNIQUE INDEX"
+                "    prefixes{ip_ver}_pk ON"
+                "    prefixes{ip_ver} ("
+                "        first,"
+                "        pref_len"
+                "    )".format(ip_ver=ip_ver))
+            self.sql_out(sql)
+
+            sql = ("CREATE TABLE"
+                "    smallest_routable_entries{ip_ver} ("
+                "        id INTEGER,"
+                "        first {val_type},"
+                "        pref_len INTEGER,"
+                "        last {val_type},"
+                "        cnt {val_type}"
+                "    )".format(ip_ver=ip_ver, val_type=val_type))
+            self.sql_out(sql)
+
+            sql = ("CREATE UNIQUE INDEX"
+                "    smallest_routable_entries{ip_ver}_ok ON"
+                "    smallest_routable_entries{ip_ver} ("
+                "        first,"
+                "        last"
+                "    )".format(ip_ver=ip_ver))
+            self.sql_out(sql)
+
+            # Prefixes added by each source.
+            sql = ("CREATE TABLE"
+                "    prefix_sources{ip_ver} ("
+                "        source,"
+                "        first {val_type},"
+                "        pref_len INTEGER"
+                "    )".format(ip_ver=ip_ver, val_type=val_type))
+            self.sql_out(sql)
+
+            sql = ("CREATE UNIQUE INDEX"
+                "    prefix_sources{ip_ver}_pk ON"
+                "    prefix_sources{ip_ver} ("
+                "        source,"
+                "        first,"
+                "        pref_len"
+                "    )".format(ip_ver=ip_ver))
+            self.sql_out(sql)
+
+            # Used by add_nets() and del_nets() to process batches of
+            # prefixes with set-based queries.
+            sql = ("CREATE TEMP TABLE"
+                "    bulk_prefixes{ip_ver} ("
+                "        first {val_type},"
+                "        pref_len INTEGER,"
+                "        last {val_type},"
+                "        cnt {val_type}"
+                "    )".format(ip_ver=ip_ver, val_type=val_type))
+            self.sql_out(sql)
+
+        # Info about the monitor, saved in snapshots.
+        sql = ("CREATE TABLE"
+            "    snapshot_info ("
+            "        info TEXT"
+            "    )")
+        self.sql_out(sql)
+
+    def _connect(self, path):
+        try:
+            # sqlite3
+            con = self.sqlite_lib.connect(
+                path, check_same_thread=not self.thread_safe,
+                cached_statements=STATEMENT_CACHE_SIZE
+            )
+        except:
+            # apsw
+            con = self.sqlite_lib.Connection(
+                path, statementcachesize=STATEMENT_CACHE_SIZE
+            )
+
+        if self.sqlite_lib_name == "sqlite3":
+            con.isolation_level = None
+
+        return con
+
+    def _backup(self, dst_con, src_con):
+        """Copy src_con into dst_con using the online backup API"""
+
+        if self.sqlite_lib_name == "apsw":
+            with dst_con.backup("main", src_con, "main") as backup:
+                backup.step()
+        else:
+            src_con.backup(dst_con)
+
+    def _save_snapshot(self, path, info):
+        self.sql_out("DELETE FROM snapshot_info")
+        self.sql_out("INSERT INTO snapshot_info (info) VALUES (?)",
+                     (json.dumps(info),))
+
+        if self.sqlite_lib_name == "sqlite3" and \
+                not hasattr(self.con, "backup"):
+            # The backup API is not exposed by sqlite3 before Python 3.7.
+            self.sql_out("VACUUM INTO ?", (path,))
+            return
+
+        con = self._connect(path)
+        try:
+            self._backup(con, self.con)
+        finally:
+            con.close()
+
+    def _read_snapshot_info(self, path):
+        con = self._connect(path)
+        try:
+            rs = con.cursor().execute("SELECT info FROM snapshot_info")
+            return json.loads(rs.fetchall()[0][0])
+        except Exception as e:
+            raise USRESMonitorException(
+                "Can't read snapshot {}: {}".format(path, str(e))
+            )
+        finally:
+            con.close()
+
+    @staticmethod
+    def _get_page_size(con):
+        return con.cursor().execute("PRAGMA page_size").fetchall()[0][0]
+
+    def _load_snapshot(self, path):
+        con = self._connect(path)
+        try:
+            same_page_size = \
+                self._get_page_size(con) == self._get_page_size(self.con)
+        finally:
+            con.close()
+
+        if self.db_path or not same_page_size or \
+                (self.sqlite_lib_name == "sqlite3" and
+                 not hasattr(self.con, "backup")):
+            # The backup API is not exposed by sqlite3 before Python 3.7,
+            # it can't change the page size of a database in WAL mode and
+            # it can't restore an in-memory database from a file with a
+            # different page size: copy the content of the tables.
+            self.sql_out("ATTACH ? AS snapshot", (path,))
+            try:
+                self.begin()
+                for tbl_name in ["prefixes4", "prefixes6",
+                                 "prefix_sources4", "prefix_sources6",
+                                 "smallest_routable_entries4",
+                                 "smallest_routable_entries6",
+                                 "snapshot_info", "sqlite_sequence"]:
+                    self.sql_out("DELETE FROM main.{}".format(tbl_name))
+                    self.sql_out("INSERT INTO main.{tbl_name} "
+                                 "SELECT * FROM snapshot.{tbl_name}".format(
+                                     tbl_name=tbl_name))
+                self.commit()
+            except:
+                self.rollback()
+                raise
+            finally:
+                self.sql_out("DETACH snapshot")
+            return
+
+        con = self._connect(path)
+        try:
+            self._backup(self.con, con)
+        finally:
+            con.close()
+
+    def dump_all(self, additional_info=None):
+        import time
+        from random import randint
+        target_file = "dump-{time}_{random}.db".format(
+            time=time.strftime("%Y-%m-%d_%H%M%S"),
+            random="_{:04d}".format(randint(0, 9999))
+        )
+
+        self.sql_out("ATTACH '{}' AS target".format(target_file))
+
+        tables = ["smallest_routable_entries4", "smallest_routable_entries6",
+                  "prefixes4", "prefixes6",
+                  "prefix_sources4", "prefix_sources6"]
+        for tbl_name in tables:
+            self.sql_out("CREATE TABLE target.{tbl_name} AS "
+                    "SELECT * FROM main.{tbl_name}".format(
+                        tbl_name=tbl_name)
+            )
+
+        if additional_info:
+            with open("{}.info".format(target_file), "w") as f:
+                f.write(additional_info)
+        return target_file
+
+    def begin(self):
+        self.sql_out("BEGIN")
+
+    def commit(self):
+        self.sql_out("COMMIT")
+
+    def rollback(self):
+        self.sql_out("ROLLBACK")
+
+    def add_prefix(self, ip_ver, first, pref_len, last, cnt, source=None):
+        try:
+            return super(SQLiteBackend, self).add_prefix(
+                ip_ver, first, pref_len, last, cnt, source
+            )
+        except Exception as e:
+            self.dump_all(
+                "add_prefix {}\n"
+                "first: {}\n"
+                "pref_len: {}\n"
+                "last: {}\n"
+                "cnt: {}\n"
+                "source: {}\n"
+                "{}".format(
+                    ip_ver, first, pref_len, last, cnt, source, str(e)
+                )
+            )
+            raise
+
+    def del_prefix(self, ip_ver, first, pref_len, source=None):
+        try:
+            return super(SQLiteBackend, self).del_prefix(
+                ip_ver, first, pref_len, source
+            )
+        except Exception as e:
+            self.dump_all(
+                "del_prefix {}\n"
+                "first: {}\n"
+                "pref_len: {}\n"
+                "source: {}\n"
+                "{}".format(
+                    ip_ver, first, pref_len, source, str(e)
+                )
+            )
+            raise
+
+    def flush_source(self, ip_ver, source):
+        try:
+            return super(SQLiteBackend, self).flush_source(ip_ver, source)
+        except Exception as e:
+            self.dump_all(
+                "flush_source {}\n"
+                "source: {}\n"
+                "{}".format(
+                    ip_ver, source, str(e)
+                )
+            )
+            raise
+
+    @staticmethod
+    def _is_unique_error(e):
+        return "UNIQUE constraint failed" in str(e) or \
+            "are not unique" in str(e)
+
+    def _get_changes(self):
+        return self.sql_out("SELECT changes()").fetchall()[0][0]
+
+    def _get_last_insert_rowid(self):
+        if self.sqlite_lib_name == "apsw":
+            return self.con.last_insert_rowid()
+        return self.cur.lastrowid
+
+    def _insert_prefix(self, ip_ver, first, pref_len, last, cnt, source):
+        sql = self.statements[ip_ver]
+
+        if ip_ver == 6:
+            first, last, cnt = _pack_addr(first), _pack_addr(last), \
+                _pack_cnt(cnt)
+
+        if source is not None:
+            try:
+                self.sql_out(sql["insert_prefix_source"],
+                             (source, first, pref_len))
+            except Exception as e:
+                if self._is_unique_error(e):
+                    return False, None
+                raise
+
+        try:
+            if source is None:
+                self.sql_out(sql["insert_prefix"],
+                             (first, pref_len, last, cnt))
+            else:
+                self.sql_out(sql["insert_sourced_prefix"],
+                             (first, pref_len, last, cnt))
+        except Exception as e:
+            if not self._is_unique_error(e):
+                raise
+
+            # Already present: add the reference.
+            if source is None:
+                self.sql_out(sql["set_unsourced"], (first, pref_len))
+                return self._get_changes() > 0, None
+
+            self.sql_out(sql["add_source_ref"], (first, pref_len))
+            return True, None
+
+        return True, self._get_last_insert_rowid()
+
+    def _delete_prefix(self, ip_ver, first, pref_len, source):
+        sql = self.statements[ip_ver]
+
+        if ip_ver == 6:
+            first = _pack_addr(first)
+
+        if source is not None:
+            self.sql_out(sql["delete_prefix_source"],
+                         (source, first, pref_len))
+            if not self._get_changes():
+                return False, None
+
+        rs = self.sql_out(sql["get_prefix_refs"],
+                          (first, pref_len)).fetchall()
+        if not rs:
+            return False, None
+        last, unsourced, sources = rs[0]
+
+        if source is None:
+            if not unsourced:
+                return False, None
+            if sources:
+                # Still referenced by some sources.
+                self.sql_out(sql["unset_unsourced"], (first, pref_len))
+                return True, None
+        elif sources > 1 or unsourced:
+            self.sql_out(sql["del_source_ref"], (first, pref_len))
+            return True, None
+
+        self.sql_out(sql["delete_prefix"], (first, pref_len))
+        return True, _unpack_addr(last) if ip_ver == 6 else last
+
+    def _load_bulk_prefixes(self, ip_ver, rows):
+        """Replace the content of the bulk table with rows
+
+        Args:
+            rows: list of (first, pref_len, last, cnt) tuples, with IPv6
+                values already packed.
+        """
+
+        sql = self.statements[ip_ver]
+
+        self.sql_out(sql["clear_bulk"])
+        self.cur.executemany(sql["insert_bulk"], rows)
+
+    def _pop_bulk_prefixes(self, ip_ver, sql, args=()):
+        """Remove the prefixes selected by sql from the bulk table
+
+        Args:
+            sql: a query that returns the rowid, first and pref_len of
+                some rows of the bulk table, aliased as b.
+
+        Returns: list of (first, pref_len) of the rows removed.
+        """
+
+        rows = self.sql_out(sql, args).fetchall()
+        if rows:
+            self.cur.executemany(self.statements[ip_ver]["delete_bulk"],
+                                 [(row[0],) for row in rows])
+        if ip_ver == 6:
+            return [(_unpack_addr(row[1]), row[2]) for row in rows]
+        return [(row[1], row[2]) for row in rows]
+
+    def _insert_prefixes(self, ip_ver, prefixes, source):
+        """Add a batch of prefixes with set-based queries
+
+        The prefixes that are already present for the source are removed
+        from the bulk table; those that are already present for other
+        sources only get a new reference; the others are inserted.
+        """
+
+        sql = self.statements[ip_ver]
+
+        if ip_ver == 6:
+            prefixes = [(_pack_addr(first), pref_len, _pack_addr(last),
+                         _pack_cnt(cnt))
+                        for first, pref_len, last, cnt in prefixes]
+
+        try:
+            self._load_bulk_prefixes(ip_ver, prefixes)
+
+            if source is None:
+                duplicates = self._pop_bulk_prefixes(
+                    ip_ver, sql["bulk_unsourced_duplicates"]
+                )
+                self.sql_out(sql["bulk_set_unsourced"])
+                self.sql_out(sql["bulk_insert_prefixes"])
+            else:
+                duplicates = self._pop_bulk_prefixes(
+                    ip_ver, sql["bulk_source_duplicates"], (source,)
+                )
+                self.sql_out(sql["bulk_insert_prefix_sources"], (source,))
+                self.sql_out(sql["bulk_add_source_ref"])
+                self.sql_out(sql["bulk_insert_sourced_prefixes"])
+            added_cnt = self._get_changes()
+        except Exception as e:
+            self.dump_all(
+                "add_prefixes {}\n"
+                "source: {}\n"
+                "{}".format(
+                    ip_ver, source, str(e)
+                )
+            )
+            raise
+
+        return duplicates, added_cnt
+
+    def _delete_bulk_prefixes(self, ip_ver, source):
+        """Remove the references from source to the prefixes of the bulk
+        table, which must all be referenced by it
+
+        Returns: number of prefixes removed.
+        """
+
+        sql = self.statements[ip_ver]
+
+        if source is None:
+            self.sql_out(sql["bulk_delete_unsourced_prefixes"])
+            deleted_cnt = self._get_changes()
+            self.sql_out(sql["bulk_unset_unsourced"])
+        else:
+            self.sql_out(sql["bulk_delete_prefix_sources"], (source,))
+            self.sql_out(sql["bulk_delete_sourced_prefixes"])
+            deleted_cnt = self._get_changes()
+            self.sql_out(sql["bulk_del_source_ref"])
+
+        return deleted_cnt
+
+    def _delete_prefixes(self, ip_ver, keys, source):
+        sql = self.statements[ip_ver]
+
+        try:
+            if ip_ver == 6:
+                keys = [(_pack_addr(first), pref_len)
+                        for first, pref_len in keys]
+            self._load_bulk_prefixes(
+                ip_ver, [(first, pref_len, None, None)
+                         for first, pref_len in keys]
+            )
+
+            if source is None:
+                missing = self._pop_bulk_prefixes(
+                    ip_ver, sql["bulk_unsourced_missing"]
+                )
+            else:
+                missing = self._pop_bulk_prefixes(
+                    ip_ver, sql["bulk_source_missing"], (source,)
+                )
+
+            deleted_cnt = self._delete_bulk_prefixes(ip_ver, source)
+        except Exception as e:
+            self.dump_all(
+                "del_prefixes {}\n"
+                "source: {}\n"
+                "{}".format(
+                    ip_ver, source, str(e)
+                )
+            )
+            raise
+
+        return missing, deleted_cnt
+
+    def _flush_source(self, ip_ver, source):
+        """Remove all the references from source
+
+        The prefixes of the source are read from the prefix_sources{4,6}_pk
+        index into the bulk table, then they are processed with the same
+        set-based queries used by del_nets().
+        """
+
+        sql = self.statements[ip_ver]
+
+        self.sql_out(sql["clear_bulk"])
+        self.sql_out(sql["load_source_bulk"], (source,))
+        refs_cnt = self._get_changes()
+        if not refs_cnt:
+            return 0, []
+
+        deleted = self.sql_out(sql["bulk_source_only_prefixes"]).fetchall()
+        if ip_ver == 6:
+            deleted = [(_unpack_addr(first), _unpack_addr(last))
+                       for first, last in deleted]
+
+        self._delete_bulk_prefixes(ip_ver, source)
+        return refs_cnt, deleted
+
+    def _get_totals(self, ip_ver, rows):
+        """Get (pref_len, number of SREs, sum of their cnt) tuples from
+        the rows of the get_sres_in_totals and get_sres_totals queries
+        """
+
+        if ip_ver == 6:
+            return [(pref_len, sres_cnt, sres_cnt * _unpack_cnt(cnt))
+                    for pref_len, sres_cnt, cnt in rows]
+        return [(pref_len, sres_cnt, sres_cnt * cnt)
+                for pref_len, sres_cnt, cnt in rows]
+
+    def _add_sre(self, ip_ver, prefix_id, first, pref_len, last, cnt):
+        """Update the SREs table after a prefix has been added
+
+        Since prefixes can only be nested or disjoint, the SREs table
+        contains non-overlapping ranges. The new prefix is added only if
+        it's not already covered by the closest SRE that starts at or
+        before its first address; in that case, the SREs that it covers
+        are removed.
+        """
+
+        sql = self.statements[ip_ver]
+
+        record = (prefix_id, first, pref_len, last, cnt)
+        if ip_ver == 6:
+            first, last, cnt = _pack_addr(first), _pack_addr(last), \
+                _pack_cnt(cnt)
+
+        rs = self.sql_out(sql["get_closest_sre_last"], (first,)).fetchall()
+        if rs and rs[0][0] >= last:
+            return
+
+        covered = self._get_totals(
+            ip_ver,
+            self.sql_out(sql["get_sres_in_totals"], (first, last)).fetchall()
+        )
+
+        if self._journal[ip_ver] is not None:
+            covered_records = self.sql_out(sql["get_sres_in"],
+                                           (first, last)).fetchall()
+            if ip_ver == 6:
+                covered_records = map(_unpack_record, covered_records)
+
+        self.sql_out(sql["delete_sres_in"], (first, last))
+
+        self.sql_out(sql["insert_sre"],
+                     (prefix_id, first, pref_len, last, cnt))
+
+        for covered_len, covered_sres, covered_cnt in covered:
+            self._update_sre_cnt(ip_ver, covered_len,
+                                 -covered_sres, -covered_cnt)
+        self._update_sre_cnt(ip_ver, pref_len, 1, record[4])
+
+        if self._journal[ip_ver] is not None:
+            for covered_record in covered_records:
+                self._log_sre(ip_ver, tuple(covered_record), -1)
+            self._log_sre(ip_ver, record, 1)
+
+    def _del_sre(self, ip_ver, first, last):
+        """Update the SREs table after a prefix has been removed
+
+        If the prefix was a SRE, the ranges that it was covering are
+        uncovered: the prefixes that fall within its range are scanned in
+        (first, pref_len) order and only those that are not covered by a
+        previous one are promoted to SREs.
+        """
+
+        sql = self.statements[ip_ver]
+
+        if ip_ver == 6:
+            first, last = _pack_addr(first), _pack_addr(last)
+
+        rs = self.sql_out(sql["get_sre"], (first, last)).fetchall()
+        if not rs:
+            return
+        record = _unpack_record(rs[0]) if ip_ver == 6 else tuple(rs[0])
+        self._update_sre_cnt(ip_ver, record[2], -1, -record[4])
+        if self._journal[ip_ver] is not None:
+            self._log_sre(ip_ver, record, -1)
+
+        self.sql_out(sql["delete_sre"], (first, last))
+
+        rs = self.sql_out(sql["get_prefixes_in"], (first, last)).fetchall()
+
+        # Packed IPv6 values compare as the integers they represent.
+        uncovered = list(iter_uncovered(rs))
+        if uncovered:
+            self.cur.executemany(sql["insert_sre"], uncovered)
+
+        for record in uncovered:
+            if ip_ver == 6:
+                record = _unpack_record(record)
+            self._update_sre_cnt(ip_ver, record[2], 1, record[4])
+            if self._journal[ip_ver] is not None:
+                self._log_sre(ip_ver, tuple(record), 1)
+
+    def _populate(self, ip_ver):
+        """Rebuild the SREs table with a single sweep over the prefixes
+
+        Prefixes are read in (first, pref_len) order, that is the order of
+        the prefixes{4,6}_pk index, so no sorting is needed; each one is
+        a SRE if it's not covered by the previous SRE (see
+        iter_uncovered()). The whole rebuild is O(n).
+        """
+
+        sql = self.statements[ip_ver]
+
+        self.sql_out("SAVEPOINT populate")
+        try:
+            self.sql_out(sql["delete_sres"])
+
+            self.cur.executemany(sql["insert_sre"],
+                                 iter_uncovered(
+                                     self.con.cursor().execute(
+                                         sql["get_sorted_prefixes"]
+                                     )
+                                 ))
+
+            self.sql_out("RELEASE populate")
+        except Exception as e:
+            self.sql_out("ROLLBACK TO populate")
+            self.sql_out("RELEASE populate")
+            self.dump_all(
+                "_populate_smallest_routable_entries {}\n"
+                "{}".format(
+                    ip_ver, str(e)
+                )
+            )
+            raise
+
+        return self._get_totals(
+            ip_ver, self.sql_out(sql["get_sres_totals"]).fetchall()
+        )
+
+    def _iter_sres(self, ip_ver):
+        # Rows are read by iterating the cursor, that is done by the SQLite
+        # library (fetchmany() isn't available with apsw); the cursor is
+        # not the shared one, so other queries can run in the meantime.
+        rows = self.con.cursor().execute(self.statements[ip_ver]["get_sres"])
+        if ip_ver == 6:
+            return (_unpack_record(row) for row in rows)
+        return iter(rows)
+
+    # Lookups run on their own cursor, so that they can be called while
+    # the SREs are being iterated; both use the first column of the
+    # smallest_routable_entries{4,6}_ok index.
+
+    def _find_sre(self, ip_ver, key):
+        if ip_ver == 6:
+            key = _pack_addr(key)
+        row = self.con.cursor().execute(
+            self.statements[ip_ver]["find_sre"], (key,)
+        ).fetchone()
+        if row is not None and ip_ver == 6:
+            return _unpack_record(row)
+        return row
+
+    def _get_sres_in(self, ip_ver, first, last):
+        if ip_ver == 6:
+            first, last = _pack_addr(first), _pack_addr(last)
+        rows = self.con.cursor().execute(
+            self.statements[ip_ver]["get_sres_in"],
+            (first, last)
+        ).fetchall()
+        if ip_ver == 6:
+            return [_unpack_record(row) for row in rows]
+        return rows
+
+    def _get_sre_lens_in(self, ip_ver, first, last):
+        # Aggregated by SQLite while scanning the index of the SREs.
+        if ip_ver == 6:
+            first, last = _pack_addr(first), _pack_addr(last)
+        rows = self.con.cursor().execute(
+            self.statements[ip_ver]["get_sres_in_totals"],
+            (first, last)
+        ).fetchall()
+        return dict((pref_len, sres_cnt) for pref_len, sres_cnt, _ in rows)
+
+    def _get_sres_page(self, ip_ver, after, limit, max_pref_len):
+        if ip_ver == 6:
+            # The empty BLOB sorts before any other one.
+            after = _pack_addr(after) if after >= 0 else _blob(b"")
+        rows = self.con.cursor().execute(
+            self.statements[ip_ver]["get_sres_page"],
+            (after, max_pref_len, limit)
+        ).fetchall()
+        if ip_ver == 6:
+            return [_unpack_record(row) for row in rows]
+        return rows
+
+    def _get_prefixes_cnt(self, ip_ver):
+        # On its own cursor, so that it can be called while the SREs are
+        # being iterated.
+        return self.con.cursor().execute(
+            self.statements[ip_ver]["count_prefixes"]
+        ).fetchall()[0][0]
@@ -63,6 +63,9 @@ setup(
     maintainer_email="pierky@pierky.com",
 
     install_requires=install_requires,
+    extras_require={
+        "numpy": ["numpy"]
+    },
 
     keywords=['BGP', 'IP Routing'],
 
@@ -82,6 +85,7 @@ setup(
 
         "Programming Language :: Python",
         "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
 
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: System :: Networking",
@@ -16,10 +16,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ipaddr
-import itertools
+import json
 import random
 import struct
-import time
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
 
 from pierky.usres_monitor import UniqueSmallestRoutableEntriesMonitor, \
                                  USRESMonitorException
@@ -31,13 +41,16 @@ def new_usres(ip_ver, target_prefix_len):
     usres_monitor = UniqueSmallestRoutableEntriesMonitor(
         target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
         target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
-        force_sqlite_lib=sqlite_lib
+        force_sqlite_lib=sqlite_lib,
+        backend=backend
     )
 
 def test_outcome(func, descr, result):
     print("{:<15}: {:>40}: {}".format(func, descr, result))
 
 def print_rs(sql):
+    if usres_monitor.backend.name != "sqlite":
+        return
     rs = usres_monitor.sql_out(sql).fetchall()
     for r in rs:
         print(r)
@@ -149,7 +162,7 @@ def test_sre(prefixes, exp_results, clear=True,
 
     try:
         # match records with expected results
-        for record, exp_res in itertools.izip_longest(records, exp_results):
+        for record, exp_res in zip_longest(records, exp_results):
             assert exp_res is not None, \
                 "Missing expected result for this record:"
             assert record["first_ip"] == exp_res[0], \
@@ -167,6 +180,10 @@ def test_sre(prefixes, exp_results, clear=True,
         print_rs("SELECT * FROM prefixes{ip_ver}".format(ip_ver=ip_ver))
         raise AssertionError("Record ID {} - {}".format(record["id"], str(e)))
 
+    assert usres_monitor.get_count(ip_ver) == \
+        sum([record["cnt"] for record in records]), \
+        "The running count doesn't match the SREs"
+
     if not print_details:
         print(" \-- details omitted")
     test_outcome("test_sre", "", "OK")
@@ -194,16 +211,14 @@ def add_random_net(ip_ver, target_prefix_len):
         net_class = ipaddr.IPv4Network
     else:
         prefix_len = random.randint(19, target_prefix_len-1)
-        max_range_len = prefix_len - 1 # to avoid overflow
-        max_prefix_len = 64
+        max_range_len = prefix_len
+        max_prefix_len = 128
         ip_class = ipaddr.IPv6Address
         net_class = ipaddr.IPv6Network
 
     max_range = 2**max_range_len - 1
     rand = random.randint(0, max_range)
     net_id = rand << max_prefix_len - prefix_len
-    if ip_ver == 6:
-        net_id = net_id << 64
     ip = ip_class(net_id)
     net = net_class("{}/{}".format(str(ip), prefix_len))
 
@@ -227,25 +242,1402 @@ def test_random_load(ip_ver, prefix_cnt, target_prefix_len):
     new_usres(ip_ver, target_prefix_len)
     res = {"dup": 0, "ok": 0}
 
-    add_begin = int(time.time())
     for i in range(prefix_cnt):
         dup_ok, net = add_random_net(ip_ver, target_prefix_len)
         res[dup_ok] += 1
         if i % 10 == 0:
             usres_monitor.del_net(net)
 
-    add_end = int(time.time())
-
-    qry_begin = int(time.time())
     cnt = usres_monitor.get_count(ip_ver)
-    qry_end = int(time.time())
+
+    # the incrementally maintained SREs must match a full rebuild
+    records = list(usres_monitor.get_prefixes(ip_ver))
+    assert cnt == sum([record["cnt"] for record in records]), \
+        "Running count doesn't match the SREs"
+    usres_monitor._populate_smallest_routable_entries(ip_ver)
+    assert usres_monitor.get_count(ip_ver) == cnt, \
+        "Incremental count doesn't match the full rebuild"
+    assert list(usres_monitor.get_prefixes(ip_ver)) == records, \
+        "Incremental SREs don't match the full rebuild"
 
     test_outcome("random_load",
                  "{} IPv{} prefixes, /{}".format(
                      prefix_cnt, ip_ver, target_prefix_len),
-                 "OK ({} duplicate, {} SREs, add/del {}s, qry {}s)".format(
-                     res["dup"], cnt, add_end-add_begin, qry_end-qry_begin)
-                 )
+                 "OK ({} duplicate, {} SREs)".format(res["dup"], cnt))
+
+def test_bulk():
+    new_usres(4, 24)
+    usres_monitor.add_net("10.0.0.0/8")
+    res = usres_monitor.add_nets(["10.0.0.0/8", "192.168.0.0/16",
+                                  "192.168.0.0/24", "192.168.0.0/24",
+                                  "192.0.2.0/25", "2001:db8::/32",
+                                  "not a prefix"])
+    assert res.processed == 3, "Unexpected processed: {}".format(res)
+    assert res.duplicates == ["192.168.0.0/24", "10.0.0.0/8"], \
+        "Unexpected duplicates: {}".format(res.duplicates)
+    assert [net for net, _ in res.invalid] == \
+        ["192.0.2.0/25", "not a prefix"], \
+        "Unexpected invalid: {}".format(res.invalid)
+    assert usres_monitor.get_count(4) == 65536 + 256
+    assert usres_monitor.get_count(6) == 2**8
+
+    res = usres_monitor.del_nets(["10.0.0.0/8", "172.16.0.0/12"])
+    assert res.processed == 1, "Unexpected processed: {}".format(res)
+    assert res.missing == ["172.16.0.0/12"], \
+        "Unexpected missing: {}".format(res.missing)
+    assert [record["first_ip"] for record in
+            usres_monitor.get_prefixes(4)] == ["192.168.0.0"]
+
+    # repeats are reported the same way, whatever the batch boundaries
+    for batch_size in (1, 2, 10000):
+        new_usres(4, 24)
+        usres_monitor.add_nets(["10.0.0.0/8", "192.168.0.0/16"])
+        res = usres_monitor.add_nets(["172.16.0.0/12", "10.0.0.0/8",
+                                      "172.16.0.0/12"],
+                                     batch_size=batch_size)
+        assert res.processed == 1
+        assert sorted(res.duplicates) == ["10.0.0.0/8", "172.16.0.0/12"], \
+            "Unexpected duplicates: {}".format(res.duplicates)
+        res = usres_monitor.del_nets(["10.0.0.0/8", "192.0.2.0/24",
+                                      "10.0.0.0/8", "192.0.2.0/24"],
+                                     batch_size=batch_size)
+        assert res.processed == 1
+        assert res.missing == ["192.0.2.0/24"], \
+            "Unexpected missing: {}".format(res.missing)
+        assert res.duplicates == ["10.0.0.0/8", "192.0.2.0/24"], \
+            "Unexpected duplicates: {}".format(res.duplicates)
+    new_usres(4, 24)
+    usres_monitor.add_nets(["192.168.0.0/16"])
+    assert [record["first_ip"] for record in
+            usres_monitor.get_prefixes(4)] == ["192.168.0.0"]
+
+    # once rebuilt, the SREs table is kept up to date incrementally again
+    generation = usres_monitor.get_generation(4)
+    usres_monitor.add_net("192.0.0.0/8")
+    assert usres_monitor.get_count(4) == 65536
+    assert usres_monitor.get_generation(4) == generation + 1
+
+    # no changes, no new generation
+    usres_monitor.del_net("172.16.0.0/12")
+    usres_monitor.del_nets(["172.16.0.0/12"])
+    assert usres_monitor.get_generation(4) == generation + 1
+
+    test_outcome("test_bulk", "add_nets/del_nets", "OK")
+
+    # bulk and single loads must give the same results
+    random.seed(1)
+    new_usres(4, 24)
+    nets = [add_random_net(4, 24)[1] for i in range(5000)]
+    records = list(usres_monitor.get_prefixes(4))
+    new_usres(4, 24)
+    res = usres_monitor.add_nets(nets, batch_size=1000)
+    assert res.processed + len(res.duplicates) == len(nets)
+    assert list(usres_monitor.get_prefixes(4)) == records, \
+        "Bulk and single loads don't match"
+
+    test_outcome("test_bulk", "5000 IPv4 prefixes, /24", "OK")
+
+def test_parse_net():
+    # the fast parser must agree with ipaddr
+    m = UniqueSmallestRoutableEntriesMonitor
+    nets = ["1.2.3.4/8", "0.0.0.0/0", "255.255.255.255/32", "10.0.0.1",
+            "2001:db8::1/32", "::/0", "::ffff:1.2.3.4/96", "2001:db8::/64",
+            "7fff:ffff:ffff:ffff::/64", "2001:DB8:0:0:1::/80", "fe80::1"]
+    random.seed(2)
+    for i in range(1000):
+        nets.append("{}/{}".format(
+            ipaddr.IPAddress(random.getrandbits(32), version=4),
+            random.randint(0, 32)))
+        nets.append("{}/{}".format(
+            ipaddr.IPAddress(random.getrandbits(128), version=6),
+            random.randint(0, 128)))
+    for net_str in nets:
+        net = ipaddr.IPNetwork(net_str)
+        exp = (net.version, m.get_first(net), net.prefixlen)
+        assert m.parse_net_str(net_str) == exp, \
+            "Unexpected result for {}: {}".format(
+                net_str, m.parse_net_str(net_str))
+        assert m.parse_net(net) == exp
+
+    # formats only ipaddr understands are parsed by it
+    assert m.parse_net_str("10.0.0.0/255.0.0.0") is None
+    assert m.parse_net("10.0.0.0/255.0.0.0") == (4, 10 << 24, 8)
+    for net_str in ("1.2.3.4/33", "2001:db8::/129", "1.2.3/24", "x/8",
+                    "1.2.3.4/-1", "10.0.0.0/ 24", "10.0.0.0/+24",
+                    "10.0.0.0/24 ", "10.0.0.0/", "2001:db8::/ 32"):
+        assert m.parse_net_str(net_str) is None, net_str
+        try:
+            m.parse_net(net_str)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Invalid prefix accepted: {}".format(
+                net_str))
+
+    test_outcome("parse_net", "{} prefixes".format(len(nets)), "OK")
+
+def test_net_int():
+    new_usres(4, 24)
+    usres_monitor.add_net_int(4, 10 << 24, 8)
+    usres_monitor.add_net_int(6, 0x20010db8 << 96, 32)
+    usres_monitor.add_net("10.0.0.0/16")
+    try:
+        usres_monitor.add_net_int(4, 10 << 24, 16)
+        raise AssertionError("Duplicate not detected")
+    except USRESMonitorException as e:
+        assert "10.0.0.0/16" in str(e), str(e)
+    assert [(r["first_ip"], r["pref_len"]) for r in
+            usres_monitor.get_prefixes(4)] == [("10.0.0.0", 8)]
+    assert [(r["first_ip"], r["pref_len"]) for r in
+            usres_monitor.get_prefixes(6)] == [("2001:db8::", 32)]
+
+    assert usres_monitor.del_net_int(4, 10 << 24, 8)
+    assert not usres_monitor.del_net("10.0.0.0/8")
+    assert usres_monitor.del_net("10.0.0.0/16")
+    usres_monitor.add_net("10.0.0.0/16")
+    assert usres_monitor.del_net_int(6, 0x20010db8 << 96, 32)
+    assert not usres_monitor.del_net_int(6, 0x20010db8 << 96, 32)
+    assert usres_monitor.get_count(4) == 256
+    assert usres_monitor.get_count(6) == 0
+
+    prefixes = [(4, 192 << 24, 8), (6, 0x20010db8 << 96, 32),
+                (4, 10 << 24, 16), (4, 192 << 24, 8), (5, 0, 8),
+                (4, 0xC0000200, 25)]
+    res = usres_monitor.add_nets_int(prefixes)
+    assert res.processed == 2
+    assert sorted(res.duplicates) == [(4, 10 << 24, 16), (4, 192 << 24, 8)]
+    assert [prefix for prefix, err in res.invalid] == prefixes[-2:]
+    assert usres_monitor.get_count(4) == 65536 + 256
+    res = usres_monitor.del_nets_int(prefixes[:2] + [(4, 172 << 24, 12)])
+    assert res.processed == 2 and res.missing == [(4, 172 << 24, 12)]
+    assert usres_monitor.get_count(4) == 256
+    assert usres_monitor.get_count(6) == 0
+
+    test_outcome("net_int", "add_net_int/del_net_int", "OK")
+
+def test_ipv6_128():
+    # the whole IPv6 address space, with target prefix lengths up to /128
+    import os
+    import shutil
+    import tempfile
+    global usres_monitor
+
+    usres_monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len6=[64, 128],
+        force_sqlite_lib=sqlite_lib,
+        backend=backend
+    )
+    monitor = usres_monitor
+    monitor.get_changes(6)
+    monitor.add_nets(["8000::/1", "ffff::/16", "2001:db8::/127",
+                      "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128"])
+    monitor.add_net("2001:db8::1/128", source="peer")
+    sres = [
+        (0x20010db8 << 96, 127, (0x20010db8 << 96) + 1, 2),
+        (1 << 127, 1, 2**128 - 1, 2**127)
+    ]
+
+    def check(exp, cnt64):
+        assert sorted(r[1:] for r in monitor.get_prefixes(6, raw=True)) == \
+            exp, list(monitor.get_prefixes(6, raw=True))
+        assert monitor.get_count(6) == sum([r[3] for r in exp])
+        assert monitor.get_count(6, 64) == cnt64
+        monitor._populate_smallest_routable_entries(6)
+        assert sorted(r[1:] for r in monitor.get_prefixes(6, raw=True)) == \
+            exp
+        assert monitor.get_count(6) == sum([r[3] for r in exp])
+
+    check(sres, 2**63)
+    assert [r["last_ip"] for r in monitor.get_prefixes_page(6)] == \
+        ["2001:db8::1", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"]
+    assert [r["first_ip"] for r in monitor.get_prefixes_page(
+        6, after=0x20010db8 << 96)] == ["8000::"]
+    assert monitor.covering_prefix("ffff::1")["first_ip"] == "8000::"
+    assert monitor.is_covered("2001:db8::1")
+    assert not monitor.is_covered("2001:db8::2")
+    assert monitor.count_in("8000::/2") == 2**126
+    assert monitor.count_in("2001:db8::/32") == 2
+    assert monitor.count_in("2001:db8::/32", 64) == 0
+
+    monitor.add_net("::/0")
+    check([(0, 0, 2**128 - 1, 2**128)], 2**64)
+    changes = monitor.get_changes(6)
+    assert [r["first_ip"] for r in changes.added] == ["::"]
+    assert changes.cnt == 2**128
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "snapshot")
+    try:
+        monitor.save_snapshot(path)
+        monitor.del_net("::/0")
+        check(sres, 2**63)
+        monitor.load_snapshot(path)
+        check([(0, 0, 2**128 - 1, 2**128)], 2**64)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    monitor.del_nets(["::/0", "8000::/1"])
+    assert monitor.flush_source("peer") == 1
+    check([(0x20010db8 << 96, 127, (0x20010db8 << 96) + 1, 2),
+           (0xffff << 112, 16, (0xffff << 112) + 2**112 - 1, 2**112)],
+          2**48)
+
+    test_outcome("ipv6_128", "full address space, /128", "OK")
+
+def test_target_lens(ip_ver, prefix_cnt, target_prefix_lens):
+    # a monitor with many target prefix lengths must give the same results
+    # of one monitor for each of them
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_lens)
+    nets = set()
+    for i in range(prefix_cnt):
+        nets.add(add_random_net(ip_ver, max(target_prefix_lens))[1])
+        if i % 3 == 0:
+            net = random.choice(sorted(nets))
+            usres_monitor.del_net(net)
+            nets.remove(net)
+    multi_monitor = usres_monitor
+
+    # a bulk load of the same prefixes
+    new_usres(ip_ver, target_prefix_lens)
+    usres_monitor.add_nets(sorted(nets))
+    bulk_monitor = usres_monitor
+
+    def get_sres(monitor, target_prefix_len=None):
+        return sorted([
+            (r["first_int"], r["pref_len"], r["last_int"], r["cnt"])
+            for r in monitor.get_prefixes(ip_ver, target_prefix_len)
+        ])
+
+    for target_prefix_len in target_prefix_lens:
+        new_usres(ip_ver, target_prefix_len)
+        usres_monitor.add_nets([net for net in nets
+                                if net.prefixlen <= target_prefix_len])
+        exp_cnt = usres_monitor.get_count(ip_ver)
+        exp_sres = get_sres(usres_monitor)
+
+        for monitor in [multi_monitor, bulk_monitor]:
+            assert monitor.get_count(ip_ver, target_prefix_len) == \
+                exp_cnt, "Counts for /{} don't match".format(
+                    target_prefix_len)
+            assert monitor.get_counts(ip_ver)[target_prefix_len] == exp_cnt
+            assert get_sres(monitor, target_prefix_len) == exp_sres, \
+                "SREs for /{} don't match".format(target_prefix_len)
+
+    assert multi_monitor.get_count(ip_ver) == \
+        multi_monitor.get_count(ip_ver, max(target_prefix_lens))
+
+    try:
+        multi_monitor.get_count(ip_ver, max(target_prefix_lens) + 1)
+        raise AssertionError("Unknown target prefix length not detected")
+    except USRESMonitorException:
+        pass
+
+    test_outcome("target_lens",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver,
+                     ", /".join(map(str, target_prefix_lens))),
+                 "OK")
+
+def test_batch(ip_ver, prefix_cnt, target_prefix_len):
+    # BatchSREs must give the same results of a monitor
+    from pierky.usres_monitor.batch import BatchSREs
+
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_len)
+    nets = [add_random_net(ip_ver, target_prefix_len)[1]
+            for i in range(prefix_cnt)]
+    exp_cnt = usres_monitor.get_count(ip_ver)
+
+    # add_nets() gives the IDs in the same way of BatchSREs
+    new_usres(ip_ver, target_prefix_len)
+    usres_monitor.add_nets(nets)
+    sres = BatchSREs.from_nets(
+        nets,
+        target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+        target_prefix_len6=target_prefix_len if ip_ver == 6 else 40
+    )[ip_ver]
+
+    assert sres.get_count() == exp_cnt, \
+        "Unexpected count: {}".format(sres.get_count())
+    assert list(sres.get_prefixes()) == \
+        list(usres_monitor.get_prefixes(ip_ver)), "Results don't match"
+
+    test_outcome("batch",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_parallel(ip_ver, prefix_cnt, target_prefix_len):
+    # ShardedSREs must give the same results of a monitor, also when
+    # prefixes span many shards
+    from pierky.usres_monitor.parallel import ShardedSREs
+
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_len)
+    nets = [str(add_random_net(ip_ver, target_prefix_len)[1])
+            for i in range(prefix_cnt)]
+    if ip_ver == 4:
+        nets += ["10.0.0.0/7", "10.0.0.0/7", "128.0.0.0/2"]
+    else:
+        nets += ["2000::/7", "6000::/3"]
+    random.shuffle(nets)
+
+    new_usres(ip_ver, target_prefix_len)
+    usres_monitor.add_nets(nets)
+    exp_records = list(usres_monitor.get_prefixes(ip_ver))
+
+    for processes, shard_bits, chunk_size in [(1, 8, 50000), (2, 4, 1000),
+                                              (2, 16, 333)]:
+        sres = ShardedSREs.from_nets(
+            iter(nets),
+            target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+            target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+            processes=processes, shard_bits=shard_bits,
+            chunk_size=chunk_size
+        )[ip_ver]
+        assert sres.get_count() == usres_monitor.get_count(ip_ver), \
+            "Unexpected count: {}".format(sres.get_count())
+        assert list(sres.get_prefixes()) == exp_records, \
+            "Results don't match"
+
+    # IDs are counted separately for each family, also when IPv4 and
+    # IPv6 prefixes are mixed in the input
+    other_ip_ver = 6 if ip_ver == 4 else 4
+    other_target_prefix_len = 24 if other_ip_ver == 4 else 40
+    other_nets = [str(add_random_net(other_ip_ver,
+                                     other_target_prefix_len)[1])
+                  for i in range(prefix_cnt // 10)]
+    mixed_nets = nets + other_nets + nets[:prefix_cnt // 10]
+    random.shuffle(mixed_nets)
+
+    new_usres(ip_ver, target_prefix_len)
+    usres_monitor.add_nets(mixed_nets)
+    for processes, shard_bits, chunk_size in [(1, 8, 50000), (2, 4, 333)]:
+        sres = ShardedSREs.from_nets(
+            iter(mixed_nets),
+            target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+            target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+            processes=processes, shard_bits=shard_bits,
+            chunk_size=chunk_size
+        )
+        for v in [4, 6]:
+            assert list(sres[v].get_prefixes()) == \
+                list(usres_monitor.get_prefixes(v)), \
+                "Results don't match with mixed families"
+
+    sres = ShardedSREs.from_nets(
+        ["10.0.0.0/24", "2001:db8::/32", "11.0.0.0/24", "2001:db9::/32",
+         "10.0.0.0/24"],
+        processes=1, chunk_size=2
+    )
+    assert [r["id"] for r in sres[4].get_prefixes()] == [1, 2]
+    assert [r["id"] for r in sres[6].get_prefixes()] == [1, 2]
+
+    test_outcome("parallel",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_threads(ip_ver, prefix_cnt, target_prefix_len):
+    # readers iterate over consistent SREs while a writer updates them
+    import threading
+    global usres_monitor
+
+    usres_monitor = UniqueSmallestRoutableEntriesMonitor(
+        target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+        target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+        force_sqlite_lib=sqlite_lib,
+        backend=backend,
+        thread_safe=True
+    )
+    monitor = usres_monitor
+    errors = []
+    done = threading.Event()
+
+    def write():
+        try:
+            random.seed(prefix_cnt)
+            nets = []
+            for i in range(prefix_cnt):
+                nets.append(add_random_net(ip_ver, target_prefix_len)[1])
+                if i % 3 == 0:
+                    monitor.del_net(nets.pop(random.randrange(len(nets))))
+                if i % 500 == 0:
+                    monitor.del_nets(nets[-100:])
+                    monitor.add_nets(nets[-100:])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    def read():
+        try:
+            while not done.is_set():
+                records = list(monitor.get_prefixes(ip_ver))
+                assert [r["id"] for r in records] == \
+                    sorted([r["id"] for r in records])
+                records.sort(key=lambda r: r["first_int"])
+                for prev, record in zip(records, records[1:]):
+                    assert prev["last_int"] < record["first_int"], \
+                        "Overlapping SREs"
+                monitor.get_count(ip_ver)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write)] + \
+        [threading.Thread(target=read) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, "Errors: {}".format(errors)
+
+    # same results of a rebuild
+    records = list(monitor.get_prefixes(ip_ver))
+    cnt = monitor.get_count(ip_ver)
+    monitor._populate_smallest_routable_entries(ip_ver)
+    assert monitor.get_count(ip_ver) == cnt
+    assert list(monitor.get_prefixes(ip_ver)) == records
+
+    # locks survive profiling, and methods are wrapped only once
+    for i in range(3):
+        monitor.enable_profiling()
+        monitor.disable_profiling()
+    for name in monitor.LOCKED_METHODS:
+        wrapper = monitor.__dict__[name]
+        assert not hasattr(wrapper.__wrapped__, "__wrapped__"), \
+            "{} wrapped more than once".format(name)
+    assert monitor.stats()[ip_ver]["prefixes"] == \
+        monitor.get_prefixes_cnt(ip_ver)
+    assert monitor.get_changes(ip_ver).cnt == cnt
+
+    test_outcome("threads",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_coverage(ip_ver, prefix_cnt, target_prefix_lens):
+    # is_covered(), covering_prefix() and count_in() must match a scan
+    # of the SREs
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_lens)
+    nets = []
+    for i in range(prefix_cnt):
+        nets.append(add_random_net(ip_ver, max(target_prefix_lens))[1])
+        if i % 3 == 0:
+            usres_monitor.del_net(nets.pop(random.randrange(len(nets))))
+
+    tot_len = 32 if ip_ver == 4 else 128
+    get_ip_repr = UniqueSmallestRoutableEntriesMonitor.get_ip_repr
+
+    for target_prefix_len in target_prefix_lens:
+        sres = list(usres_monitor.get_prefixes(ip_ver, target_prefix_len))
+
+        def scan(first, pref_len):
+            # SREs that cover the prefix, and SREs within it
+            covering = [sre for sre in sres
+                        if sre["pref_len"] <= pref_len and
+                        (first ^ sre["first_int"]) >>
+                        (tot_len - sre["pref_len"]) == 0]
+            within = [sre for sre in sres
+                      if sre["pref_len"] >= pref_len and
+                      (first ^ sre["first_int"]) >>
+                      (tot_len - pref_len) == 0]
+            return covering, within
+
+        # random addresses, and addresses within the SREs
+        addrs = [random.randint(0, 2**(tot_len - 1) - 1) for i in range(300)]
+        for sre in random.sample(sres, 300):
+            addrs.append(sre["first_int"] + random.randint(
+                0, sre["last_int"] - sre["first_int"]))
+        addrs.append(0)
+        addrs.append(2**(tot_len - 1) - 1)
+        for addr in addrs:
+            covering, within = scan(addr, tot_len)
+            addr_str = str(get_ip_repr(ip_ver, addr))
+            assert usres_monitor.is_covered(
+                addr_str, target_prefix_len) == bool(covering)
+            assert usres_monitor.covering_prefix(
+                addr_str, target_prefix_len) == \
+                (covering[0] if covering else None), \
+                "Unexpected covering prefix for {}".format(addr_str)
+
+        for i in range(300):
+            pref_len = random.randint(1, target_prefix_len)
+            first = random.randint(0, 2**(pref_len - 1) - 1) << \
+                tot_len - pref_len
+            covering, within = scan(first, pref_len)
+            net = "{}/{}".format(get_ip_repr(ip_ver, first), pref_len)
+            if covering:
+                exp_cnt = 2**(target_prefix_len - pref_len)
+            else:
+                exp_cnt = sum([sre["cnt"] for sre in within])
+            assert usres_monitor.count_in(net, target_prefix_len) == \
+                exp_cnt, "Unexpected count in {}".format(net)
+
+    test_outcome("coverage",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver,
+                     ", /".join(map(str, target_prefix_lens))),
+                 "OK")
+
+def test_raw(ip_ver, prefix_cnt, target_prefix_len):
+    # raw records carry the same values of the dicts, and IP strings are
+    # the same of ipaddr
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, [target_prefix_len - 4, target_prefix_len])
+    for i in range(prefix_cnt):
+        add_random_net(ip_ver, target_prefix_len)
+
+    for target in [None, target_prefix_len - 4]:
+        records = list(usres_monitor.get_prefixes(ip_ver, target, raw=True))
+        dicts = list(usres_monitor.get_prefixes(ip_ver, target))
+        assert [tuple(record) for record in records] == \
+            [(d["id"], d["first_int"], d["pref_len"], d["last_int"], d["cnt"])
+             for d in dicts], "Raw records don't match"
+
+    tot_len = 32 if ip_ver == 4 else 128
+    values = [0, 2**tot_len - 1, 1, 2**(tot_len - 1)] + \
+        [random.randint(0, 2**tot_len - 1) for i in range(1000)] + \
+        [random.randint(0, 2**16 - 1) << random.randint(0, tot_len - 16)
+         for i in range(1000)]
+    for value in values:
+        assert UniqueSmallestRoutableEntriesMonitor.get_ip_str(
+            ip_ver, value) == \
+            str(UniqueSmallestRoutableEntriesMonitor.get_ip_repr(
+                ip_ver, value)), "Unexpected IP string: {}".format(value)
+
+    test_outcome("raw",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_pages(ip_ver, prefix_cnt, target_prefix_len):
+    # pages must give all the prefixes, sorted by first, also when other
+    # calls are made between them
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, [target_prefix_len - 4, target_prefix_len])
+    for i in range(prefix_cnt):
+        add_random_net(ip_ver, target_prefix_len)
+
+    def read_pages(limit, target):
+        res = []
+        after = None
+        while True:
+            page = usres_monitor.get_prefixes_page(
+                ip_ver, after=after, limit=limit, target_prefix_len=target)
+            # other queries between pages
+            next(usres_monitor.get_prefixes(ip_ver))
+            res.extend(page)
+            if len(page) < limit:
+                return res
+            after = page[-1]["first_int"]
+
+    for target in [None, target_prefix_len - 4]:
+        exp = sorted(usres_monitor.get_prefixes(ip_ver, target),
+                     key=lambda prefix: prefix["first_int"])
+        for limit in [1, 7, 1000, len(exp), 100000]:
+            assert read_pages(limit, target) == exp, \
+                "Pages don't match, limit {}".format(limit)
+        assert [tuple(record) for record in usres_monitor.get_prefixes_page(
+                ip_ver, limit=10, target_prefix_len=target, raw=True)] == \
+            [(p["id"], p["first_int"], p["pref_len"], p["last_int"],
+              p["cnt"]) for p in exp[:10]]
+
+    # updates between pages are reflected by the following pages
+    page = usres_monitor.get_prefixes_page(ip_ver, limit=10)
+    last = usres_monitor.get_prefixes_page(ip_ver, limit=1,
+                                           after=page[-1]["first_int"])[0]
+    usres_monitor.del_net("{}/{}".format(last["first_ip"], last["pref_len"]))
+    next_page = usres_monitor.get_prefixes_page(
+        ip_ver, limit=10, after=page[-1]["first_int"])
+    assert last["id"] not in [p["id"] for p in next_page]
+
+    try:
+        usres_monitor.get_prefixes_page(ip_ver, limit=0)
+    except USRESMonitorException:
+        pass
+    else:
+        raise AssertionError("Invalid limit accepted")
+
+    test_outcome("pages",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_compat():
+    # attributes of the monitor from before backends were introduced
+    new_usres(4, 24)
+    if backend == "sqlite":
+        assert usres_monitor.sqlite_lib_name == sqlite_lib
+        assert usres_monitor.sqlite_version
+        assert usres_monitor.cur is usres_monitor.backend.cur
+        assert usres_monitor.sql_out(
+            "SELECT COUNT(*) FROM prefixes4").fetchall()[0][0] == 0
+        try:
+            usres_monitor.cur = None
+            raise AssertionError("cur is not read-only")
+        except AttributeError:
+            pass
+    else:
+        assert not hasattr(usres_monitor, "cur")
+        try:
+            usres_monitor.sql_out("SELECT 1")
+            raise AssertionError("sql_out() didn't fail")
+        except USRESMonitorException as e:
+            assert "not supported" in str(e), str(e)
+
+    test_outcome("test_compat", "backend attributes", "OK")
+
+def test_stats():
+    new_usres(4, 24)
+    usres_monitor.add_net("10.0.0.0/8")
+    usres_monitor.add_nets(["192.168.0.0/16", "192.168.1.0/24"])
+    stats = usres_monitor.stats()[4]
+    assert stats["prefixes"] == 3
+    assert stats["incremental_updates"] == 1
+    assert not stats["sres_up_to_date"]
+    assert stats["populate_runs"] == 0
+    assert usres_monitor.stats()["timings"] == {}
+
+    calls = []
+    usres_monitor.enable_profiling(
+        callback=lambda operation, elapsed: calls.append(operation)
+    )
+    assert usres_monitor.get_count(4) == 65536 + 256
+    assert len(list(usres_monitor.get_prefixes(4))) == 2
+    usres_monitor.add_net("192.0.2.0/24")
+    assert calls == ["populate", "get_count", "get_prefixes",
+                     "add_net_int", "add_net"], \
+        "Unexpected calls: {}".format(calls)
+
+    usres_monitor.disable_profiling()
+    usres_monitor.get_count(4)
+    assert "add_net" not in usres_monitor.__dict__
+    assert len(calls) == 5
+
+    stats = usres_monitor.stats()
+    assert stats[4]["sres_up_to_date"]
+    assert stats[4]["prefixes"] == 4
+    assert stats[4]["sres"] == 3
+    assert stats[4]["sre_cnt"] == 65536 + 256 + 1
+    assert stats[4]["incremental_updates"] == 2
+    assert stats[4]["populate_runs"] == 1
+    assert stats[4]["last_populate_rows"] == 3
+    assert stats[4]["last_populate_covered"] == 1
+    assert stats[4]["cache_misses"] == 1
+    assert stats[4]["cache_hits"] == 2
+    assert stats[6]["prefixes"] == 0
+    assert usres_monitor.get_prefixes_cnt(4) == 4
+    usres_monitor.add_net("192.0.2.0/24", source="peer")
+    usres_monitor.del_nets(["10.0.0.0/8"])
+    assert usres_monitor.get_prefixes_cnt(4) == 3
+    assert usres_monitor.get_prefixes_cnt(6) == 0
+    assert sorted(stats["timings"]) == ["add_net", "add_net_int",
+                                        "get_count", "get_prefixes",
+                                        "populate"]
+    assert stats["timings"]["get_count"]["calls"] == 1
+
+    test_outcome("test_stats", "stats/profiling", "OK")
+
+def test_changes(ip_ver, prefix_cnt, target_prefix_len):
+    # applying the changes to the previous SREs must give the current ones
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_len)
+    sres = {}
+    cnt = 0
+
+    def apply_changes():
+        changes = usres_monitor.get_changes(ip_ver)
+        for record in changes.removed:
+            assert sres.pop(record["id"]) == record
+        for record in changes.added:
+            assert record["id"] not in sres
+            sres[record["id"]] = record
+        assert sorted(sres.values(), key=lambda r: r["id"]) == \
+            list(usres_monitor.get_prefixes(ip_ver)), \
+            "Changes don't match the SREs"
+        assert changes.cnt == usres_monitor.get_count(ip_ver)
+        return changes
+
+    nets = [add_random_net(ip_ver, target_prefix_len)[1] for i in range(10)]
+    changes = apply_changes()
+    assert changes.cnt_delta == changes.cnt
+    assert not changes.removed
+
+    for i in range(prefix_cnt):
+        nets.append(add_random_net(ip_ver, target_prefix_len)[1])
+        if i % 3 == 0:
+            usres_monitor.del_net(nets.pop(random.randrange(len(nets))))
+        if i % 50 == 0:
+            cnt = usres_monitor.get_count(ip_ver)
+            apply_changes()
+
+    # no changes
+    cnt = usres_monitor.get_count(ip_ver)
+    changes = apply_changes()
+    changes = apply_changes()
+    assert not changes.added and not changes.removed
+    assert changes.cnt_delta == 0
+
+    # changes applied in bulk
+    random.shuffle(nets)
+    usres_monitor.del_nets(nets[:len(nets) // 2])
+    changes = apply_changes()
+    assert changes.cnt_delta == changes.cnt - cnt
+
+    # added then removed: not reported
+    net = "{}/{}".format("10.0.0.0" if ip_ver == 4 else "2001:db8::",
+                         target_prefix_len)
+    if net not in [str(n) for n in nets]:
+        usres_monitor.add_net(net)
+        usres_monitor.del_net(net)
+        changes = apply_changes()
+        assert not changes.added and not changes.removed
+
+    test_outcome("changes",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_sources(ip_ver, prefix_cnt, target_prefix_len):
+    # a prefix is removed only when no sources reference it
+    def check_prefixes(expected):
+        ref = UniqueSmallestRoutableEntriesMonitor(
+            target_prefix_len4=usres_monitor.target_prefix_len4,
+            target_prefix_len6=usres_monitor.target_prefix_len6,
+            backend="intervals"
+        )
+        ref.add_nets(expected)
+        # IDs depend on the insertion order
+        assert sorted([(r["first_int"], r["pref_len"], r["last_int"],
+                        r["cnt"])
+                       for r in usres_monitor.get_prefixes(ip_ver)]) == \
+            sorted([(r["first_int"], r["pref_len"], r["last_int"], r["cnt"])
+                    for r in ref.get_prefixes(ip_ver)]), \
+            "SREs don't match the referenced prefixes"
+        assert usres_monitor.get_count(ip_ver) == ref.get_count(ip_ver)
+
+    def expect_error(func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except USRESMonitorException:
+            return
+        raise AssertionError("No errors raised")
+
+    import os
+    import shutil
+    import tempfile
+
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_len)
+    net = "10.0.0.0/8" if ip_ver == 4 else "2001:db8::/32"
+
+    usres_monitor.add_net(net, source="a")
+    usres_monitor.add_net(net, source=1)
+    usres_monitor.add_net(net)
+    expect_error(usres_monitor.add_net, net, source="a")
+    expect_error(usres_monitor.add_net, net)
+    expect_error(usres_monitor.add_net, net, source=1.5)
+    expect_error(usres_monitor.flush_source, None)
+    usres_monitor.del_net(net)
+    usres_monitor.del_net(net, source="a")
+    check_prefixes([net])
+    assert usres_monitor.flush_source("a") == 0
+    assert usres_monitor.flush_source(1) == 1
+    check_prefixes([])
+    usres_monitor.add_net(net)
+    usres_monitor.del_net(net, source="a")
+    check_prefixes([net])
+    usres_monitor.del_net(net)
+    check_prefixes([])
+
+    # each source announces a random subset of the same prefixes
+    nets = set()
+    while len(nets) < prefix_cnt:
+        nets.add(str(add_random_net(ip_ver, target_prefix_len)[1]))
+    nets = sorted(nets)
+    usres_monitor.del_nets(nets)
+    sources = {}
+    for source in ["a", "b", "c"]:
+        sources[source] = set(random.sample(nets, prefix_cnt // 2))
+    sources[None] = set(random.sample(nets, prefix_cnt // 10))
+
+    for source in ["a", "b"]:
+        res = usres_monitor.add_nets(sorted(sources[source]), batch_size=100,
+                                     source=source)
+        assert res.processed == len(sources[source]) and not res.duplicates
+    for net in sorted(sources["c"]):
+        usres_monitor.add_net(net, source="c")
+    usres_monitor.add_nets(sorted(sources[None]))
+    res = usres_monitor.add_nets(sorted(sources["a"])[:10], source="a")
+    assert len(res.duplicates) == 10
+
+    def referenced():
+        return set().union(*sources.values())
+
+    check_prefixes(referenced())
+
+    # few prefixes removed: SREs updated incrementally
+    usres_monitor.get_count(ip_ver)
+    removed = sorted(sources["c"])[:prefix_cnt // 20]
+    res = usres_monitor.del_nets(removed, source="c")
+    assert res.processed == len(removed) and not res.missing
+    res = usres_monitor.del_nets(removed, source="c")
+    assert len(res.missing) == len(removed)
+    sources["c"].difference_update(removed)
+    check_prefixes(referenced())
+
+    # few prefixes left without references: SREs updated incrementally
+    sources["d"] = set(random.sample(nets, 20))
+    usres_monitor.add_nets(sorted(sources["d"]), source="d")
+    usres_monitor.get_count(ip_ver)
+    updates = usres_monitor.stats()[ip_ver]["incremental_updates"]
+    assert usres_monitor.flush_source("d") == 20
+    assert usres_monitor.stats()[ip_ver]["incremental_updates"] > updates
+    del sources["d"]
+    check_prefixes(referenced())
+
+    # references survive a snapshot
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "snapshot")
+        usres_monitor.save_snapshot(path)
+        new_usres(ip_ver, target_prefix_len)
+        usres_monitor.load_snapshot(path)
+    finally:
+        shutil.rmtree(tmp_dir)
+    check_prefixes(referenced())
+
+    for source in ["c", "a", "b"]:
+        assert usres_monitor.flush_source(source) == len(sources[source])
+        assert usres_monitor.flush_source(source) == 0
+        del sources[source]
+        check_prefixes(referenced())
+
+    usres_monitor.del_nets(sorted(sources[None]))
+    check_prefixes([])
+
+    test_outcome("sources",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_backends_match(ip_ver, prefix_cnt, target_prefix_len):
+    # same random adds/dels on all the backends must give the same SREs
+    global backend, sqlite_lib
+    results = []
+    for backend, sqlite_lib in backends:
+        random.seed(prefix_cnt)
+        new_usres(ip_ver, target_prefix_len)
+        nets = []
+        for i in range(prefix_cnt):
+            nets.append(add_random_net(ip_ver, target_prefix_len)[1])
+            if i % 3 == 0:
+                usres_monitor.del_net(random.choice(nets))
+        results.append((usres_monitor.get_count(ip_ver),
+                        list(usres_monitor.get_prefixes(ip_ver))))
+
+    for res in results[1:]:
+        assert res == results[0], "Backends don't match"
+
+    test_outcome("backends_match",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_disk(ip_ver, prefix_cnt, target_prefix_len):
+    # a database kept in a file gives the same results of the in-memory one
+    import os
+    import shutil
+    import tempfile
+    global usres_monitor
+
+    def expect_error(msg, **kwargs):
+        try:
+            UniqueSmallestRoutableEntriesMonitor(backend=backend,
+                                                 force_sqlite_lib=sqlite_lib,
+                                                 **kwargs)
+            raise AssertionError("No error with {}".format(kwargs))
+        except USRESMonitorException as e:
+            assert msg in str(e), str(e)
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "usres.db")
+    try:
+        if backend != "sqlite":
+            expect_error("can't be used", db_path=path)
+            return
+
+        expect_error("only with db_path", db_pragmas={"page_size": 4096})
+        expect_error("Unknown PRAGMA", db_path=path,
+                     db_pragmas={"foo": 1})
+        expect_error("Invalid value", db_path=path,
+                     db_pragmas={"journal_mode": "WAL; DROP"})
+
+        random.seed(prefix_cnt)
+        new_usres(ip_ver, target_prefix_len)
+        memory = usres_monitor
+        usres_monitor = UniqueSmallestRoutableEntriesMonitor(
+            target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+            target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+            force_sqlite_lib=sqlite_lib,
+            backend=backend,
+            db_path=path,
+            db_pragmas={"page_size": 4096, "cache_size": 100,
+                        "journal_mode": "WAL"}
+        )
+        disk = usres_monitor
+        assert os.path.exists(path)
+        assert disk.sql_out("PRAGMA page_size").fetchall()[0][0] == 4096
+        assert disk.sql_out("PRAGMA cache_size").fetchall()[0][0] == 100
+        assert disk.sql_out(
+            "PRAGMA journal_mode").fetchall()[0][0].lower() == "wal"
+
+        # the file must not be reused
+        expect_error("already exists", db_path=path)
+
+        nets = []
+        for i in range(prefix_cnt):
+            res, net = add_random_net(ip_ver, target_prefix_len)
+            if res == "ok":
+                nets.append(net)
+            if i % 3 == 0:
+                disk.del_net(nets.pop(random.randrange(len(nets))))
+        memory.add_nets(nets)
+        disk.del_nets(nets[:100], source="peer")
+        disk.add_nets(nets[:100], source="peer")
+        disk.flush_source("peer")
+        disk.add_nets(nets[:100])
+
+        assert disk.get_count(ip_ver) == memory.get_count(ip_ver)
+        assert sorted(r[1:] for r in disk.get_prefixes(ip_ver, raw=True)) \
+            == sorted(r[1:] for r in memory.get_prefixes(ip_ver, raw=True))
+
+        # snapshots are loaded into the file
+        snapshot = os.path.join(tmp_dir, "snapshot")
+        memory.save_snapshot(snapshot)
+        os.remove(path)
+        usres_monitor = UniqueSmallestRoutableEntriesMonitor(
+            target_prefix_len4=target_prefix_len if ip_ver == 4 else 24,
+            target_prefix_len6=target_prefix_len if ip_ver == 6 else 40,
+            force_sqlite_lib=sqlite_lib,
+            backend=backend,
+            db_path=path
+        )
+        assert usres_monitor.sql_out(
+            "PRAGMA journal_mode").fetchall()[0][0].lower() == "memory"
+        usres_monitor.load_snapshot(snapshot)
+        assert list(usres_monitor.get_prefixes(ip_ver)) == \
+            list(memory.get_prefixes(ip_ver))
+
+        # snapshots saved from the file, with a different page size, are
+        # loaded into memory
+        assert usres_monitor.sql_out("PRAGMA page_size").fetchall()[0][0] \
+            != memory.sql_out("PRAGMA page_size").fetchall()[0][0]
+        os.remove(snapshot)
+        usres_monitor.save_snapshot(snapshot)
+        new_usres(ip_ver, target_prefix_len)
+        usres_monitor.load_snapshot(snapshot)
+        assert list(usres_monitor.get_prefixes(ip_ver)) == \
+            list(memory.get_prefixes(ip_ver))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    test_outcome("disk",
+                 "{} IPv{} prefixes, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_buffer(ip_ver, prefix_cnt, target_prefix_len):
+    # coalesced events give the same prefixes of the events applied one
+    # by one, also when they are duplicate or missing
+    from pierky.usres_monitor.buffer import CoalescingBuffer
+
+    def new_monitor():
+        new_usres(ip_ver, target_prefix_len)
+        return usres_monitor
+
+    def check(monitor, ref):
+        assert monitor.get_count(ip_ver) == ref.get_count(ip_ver)
+        # IDs depend on the insertion order
+        assert sorted(r[1:] for r in monitor.get_prefixes(ip_ver, raw=True)) \
+            == sorted(r[1:] for r in ref.get_prefixes(ip_ver, raw=True)), \
+            "SREs don't match"
+
+    random.seed(prefix_cnt)
+    new_usres(ip_ver, target_prefix_len)
+    nets = set()
+    while len(nets) < prefix_cnt // 10:
+        nets.add(str(add_random_net(ip_ver, target_prefix_len)[1]))
+    nets = sorted(nets)
+
+    events = []
+    for i in range(prefix_cnt):
+        events.append((random.choice(["add", "add", "del"]),
+                       random.choice(nets), random.choice([None, "a", "b"])))
+    events.append(("flush", None, "b"))
+    events += [("add", net, "b") for net in nets[:10]]
+
+    ref = new_monitor()
+    for action, net, source in events:
+        if action == "add":
+            try:
+                ref.add_net(net, source=source)
+            except USRESMonitorException:
+                pass
+        elif action == "del":
+            ref.del_net(net, source=source)
+        else:
+            ref.flush_source(source)
+
+    for batch_size, bulk_min in [(1, 100), (10, 100), (100, 1), (5000, 100)]:
+        monitor = new_monitor()
+        buf = CoalescingBuffer(monitor, batch_size=batch_size,
+                               batch_interval=3600)
+        buf.BULK_MIN = bulk_min
+        buf.BULK_SHARE = 0
+        for action, net, source in events:
+            if action == "add":
+                buf.add_net(net, source=source)
+            elif action == "del":
+                buf.del_net(net, source=source)
+            else:
+                buf.flush_source(source)
+        buf.flush()
+        assert not len(buf)
+        check(monitor, ref)
+        assert buf.events == prefix_cnt + 10
+        if batch_size > 1:
+            assert buf.coalesced and buf.processed < prefix_cnt
+
+    # events that cancel out are not applied, their IDs are not used
+    now = [0]
+    monitor = new_monitor()
+    buf = CoalescingBuffer(monitor, batch_size=100, batch_interval=10,
+                           timer=lambda: now[0])
+    first, pref_len = monitor.parse_net(nets[0])[1:]
+    buf.add_net_int(ip_ver, first, pref_len)
+    buf.add_net(nets[1])
+    buf.del_net(nets[1])
+    generation = monitor.get_generation(ip_ver)
+    assert len(buf) == 2 and buf.poll() is None
+    now[0] = 10
+    res = buf.poll()
+    assert res.processed == 1 and buf.netted == 1 and not len(buf)
+    assert monitor.get_generation(ip_ver) == generation + 1
+    assert list(monitor.get_prefixes(ip_ver, raw=True))[0][0] == 1
+
+    # the first event was a duplicate: the last one decides
+    buf.add_net(nets[0])
+    buf.del_net(nets[0])
+    now[0] = 20
+    buf.add_net(nets[1])
+    assert buf.flushes == 2 and not len(buf)
+    assert monitor.get_count(ip_ver) == \
+        monitor.get_sre(monitor.get_net(nets[1]), target_prefix_len)[2]
+
+    res = buf.flush()
+    buf.add_net(nets[1])
+    buf.del_net(nets[2])
+    res = buf.flush()
+    assert res.processed == 0
+    assert res.duplicates == [nets[1]] and res.missing == [nets[2]]
+
+    # errors are raised when events are received
+    for func, args in [(buf.add_net, ("foo",)),
+                       (buf.add_net_int, (ip_ver, 0, target_prefix_len + 1)),
+                       (buf.del_net, (nets[0], 1.5))]:
+        try:
+            func(*args)
+        except (AssertionError, ValueError, USRESMonitorException):
+            pass
+        else:
+            raise AssertionError("No errors raised")
+    assert not len(buf)
+
+    test_outcome("buffer",
+                 "{} IPv{} events, /{}".format(
+                     prefix_cnt, ip_ver, target_prefix_len),
+                 "OK")
+
+def test_mrt(prefix_cnt):
+    # prefixes of MRT RIB dumps give the same SREs of add_nets(), whatever
+    # the compression and the size of the buffer
+    import bz2
+    import gzip
+    import os
+    import shutil
+    import tempfile
+    from pierky.usres_monitor.mrt import MRTLoader
+
+    def record(mrt_type, subtype, body):
+        return struct.pack("!IHHI", 1483228800, mrt_type, subtype,
+                           len(body)) + body
+
+    def rib_record(seq, ip_ver, first, pref_len, peers, addpath=False):
+        prefix = struct.pack("!QQ", first >> 64, first & (2**64 - 1)) \
+            if ip_ver == 6 else struct.pack("!I", first)
+        body = struct.pack("!IB", seq, pref_len) + \
+            prefix[:(pref_len + 7) // 8] + struct.pack("!H", peers)
+        for peer in range(peers):
+            # peer index, originated time, [path id], attributes
+            body += struct.pack("!HI", peer, 1483228800)
+            if addpath:
+                body += struct.pack("!I", peer)
+            body += struct.pack("!H", 4) + b"\x40\x01\x01\x00"
+        subtype = {4: 2, 6: 4}[ip_ver] + (6 if addpath else 0)
+        return record(13, subtype, body)
+
+    random.seed(prefix_cnt)
+    nets = []
+    new_usres(4, 24)
+    for ip_ver, target_prefix_len in [(4, 24), (6, 40)]:
+        for i in range(prefix_cnt):
+            nets.append(add_random_net(ip_ver, target_prefix_len)[1])
+    nets = sorted(set(nets), key=lambda net: (net.version, net))
+
+    data = record(13, 1, b"\x00" * 10)  # PEER_INDEX_TABLE
+    data += record(16, 4, b"\x00" * 20)  # BGP4MP
+    loaded = []
+    for seq, net in enumerate(nets):
+        ip_ver, first, pref_len = \
+            UniqueSmallestRoutableEntriesMonitor.parse_net(net)
+        if seq % 7 == 0:
+            # same prefix in the multicast RIB
+            data += record(13, 3 if ip_ver == 4 else 5, b"\x00" * 8)
+        if seq % 11 == 0:
+            # no routes
+            data += rib_record(seq, ip_ver, first, pref_len, 0)
+            continue
+        data += rib_record(seq, ip_ver, first, pref_len,
+                           random.randint(1, 50), addpath=seq % 5 == 0)
+        if seq % 13 == 0:
+            data += rib_record(seq, ip_ver, first, pref_len, 1)
+        loaded.append(net)
+    data += rib_record(0, 4, 0xC0000200, 25, 3)
+    data += rib_record(0, 6, 0x20010DB8 << 96, 48, 3)
+
+    new_usres(4, 24)
+    exp = usres_monitor
+    exp.add_nets(loaded)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for name, open_func in [("rib", open), ("rib.gz", gzip.open),
+                                ("rib.bz2", bz2.BZ2File)]:
+            paths.append(os.path.join(tmp_dir, name))
+            f = open_func(paths[-1], "wb")
+            f.write(data)
+            f.close()
+
+        for path, buffer_size, batch_size in [(paths[0], 1000000, 10000),
+                                              (paths[1], 100, 1000),
+                                              (paths[2], 10, 7)]:
+            new_usres(4, 24)
+            loader = MRTLoader(usres_monitor, batch_size=batch_size,
+                               buffer_size=buffer_size)
+            assert loader.load(path) == len(loaded)
+            assert loader.too_long == 2 and loader.duplicates == 0
+            assert loader.skipped == 2 + len(range(0, len(nets), 7))
+            for ip_ver in [4, 6]:
+                assert usres_monitor.get_count(ip_ver) == \
+                    exp.get_count(ip_ver)
+                assert list(usres_monitor.get_prefixes(ip_ver)) == \
+                    list(exp.get_prefixes(ip_ver))
+
+        # prefixes of further files are added to the same monitor
+        assert loader.load(paths[1]) == 0
+        assert loader.duplicates == len(loaded)
+        with open(paths[0], "rb") as f:
+            assert loader.load(f, source="rrc00") == len(loaded)
+        assert loader.processed == 2 * len(loaded)
+        assert usres_monitor.flush_source("rrc00") == len(loaded)
+        assert usres_monitor.get_count(4) == exp.get_count(4)
+
+        with open(paths[0], "wb") as f:
+            f.write(data[:-10])
+        try:
+            loader.load(paths[0])
+        except USRESMonitorException as e:
+            assert "Truncated" in str(e)
+        else:
+            raise AssertionError("No errors raised")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    test_outcome("mrt", "{} prefixes".format(len(nets)), "OK")
+
+def test_snapshot():
+    import os
+    import shutil
+    import tempfile
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "snapshot")
+    try:
+        random.seed(3)
+        new_usres(4, 24)
+        for i in range(3000):
+            add_random_net(4, 24)
+        usres_monitor.add_nets(["2001:db8::/32", "2001:db8:1::/48",
+                                "2001:db9::/48", "::/1"])
+        records4 = list(usres_monitor.get_prefixes(4))
+        records6 = list(usres_monitor.get_prefixes(6))
+        cnt4 = usres_monitor.get_count(4)
+        cnt6 = usres_monitor.get_count(6)
+        usres_monitor.save_snapshot(path)
+
+        # an existing snapshot is replaced
+        usres_monitor.add_net("0.0.0.0/1")
+        usres_monitor.save_snapshot(path)
+        usres_monitor.del_net("0.0.0.0/1")
+        usres_monitor.save_snapshot(path)
+
+        new_usres(4, 24)
+        usres_monitor.add_net("10.0.0.0/8")
+        generation = usres_monitor.get_generation(4)
+        usres_monitor.load_snapshot(path)
+        assert usres_monitor.get_generation(4) != generation
+        assert usres_monitor.get_count(4) == cnt4
+        assert usres_monitor.get_count(6) == cnt6
+        assert list(usres_monitor.get_prefixes(4)) == records4
+        assert list(usres_monitor.get_prefixes(6)) == records6
+
+        # SREs are still kept up to date
+        usres_monitor.add_net("0.0.0.0/1")
+        usres_monitor.del_net("::/1")
+        usres_monitor._populate_smallest_routable_entries(4)
+        usres_monitor._populate_smallest_routable_entries(6)
+        assert usres_monitor.get_count(4) == \
+            sum([record["cnt"] for record in usres_monitor.get_prefixes(4)])
+        assert usres_monitor.get_count(6) == \
+            sum([record["cnt"] for record in usres_monitor.get_prefixes(6)])
+
+        new_usres(4, 23)
+        try:
+            usres_monitor.load_snapshot(path)
+            raise AssertionError("Snapshot with different target loaded")
+        except USRESMonitorException as e:
+            assert "target_prefix_len4" in str(e)
+
+        try:
+            usres_monitor.load_snapshot(path + ".missing")
+            raise AssertionError("Missing snapshot loaded")
+        except USRESMonitorException:
+            pass
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    test_outcome("test_snapshot", "save/load", "OK")
+
+def test_exabgp():
+    import asyncio
+    from collections import OrderedDict
+    from pierky.usres_monitor.exabgp import ExaBGPIngestor
+
+    def update(announce=None, withdraw=None, peer="192.0.2.1"):
+        msg = {
+            "exabgp": "4.0.1",
+            "type": "update",
+            "neighbor": {
+                "address": {"local": "192.0.2.2", "peer": peer},
+                "direction": "receive",
+                "message": {"update": {}}
+            }
+        }
+        if announce:
+            msg["neighbor"]["message"]["update"]["announce"] = announce
+        if withdraw:
+            msg["neighbor"]["message"]["update"]["withdraw"] = withdraw
+        return json.dumps(msg)
+
+    lines = [
+        update(announce={"ipv4 unicast": {"192.0.2.1": [
+            {"nlri": "10.0.0.0/8"}, {"nlri": "192.168.0.0/16"},
+            {"nlri": "172.16.0.0/12"}]}}),
+        # ExaBGP 3 format
+        update(announce={"ipv6 unicast": {"2001:db8::1": {
+            "2001:db8::/32": {}}}}),
+        json.dumps({"type": "state", "neighbor": {"state": "up"}}),
+        "not json",
+        update(withdraw={"ipv4 unicast": [{"nlri": "192.168.0.0/16"}]}),
+        # announced and then withdrawn within the same batch
+        update(announce={"ipv4 unicast": {"192.0.2.1": [
+            {"nlri": "198.51.100.0/24"}]}}),
+        update(withdraw={"ipv4 unicast": {"198.51.100.0/24": {}}}),
+        update(announce={"ipv4 unicast": {"192.0.2.1": [
+            {"nlri": "10.0.0.0/8"}]}}),
+    ]
+
+    for batch_size in (1, 3, 10000):
+        new_usres(4, 24)
+        ingestor = ExaBGPIngestor(usres_monitor, batch_size=batch_size,
+                                  queue_size=2)
+        asyncio.run(ingestor.replay(lines))
+
+        assert ingestor.messages == 8
+        assert ingestor.bad_messages == 1
+        assert ingestor.events == 8
+        assert usres_monitor.get_count(4) == 65536 + 4096, \
+            "Unexpected count: {}".format(usres_monitor.get_count(4))
+        assert usres_monitor.get_count(6) == 2**8
+
+        test_outcome("test_exabgp", "batch size {}".format(batch_size),
+                     "OK ({} batches, {} coalesced)".format(
+                         ingestor.batches, ingestor.coalesced))
+
+    # prefixes are tracked per neighbor and flushed when it goes down
+    def state(peer, state):
+        return json.dumps({"type": "state", "neighbor": {
+            "address": {"local": "192.0.2.2", "peer": peer},
+            "state": state}})
+
+    lines = [
+        update(announce={"ipv4 unicast": {"192.0.2.1": [
+            {"nlri": "10.0.0.0/8"}, {"nlri": "192.168.0.0/16"}]}}),
+        update(announce={"ipv4 unicast": {"192.0.2.3": [
+            {"nlri": "10.0.0.0/8"}]}}, peer="192.0.2.3"),
+        update(withdraw={"ipv4 unicast": [{"nlri": "10.0.0.0/8"}]},
+               peer="192.0.2.3"),
+        state("192.0.2.3", "down"),
+        update(announce={"ipv4 unicast": {"192.0.2.3": [
+            {"nlri": "172.16.0.0/12"}]}}, peer="192.0.2.3"),
+        state("192.0.2.1", "down"),
+    ]
+    for batch_size in (1, 10000):
+        new_usres(4, 24)
+        ingestor = ExaBGPIngestor(usres_monitor, batch_size=batch_size)
+        asyncio.run(ingestor.replay(lines[:3]))
+        assert usres_monitor.get_count(4) == 65536 + 256
+        asyncio.run(ingestor.replay(lines[3:]))
+        assert usres_monitor.get_count(4) == 4096, \
+            "Unexpected count: {}".format(usres_monitor.get_count(4))
+        assert ingestor.flushed == 2
+
+    test_outcome("test_exabgp", "neighbors going down", "OK")
+
+    # small batches update the SREs incrementally, large ones in bulk
+    new_usres(4, 24)
+    ingestor = ExaBGPIngestor(usres_monitor)
+    nets = ["10.{}.{}.0/24".format(i // 256, i % 256) for i in range(300)]
+    ingestor.apply(OrderedDict(((None, net), "add") for net in nets))
+    assert usres_monitor.get_count(4) == 300
+    populate_runs = usres_monitor.stats()[4]["populate_runs"]
+    assert populate_runs == 1
+
+    ingestor.apply(OrderedDict([((None, nets[0]), "del"),
+                                ((None, "192.0.2.0/24"), "add"),
+                                ((None, "192.0.2.0/25"), "add"),
+                                ((None, "198.51.100.0/24"), "del")]))
+    assert usres_monitor.get_count(4) == 300
+    assert usres_monitor.stats()[4]["populate_runs"] == populate_runs
+    assert ingestor.invalid == 1
+    assert ingestor.missing == 1
+
+    test_outcome("test_exabgp", "incremental updates", "OK")
 
 def test_base():
     test_min_max("1.2.3.4/8", 24, "1.0.0.0", "1.255.255.0")
@@ -259,10 +1651,20 @@ def test_base():
     test_min_max("2000::/3", 64, "2000::", "3fff:ffff:ffff:ffff::")
     test_min_max("7fff:ffff:ffff:ffff::/64", 64,
                  "7fff:ffff:ffff:ffff::", "7fff:ffff:ffff:ffff::")
-    test_min_max("8000:0000:0000:0000::/64", 64, "", "", shoud_fail=True)
+    test_min_max("8000:0000:0000:0000::/64", 64, "8000::", "8000::")
+    test_min_max("ffff:ffff:ffff:ffff::/64", 64,
+                 "ffff:ffff:ffff:ffff::", "ffff:ffff:ffff:ffff::")
+    test_min_max("2001:aaaa::/32", 65,
+                 "2001:aaaa::", "2001:aaaa:ffff:ffff:8000::")
+    test_min_max("2001:db8::/64", 128,
+                 "2001:db8::", "2001:db8::ffff:ffff:ffff:ffff")
+    test_min_max("::/0", 128,
+                 "::", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff")
+    test_min_max("2001:db8::1/128", 128, "2001:db8::1", "2001:db8::1")
     test_min_max("192.168.0.1/32", 24, "", "", shoud_fail=True)
     test_min_max("2001:db8::/60", 56, "", "", shoud_fail=True)
-    test_min_max("2001:aaaa::/32", 65, "", "", shoud_fail=True)
+    test_min_max("2001:db8::/65", 64, "", "", shoud_fail=True)
+    test_min_max("2001:aaaa::/32", 129, "", "", shoud_fail=True)
 
     new_usres(4, 25)
     test_duplicate("192.0.2.0/24")
@@ -495,19 +1897,69 @@ def test_load():
         test_random_load(6, 1000, target_prefix_len)
         test_random_load(6, 10000, target_prefix_len)
 
-global sqlite_lib
-for sqlite_lib in ("sqlite3", "apsw"):
+        target_prefix_len = 128
+        test_random_load(6, 10000, target_prefix_len)
+
+backends = [
+    ("sqlite", "sqlite3"),
+    ("sqlite", "apsw"),
+    ("intervals", None)
+]
+
+global backend, sqlite_lib
+for backend, sqlite_lib in backends:
     new_usres(4, 24)
-    print("Testing with {} library and SQLite version {}".format(
-        usres_monitor.sqlite_lib_name,
-        usres_monitor.sqlite_version
-    ))
+    if backend == "sqlite":
+        print("Testing with {} library and SQLite version {}".format(
+            usres_monitor.backend.sqlite_lib_name,
+            usres_monitor.backend.sqlite_version
+        ))
+    else:
+        print("Testing with {} backend".format(backend))
     print("")
 
     test_base()
+    test_net_int()
+    test_ipv6_128()
     test_sres()
+    test_bulk()
+    test_compat()
+    test_stats()
+    test_changes(4, 3000, 24)
+    test_changes(6, 3000, 64)
+    test_sources(4, 3000, 24)
+    test_sources(6, 3000, 64)
+    test_target_lens(4, 3000, [22, 23, 24])
+    test_target_lens(6, 3000, [40, 48])
+    if numpy:
+        test_batch(4, 10000, 24)
+        test_batch(6, 10000, 64)
+    test_raw(4, 3000, 24)
+    test_raw(6, 3000, 64)
+    test_pages(4, 3000, 24)
+    test_pages(6, 3000, 64)
+    test_coverage(4, 3000, [20, 24])
+    test_coverage(6, 3000, [48, 64])
+    test_threads(4, 3000, 24)
+    test_threads(6, 3000, 64)
+    test_parallel(4, 10000, 24)
+    test_parallel(6, 10000, 64)
+    test_snapshot()
+    test_disk(4, 3000, 24)
+    test_disk(6, 3000, 64)
+    test_buffer(4, 3000, 24)
+    test_buffer(6, 3000, 64)
+    test_mrt(3000)
+    if sys.version_info >= (3, 7):
+        test_exabgp()
     test_load()
 
     print("\n\n")
 
-usres_monitor.dump_all()
+    if backend == "sqlite":
+        usres_monitor.dump_all()
+
+test_parse_net()
+test_backends_match(4, 10000, 24)
+test_backends_match(6, 10000, 64)
+test_backends_match(6, 10000, 128)